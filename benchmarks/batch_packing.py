@@ -0,0 +1,85 @@
+"""
+Benchmark of MessageQueue batch planning against the previous packing loop.
+
+Usage: python benchmarks/batch_packing.py [--messages N] [--recipients N ...]
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from feelsbot.message_queue import MAX_PER_BATCH, MAX_PER_USER, plan_batches  # noqa: E402
+
+
+def legacy_plan(queue):
+    # The packing loop as it was before plan_batches(): every batch rescans all recipients from the first.
+    batches = []
+    count = {person: 0 for person in queue}
+
+    def count_unprocessed():
+        result = False
+        for c in count:
+            if count[c] < len(queue[c]):
+                result = True
+        return result
+
+    while count_unprocessed():
+        sending = []
+        for person in queue:
+            if len(sending) >= 25:
+                break
+            add = min(5, 25 - len(sending))
+            if count[person] < len(queue[person]):
+                sending += queue[person][count[person]:count[person] + add]
+                count[person] += add
+        if len(sending) > 0:
+            batches.append(sending)
+    return batches
+
+
+def build_queue(messages, recipients):
+    queue = {}
+    for i in range(messages):
+        person = 'user{}'.format(i % recipients)
+        queue.setdefault(person, []).append((person, i))
+    return queue
+
+
+def check(queue, batches):
+    seen = [item for batch in batches for item in batch]
+    assert sorted(seen) == sorted(item for items in queue.values() for item in items), 'messages lost or repeated'
+    for batch in batches:
+        assert len(batch) <= MAX_PER_BATCH, 'batch too large'
+        assert max(Counter(person for person, _ in batch).values()) <= MAX_PER_USER, 'too many for one user'
+
+
+def timed(plan, queue, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        batches = plan(queue)
+    return (time.perf_counter() - start) / repeat, batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--recipients', type=int, nargs='*', default=[1, 10, 100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>12} {:>12} {:>14} {:>14}'.format(
+        'messages', 'recipients', 'batches', 'old batches', 'planned ms', 'old loop ms'))
+    for recipients in args.recipients:
+        queue = build_queue(args.messages, recipients)
+        planned, batches = timed(plan_batches, queue, args.repeat)
+        legacy, legacy_batches = timed(legacy_plan, queue, args.repeat)
+        check(queue, batches)
+        print('{:>10} {:>10} {:>12} {:>12} {:>14.2f} {:>14.2f}'.format(
+            args.messages, recipients, len(batches), len(legacy_batches), planned * 1e3, legacy * 1e3))
+
+
+if __name__ == '__main__':
+    main()
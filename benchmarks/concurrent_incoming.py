@@ -0,0 +1,145 @@
+"""
+Stress check of concurrent /incoming requests against one app instance, verifying that replies never cross between
+requests (each request must send exactly its own replies, to its own sender and chat).
+
+Kik itself is replaced by an in-process recorder, so nothing is sent over the network. A smaller version runs with
+the tests, see tests/test_concurrent_incoming.py.
+
+Usage: python benchmarks/concurrent_incoming.py [--threads N] [--requests N]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from feelsbot import init_app  # noqa: E402
+from feelsbot.database import FeelsTable  # noqa: E402
+from feelsbot.kik_api import PooledKikApi  # noqa: E402
+from feelsbot.parser import BUTTONS  # noqa: E402
+
+
+API_KEY = 'stress-key'
+ADMIN = 'stress-admin'
+RECIPIENT = 'stress-recipient'
+
+
+class Recorder:
+    """
+    Stand in for PooledKikApi.send_messages, recording every batch along with the request that sent it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.batches = []
+
+    def send_messages(self, messages):
+        with self.lock:
+            self.batches.append((getattr(self.local, 'request', None), [m.to_json() for m in messages]))
+        return {}
+
+
+def write_config(directory):
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as config_file:
+        json.dump({
+            'database': os.path.join(directory, 'stress.db'),
+            'bot_username': 'stress-bot',
+            'bot_api_key': API_KEY,
+            'webhook': 'http://localhost/incoming',
+            'admin': ADMIN,
+            'recipient': RECIPIENT,
+            'webhook_user': 'user',
+            'webhook_pass': 'pass',
+        }, config_file)
+    return path
+
+
+def post_incoming(client, recorder, number, user, body):
+    chat_id = 'chat-{}'.format(number)
+    data = json.dumps({'messages': [{
+        'type': 'text', 'id': 'message-{}'.format(number), 'from': user, 'chatId': chat_id, 'body': body,
+        'participants': [user], 'timestamp': int(time.time() * 1000),
+    }]}).encode('utf-8')
+    signature = base64.b16encode(hmac.new(API_KEY.encode('utf-8'), data, hashlib.sha1).digest()).decode('utf-8')
+    recorder.local.request = number
+    try:
+        response = client.post('/incoming', data=data, content_type='application/json',
+                               headers={'X-Kik-Signature': signature})
+    finally:
+        recorder.local.request = None
+    return number, user, chat_id, response.status_code
+
+
+def check(results, recorder):
+    sent = {}
+    for number, messages in recorder.batches:
+        sent.setdefault(number, []).extend(messages)
+
+    problems = []
+    for number, user, chat_id, status in results:
+        messages = sent.pop(number, [])
+        if status != 200:
+            problems.append('request {} returned {}'.format(number, status))
+        if user == RECIPIENT:
+            # A feel for the recipient and the matching notification for the admin, and nothing else.
+            if sorted(m['to'] for m in messages) != sorted([ADMIN, RECIPIENT]):
+                problems.append('request {} sent {}'.format(number, [m['to'] for m in messages]))
+        elif [(m['to'], m.get('chatId')) for m in messages] != [(user, chat_id)]:
+            problems.append('request {} from {} sent {}'.format(number, user, messages))
+    if sent:
+        problems.append('messages sent outside of any request: {}'.format(sent))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    recorder = Recorder()
+    # Avoid contacting Kik: no webhook configuration, and all sends are recorded instead.
+    PooledKikApi.set_configuration = lambda self, configuration: configuration
+    PooledKikApi.send_messages = lambda self, messages: recorder.send_messages(messages)
+
+    directory = tempfile.mkdtemp()
+    app = init_app(write_config(directory))
+    with FeelsTable() as table:
+        table.insert_feels([('stress', 'stress', 'feel {}'.format(i)) for i in range(100)])
+        for feel_id in range(1, 101):
+            table.approve(feel_id)
+    client = app.test_client()
+
+    requests = []
+    for number in range(args.requests):
+        if number % 5 == 0:
+            requests.append((number, RECIPIENT, BUTTONS['recipient_request_feel']))
+        else:
+            requests.append((number, 'stranger-{}'.format(number), 'hello {}'.format(number)))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(lambda r: post_incoming(client, recorder, *r), requests))
+    elapsed = time.perf_counter() - start
+
+    problems = check(results, recorder)
+    print('{} requests on {} threads in {:.2f}s ({:.0f}/s), {} batches sent'.format(
+        len(results), args.threads, elapsed, len(results) / elapsed, len(recorder.batches)))
+    for problem in problems[:20]:
+        print(problem)
+    print('FAILED: {} problems'.format(len(problems)) if problems else 'OK: no cross-talk between requests')
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
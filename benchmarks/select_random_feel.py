@@ -0,0 +1,87 @@
+"""
+Benchmark of the per-pick cost of FeelsTable.select_random_feel() against the previous full-scan selection.
+
+Usage: python benchmarks/select_random_feel.py [feel counts...] [--picks N]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from feelsbot.database import Database, FeelsTable  # noqa: E402
+from feelsbot.database.feels import QUERIES  # noqa: E402
+
+
+def build_database(path, count):
+    Database._config = None
+    Database.init_database({'database': path})
+    FeelsTable._index = None
+
+    connect = sqlite3.connect(path)
+    # Mostly approved, with a spread of selectors similar to a long running deployment.
+    rows = ((str(i), 'bench', 'feel {}'.format(i), 1 if i % 10 else random.choice((0, -1)), random.randint(40, 41))
+            for i in range(count))
+    with connect:
+        connect.executemany('INSERT INTO feels(submitted, name, comment, approved, selector) VALUES (?, ?, ?, ?, ?)',
+                            rows)
+    connect.close()
+
+
+def legacy_pick(table):
+    # The selection as it was before the index: a min() scan plus fetching every eligible id.
+    cursor = table._cursor
+    min_selector = cursor.execute(QUERIES['min_selector']).fetchone()[0]
+    feels = cursor.execute(QUERIES['random_feel_ids'], [min_selector + 1]).fetchall()
+    feel_id = feels[random.randrange(len(feels))]['feel_id']
+    with table._session.transaction():
+        table._update_selector(feel_id)
+        return cursor.execute(QUERIES['select_row'], [feel_id]).fetchone()
+
+
+def time_picks(pick, picks):
+    with FeelsTable() as table:
+        start = time.perf_counter()
+        for _ in range(picks):
+            pick(table)
+        return (time.perf_counter() - start) / picks
+
+
+def run(count, picks):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.db')
+    build_database(path, count)
+
+    with FeelsTable() as table:
+        start = time.perf_counter()
+        table._load_index()
+        load = time.perf_counter() - start
+
+    indexed = time_picks(lambda table: table.select_random_feel(), picks)
+    # The legacy path is slow enough at large sizes that only a sample of picks is timed.
+    legacy = time_picks(legacy_pick, max(1, picks // 100))
+    Database._pool.close_all()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return load, indexed, legacy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('counts', nargs='*', type=int, default=[1000, 100000, 1000000])
+    parser.add_argument('--picks', type=int, default=1000)
+    args = parser.parse_args()
+
+    print('{:>10} {:>14} {:>16} {:>16}'.format('feels', 'index load ms', 'indexed us/pick', 'legacy us/pick'))
+    for count in args.counts:
+        load, indexed, legacy = run(count, args.picks)
+        print('{:>10} {:>14.1f} {:>16.1f} {:>16.1f}'.format(count, load * 1e3, indexed * 1e6, legacy * 1e6))
+
+
+if __name__ == '__main__':
+    main()
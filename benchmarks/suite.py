@@ -0,0 +1,308 @@
+"""
+Micro-benchmarks of the database, queue and parser hot paths, on generated datasets of a given number of feels and
+recipients. Results can be saved as json and compared with a previous run, to catch regressions between versions.
+
+Kik is replaced by a fake client that accepts every message, so nothing is sent over the network.
+
+Usage: python benchmarks/suite.py [--feels N ...] [--recipients N ...] [--repeat N] [--output FILE] [--compare FILE]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from kik.messages import TextMessage  # noqa: E402
+
+from feelsbot import parser as parser_module  # noqa: E402
+from feelsbot.database import (Database, FeelsTable, SeenMessagesTable, SubscribersTable, UserStatusTable,  # noqa: E402
+                               request_session)
+from feelsbot.message_queue import MessageQueue  # noqa: E402
+from feelsbot.parser import MessageParser  # noqa: E402
+
+
+ADMIN = 'bench-admin'
+RECIPIENT = 'bench-recipient'
+
+# Feels approved or blocked by each call of the bulk moderation cases (a page of the admin review).
+BULK_SIZE = 10
+
+# Slower than this ratio of the previous median is reported as a regression by --compare.
+REGRESSION_RATIO = 1.2
+
+
+class FakeKik:
+    """
+    Stand in for KikApi, accepting every batch.
+    """
+
+    def __init__(self):
+        self.messages = 0
+
+    def send_messages(self, messages):
+        self.messages += len(messages)
+        return {}
+
+
+def reset():
+    # Every dataset gets a database of its own, so the process-wide caches must start afresh too.
+    if Database._pool is not None:
+        Database._pool.close_all()
+    Database._config = None
+    FeelsTable._index = None
+    FeelsTable._need_approval = None
+    UserStatusTable._cache = None
+    SeenMessagesTable._cache = None
+    SeenMessagesTable._purged_at = None
+
+
+def build_dataset(directory, feels, recipients):
+    """
+    Create a database of feels (mostly approved, some awaiting approval or blocked, with a spread of selectors like a
+    long running deployment) and subscribers.
+    :return: The configuration for the dataset.
+    """
+    reset()
+    config = {
+        'database': os.path.join(directory, 'bench-{}-{}.db'.format(feels, recipients)),
+        'admin': ADMIN,
+        'recipient': RECIPIENT,
+    }
+    Database.init_database(config)
+
+    connect = sqlite3.connect(config['database'])
+    rows = ((str(i), 'bench', 'feel {}'.format(i), 1 if i % 10 else random.choice((0, -1)), random.randint(40, 41))
+            for i in range(feels))
+    with connect:
+        connect.executemany('INSERT INTO feels(submitted, name, comment, approved, selector) VALUES (?, ?, ?, ?, ?)',
+                            rows)
+        connect.executemany('INSERT INTO subscribers(user_id, created) VALUES (?, ?)',
+                            [(RECIPIENT, 0)] + [('bench-user-{}'.format(i), 0) for i in range(recipients - 1)])
+    connect.close()
+    # feel_counts is kept by triggers, but rows inserted directly bypass the cached count of feels needing approval.
+    FeelsTable._need_approval = None
+    return config
+
+
+def new_feels(count, approved):
+    """
+    Add feels to act on, outside of the timed operations.
+    :return: List of the new feel ids.
+    """
+    with FeelsTable() as table:
+        table._cursor.executemany('INSERT INTO feels(submitted, name, comment, approved) VALUES (?, ?, ?, ?)',
+                                  [('now', 'bench', 'extra', approved)] * count)
+        table._connect.commit()
+        rows = table._cursor.execute('SELECT feel_id FROM feels ORDER BY feel_id DESC LIMIT ?', [count]).fetchall()
+    FeelsTable._need_approval = None
+    return [row['feel_id'] for row in reversed(rows)]
+
+
+def measure(repeat, operation, setup=None):
+    """
+    Time an operation repeatedly.
+    :param repeat: Number of times to run it.
+    :param operation: Function taking the value returned by setup (or nothing if there is no setup).
+    :param setup: Function called before each run, untimed.
+    :return: Dictionary of statistics, in microseconds per operation.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is None:
+            start = time.perf_counter()
+            operation()
+        else:
+            value = setup()
+            start = time.perf_counter()
+            operation(value)
+        times.append((time.perf_counter() - start) * 1e6)
+    times.sort()
+    return {
+        'n': repeat,
+        'mean_us': statistics.fmean(times),
+        'median_us': statistics.median(times),
+        'p95_us': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'min_us': times[0],
+    }
+
+
+def table_call(table_class, method, *args):
+    with table_class() as table:
+        return getattr(table, method)(*args)
+
+
+def feels_cases(repeat):
+    pending = iter(new_feels(2 * repeat, 0))
+    blocked = iter(new_feels(repeat, -1))
+    bulk = iter(new_feels(2 * BULK_SIZE * repeat, 0))
+    yield 'feels.select_random_feel', measure(repeat, lambda: table_call(FeelsTable, 'select_random_feel'))
+    yield 'feels.approve', measure(repeat, lambda feel_id: table_call(FeelsTable, 'approve', feel_id),
+                                   lambda: next(pending))
+    yield 'feels.block', measure(repeat, lambda feel_id: table_call(FeelsTable, 'block', feel_id),
+                                 lambda: next(pending))
+    yield 'feels.unblock', measure(repeat, lambda feel_id: table_call(FeelsTable, 'unblock', feel_id),
+                                   lambda: next(blocked))
+    for method in ('approve_many', 'block_many'):
+        yield 'feels.{}_{}'.format(method, BULK_SIZE), measure(
+            repeat, lambda feel_ids: table_call(FeelsTable, method, feel_ids),
+            lambda: [next(bulk) for _ in range(BULK_SIZE)])
+    for method in ('count_all', 'count_need_approval', 'count_blocked', 'counts'):
+        yield 'feels.' + method, measure(repeat, lambda: table_call(FeelsTable, method))
+
+
+def user_status_cases(repeat):
+    users = ['bench-status-{}'.format(i) for i in range(repeat)]
+    for user in users:
+        table_call(UserStatusTable, 'update', user, 0)
+    yield 'user_status.status_cached', measure(repeat, lambda: table_call(UserStatusTable, 'status', ADMIN))
+    uncached = iter(users)
+
+    def evict():
+        user = next(uncached)
+        UserStatusTable.invalidate(user)
+        return user
+    yield 'user_status.status_uncached', measure(repeat, lambda user: table_call(UserStatusTable, 'status', user),
+                                                 evict)
+    yield 'user_status.update', measure(repeat, lambda: table_call(UserStatusTable, 'update', ADMIN, 100, [1, 2]))
+
+
+def queue_cases(repeat, config, recipients):
+    queue = MessageQueue(config, FakeKik())
+    yield 'queue.add_message', measure(repeat, lambda: queue.add_message(RECIPIENT, 'benchmark message'))
+    queue.send_all()
+
+    users = [RECIPIENT] + ['bench-user-{}'.format(i) for i in range(recipients - 1)]
+
+    def fill():
+        for user in users:
+            queue.add_message(user, 'benchmark message')
+    yield 'queue.send_all', measure(repeat, lambda _: queue.send_all(), fill)
+
+    def broadcast():
+        pending = queue.pending()
+        pending.add_broadcast(['benchmark message'])
+        pending.send_all()
+    yield 'queue.broadcast', measure(max(1, repeat // 10), broadcast)
+
+
+# Parser state (and state data) needed for each button to take its normal path, rather than the error path.
+BUTTON_STATES = {
+    parser_module.BUTTONS['admin_approve']: parser_module.STATE_ADMIN_APPROVE_MESSAGE,
+    parser_module.BUTTONS['admin_block']: parser_module.STATE_ADMIN_APPROVE_MESSAGE,
+    parser_module.BUTTONS['admin_confirm_manual']: parser_module.STATE_ADMIN_MANUAL_CONFIRM,
+}
+
+
+def parser_cases(repeat, config):
+    message_parser = MessageParser(config, MessageQueue(config, FakeKik()))
+    pending = iter(new_feels(2 * repeat, 0))
+    buttons = [(ADMIN, body) for body in parser_module.MESSAGES_ADMIN] + \
+              [(RECIPIENT, body) for body in parser_module.MESSAGES_RECIPIENT] + \
+              [(ADMIN, None)]
+
+    for user, body in buttons:
+        def setup():
+            state = BUTTON_STATES.get(body, parser_module.STATE_DEFAULT)
+            data = None
+            if state == parser_module.STATE_ADMIN_APPROVE_MESSAGE:
+                data = next(pending)
+            elif state == parser_module.STATE_ADMIN_MANUAL_CONFIRM:
+                data = 'benchmark manual message'
+            elif body is None:
+                # A custom message typed by the admin, after choosing to send a manual message.
+                state = parser_module.STATE_ADMIN_MANUAL_MESSAGE
+            table_call(UserStatusTable, 'update', user, state, data)
+            if user == RECIPIENT:
+                # Subscribed again after any earlier 'Unsubscribe', so every run takes the handler's own path.
+                table_call(SubscribersTable, 'subscribe', RECIPIENT)
+            return TextMessage(from_user=user, chat_id='bench-chat', body=body or 'benchmark manual message')
+
+        def process(message):
+            queue = message_parser.queue.pending()
+            with request_session():
+                message_parser.process_text_message(message, queue)
+
+        name = body if body is not None else 'manual message text'
+        yield 'parser.{}.{}'.format('admin' if user == ADMIN else 'recipient', name), measure(repeat, process, setup)
+
+
+def run(feels, recipients, repeat, directory):
+    config = build_dataset(directory, feels, recipients)
+    dataset = {'feels': feels, 'recipients': recipients}
+    results = []
+    for cases in (feels_cases(repeat), user_status_cases(repeat), queue_cases(repeat, config, recipients),
+                  parser_cases(repeat, config)):
+        for case, stats in cases:
+            results.append(dict(case=case, dataset=dataset, **stats))
+            print('{:>8} {:>7}  {:<45} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                feels, recipients, case, stats['mean_us'], stats['median_us'], stats['p95_us']))
+    return results
+
+
+def compare(results, path):
+    with open(path) as previous_file:
+        previous = {(r['case'], r['dataset']['feels'], r['dataset']['recipients']): r
+                    for r in json.load(previous_file)['results']}
+    print('\nCompared with {} (median):'.format(path))
+    regressions = 0
+    for result in results:
+        before = previous.get((result['case'], result['dataset']['feels'], result['dataset']['recipients']))
+        if before is None:
+            continue
+        ratio = result['median_us'] / before['median_us'] if before['median_us'] > 0 else 1.0
+        flag = 'REGRESSION' if ratio > REGRESSION_RATIO else ''
+        regressions += bool(flag)
+        print('{:>8} {:>7}  {:<45} {:>7.2f}x {}'.format(result['dataset']['feels'], result['dataset']['recipients'],
+                                                        result['case'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--feels', nargs='+', type=int, default=[1000, 100000])
+    parser.add_argument('--recipients', nargs='+', type=int, default=[1, 1000])
+    parser.add_argument('--repeat', type=int, default=200, help="Runs of each operation.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Save the results to this json file.")
+    parser.add_argument('--compare', help="Compare with the results saved by a previous run.")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    directory = tempfile.mkdtemp()
+    print('{:>8} {:>7}  {:<45} {:>10} {:>10} {:>10}'.format('feels', 'recips', 'case', 'mean us', 'median us',
+                                                             'p95 us'))
+    results = []
+    try:
+        for feels in args.feels:
+            for recipients in args.recipients:
+                results += run(feels, max(1, recipients), args.repeat, directory)
+    finally:
+        reset()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'python': platform.python_version(),
+                    'sqlite': sqlite3.sqlite_version,
+                    'repeat': args.repeat,
+                    'seed': args.seed,
+                },
+                'results': results,
+            }, output, indent=1)
+    if args.compare:
+        sys.exit(1 if compare(results, args.compare) else 0)
+
+
+if __name__ == '__main__':
+    main()
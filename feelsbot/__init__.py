@@ -1 +1,26 @@
-from .server import init_app
+# Imported first, so that the startup timings include importing everything else.
+from . import startup  # noqa: F401
+
+
+def init_app(path):
+    """
+    Create the WSGI (Flask) application, see server.init_app(). The server (with Flask and the Kik client) is only
+    imported when this is called, so tools that do not serve requests (the importer, load test and benchmarks) do not
+    pay for importing it.
+    """
+    # Only the server's own import is timed, not the time since the package was imported.
+    startup.restart()
+    from .server import init_app as init
+
+    return init(path)
+
+
+def init_asgi_app(path):
+    """
+    Create the ASGI application, see asgi.init_asgi_app(). The ASGI app (and asyncio) is only imported when this is
+    called, so the WSGI app does not pay for importing it.
+    """
+    startup.restart()
+    from .asgi import init_asgi_app as init
+
+    return init(path)
@@ -0,0 +1,250 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from werkzeug.exceptions import ClientDisconnected, HTTPException
+from werkzeug.wrappers import Request
+
+from . import metrics, server
+from .kik_api import AsyncKikApi
+
+
+# Defaults used for the ASGI options not present in the configuration file.
+ASGI_DEFAULTS = {
+    # Number of threads doing database work (parsing messages, updating tables) for requests in progress.
+    'asgi_database_workers': 4,
+    # Maximum number of calls to Kik open at the same time.
+    'asgi_kik_connections': 50,
+}
+
+# Content type of responses, unless the route gives another (Flask's default).
+HTML = 'text/html; charset=utf-8'
+
+
+def init_asgi_app(path):
+    """
+    Load the configuration and create the ASGI application, as an alternative to init_app() for ASGI servers such as
+    uvicorn or hypercorn. Serves the same endpoints with the same handling, on a single event loop.
+    :param path: Location of the json configuration file for the application to be run.
+    :return: The ASGI application.
+    """
+    server.init_app(path)
+    return AsgiApp(server.config)
+
+
+class AsgiApp:
+    """
+    ASGI application serving the webhook endpoints of server.py.
+
+    Each request's database work (the same functions used by the Flask app) runs on a dedicated pool of threads, so
+    the event loop itself never waits on SQLite. Replies are then sent with a non-blocking Kik client, so requests
+    waiting on Kik do not hold a thread at all and a single process can have many webhooks in progress at once.
+    """
+
+    # The handler method for each route, and the content type of its responses (as sent by the Flask app).
+    ROUTES = {
+        ('GET', '/'): ('status_page', HTML),
+        ('GET', '/metrics'): ('metrics_page', 'text/plain; version=0.0.4'),
+        ('POST', '/incoming'): ('incoming', HTML),
+        ('POST', '/message'): ('zapier_trigger', HTML),
+        ('POST', '/new-feel'): ('zapier_new_feel', HTML),
+        ('POST', '/import-feels'): ('import_feels', 'application/json'),
+    }
+    # Handlers given the request body as a stream read as they go, rather than read in full before they are called.
+    STREAMED = {'import_feels'}
+
+    def __init__(self, config):
+        options = dict(ASGI_DEFAULTS)
+        options.update((key, config[key]) for key in ASGI_DEFAULTS if key in config)
+        self.executor = ThreadPoolExecutor(max_workers=int(options['asgi_database_workers']),
+                                           thread_name_prefix='feelsbot-database')
+        self.kik = AsyncKikApi(server.kik, pool_size=int(options['asgi_kik_connections']))
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                if server.scheduler.enabled:
+                    server.scheduler.ensure_started()
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        """
+        Stop the scheduler, close the Kik connections and wait for any database work still in progress.
+        :return: Nothing.
+        """
+        await self.kik.close()
+        if server.scheduler.enabled:
+            await self.run_blocking(server.scheduler.stop, server.scheduler.poll_interval)
+        await self.run_blocking(server.queue.flush, float(server.queue.options['message_queue_shutdown_timeout']))
+        self.executor.shutdown(wait=True)
+
+    async def run_blocking(self, func, *args):
+        """
+        Run a function on the database threads, off the event loop.
+        :param func: The function to call.
+        :param args: Arguments for the function.
+        :return: The function's return value.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    async def _http(self, scope, receive, send):
+        started = time.perf_counter()
+        handler, content_type = self.ROUTES.get((scope['method'], scope['path']), (None, HTML))
+        if handler in self.STREAMED:
+            stream = io.BufferedReader(_ReceiveStream(receive, asyncio.get_running_loop()))
+        else:
+            chunks = []
+            while True:
+                event = await receive()
+                if event['type'] == 'http.disconnect':
+                    return
+                chunks.append(event.get('body', b''))
+                if not event.get('more_body', False):
+                    break
+            stream = io.BytesIO(b''.join(chunks))
+
+        if handler is None:
+            known = any(path == scope['path'] for _, path in self.ROUTES)
+            status, response = (405, "Method not allowed.") if known else (404, "Not found.")
+        else:
+            try:
+                status, response = await getattr(self, handler)(_request(scope, stream))
+            except HTTPException as e:
+                # E.g. a body that is not valid json, rejected just as it would be by Flask.
+                status, response = e.code, e.description
+            except Exception as e:
+                print("Unexpected error handling {} {}: {}".format(scope['method'], scope['path'], e))
+                status, response = 500, "Internal server error."
+
+        content = (response or '').encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', content_type.encode('latin-1')),
+                        (b'content-length', str(len(content)).encode('latin-1'))],
+        })
+        await send({'type': 'http.response.body', 'body': content})
+
+        if metrics.enabled():
+            server.record_request(scope['path'] if handler is not None else 'unmatched', status,
+                                  time.perf_counter() - started)
+            await self.run_blocking(metrics.maybe_flush)
+
+    async def _send(self, pending):
+        # Reading each chunk of a broadcast is database work, so the chunks are taken on the database threads.
+        result = 200
+        chunks = pending.chunks()
+        while True:
+            queue = await self.run_blocking(next, chunks, None)
+            if queue is None:
+                return result
+            if await server.queue.send_pending_async(queue, self.kik, self.run_blocking) != 200:
+                result = 202
+
+    async def status_page(self, req):
+        return 200, await self.run_blocking(server.status_page)
+
+    async def metrics_page(self, req):
+        return await self.run_blocking(server.metrics_page, req)
+
+    async def incoming(self, req):
+        result, response, pending = await self.run_blocking(server.receive_incoming, req)
+        if pending is None:
+            return result, response
+        queue_result = await self._send(pending)
+        if result != 200 and queue_result != 200:
+            # Error reporting notifies the admin through the blocking client.
+            return await self.run_blocking(server.finish_incoming, result, queue_result), None
+        return server.finish_incoming(result, queue_result), None
+
+    async def zapier_trigger(self, req):
+        result, response, pending = await self.run_blocking(server.receive_trigger, req)
+        if pending is None:
+            return result, response
+        return await self._send(pending), None
+
+    async def zapier_new_feel(self, req):
+        return await self.run_blocking(server.receive_new_feel, req)
+
+    async def import_feels(self, req):
+        return await self.run_blocking(server.receive_import, req, req.stream)
+
+
+class _ReceiveStream(io.RawIOBase):
+    """
+    Request body read from the ASGI receive channel as it is consumed, by a handler running on a database thread (see
+    AsgiApp.run_blocking()). Each read waits for the event loop to receive the next chunk, so only one chunk of the
+    body is held at a time, however large the upload.
+    """
+
+    def __init__(self, receive, loop):
+        """
+        :param receive: The ASGI receive callable of the request.
+        :param loop: The event loop serving the request.
+        """
+        self._receive = receive
+        self._loop = loop
+        self._chunk = b''
+        self._offset = 0
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._chunk):
+            if not self._more:
+                return 0
+            event = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if event['type'] == 'http.disconnect':
+                self._more = False
+                raise ClientDisconnected()
+            self._chunk = event.get('body', b'')
+            self._offset = 0
+            self._more = event.get('more_body', False)
+        size = min(len(buffer), len(self._chunk) - self._offset)
+        buffer[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        return size
+
+
+def _request(scope, stream):
+    """
+    Wrap an ASGI request as a werkzeug request, as used by the Flask handlers, for the shared handling in server.py.
+    :param scope: The ASGI connection scope.
+    :param stream: Binary stream of the request body, which ends with the body.
+    :return: The werkzeug Request.
+    """
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # The stream ends with the body, so werkzeug reads it as it is, whether or not there is a content length.
+        'wsgi.input_terminated': True,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return Request(environ)
@@ -1,3 +1,11 @@
 from .database import Database
+from .session import Session, request_session
 from .feels import FeelsTable
 from .user_status import UserStatusTable
+from .outbox import OutboxTable
+from .rate_limit import RateLimitTable
+from .subscribers import SubscribersTable
+from .seen_messages import SeenMessagesTable
+from .metrics import MetricsTable
+from .schedules import SchedulesTable
+from .leases import LeasesTable
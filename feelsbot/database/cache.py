@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Small thread-safe mapping that evicts the least recently used entry once capacity is reached.
+    A capacity of 0 disables the cache entirely (nothing is stored).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedCount:
+    """
+    A single cached number, such as a row count, loaded on first use and kept current in place by the code that
+    changes it. Reloaded once older than max_age seconds (None never expires), to pick up changes by other processes.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._value = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self, load):
+        """
+        :param load: Function taking no arguments that returns the current value, called if nothing usable is cached.
+        :return: The cached value.
+        """
+        with self._lock:
+            expired = self.max_age is not None and self._loaded_at is not None and \
+                time.monotonic() - self._loaded_at >= self.max_age
+            if self._value is None or expired:
+                self._value = load()
+                self._loaded_at = time.monotonic()
+            return self._value
+
+    def adjust(self, delta):
+        """
+        Apply a known change to the cached value (ignored if nothing is cached).
+        :param delta: The amount to add.
+        :return: Nothing.
+        """
+        with self._lock:
+            if self._value is not None:
+                self._value += delta
+
+    def invalidate(self):
+        """
+        Drop the cached value, so the next get() loads it again.
+        :return: Nothing.
+        """
+        with self._lock:
+            self._value = None
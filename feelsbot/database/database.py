@@ -1,4 +1,109 @@
+import os
+import queue
 import sqlite3
+import threading
+
+from . import schema
+
+
+# Defaults used for any connection options not present in the configuration file.
+CONNECTION_DEFAULTS = {
+    'database_pool_size': 4,
+    'database_journal_mode': 'WAL',
+    'database_synchronous': 'NORMAL',
+    'database_mmap_size': 64 * 1024 * 1024,
+    'database_cached_statements': 128,
+    'database_timeout': 5.0,
+}
+
+
+class ConnectionPool:
+    """
+    Pool of long-lived connections to a single database file.
+
+    Connections are configured once (journal mode, synchronous level, memory map size and the statement cache) when
+    they are created, then handed out and returned for reuse rather than being closed at the end of every table
+    context. Up to pool_size idle connections are kept; any connections beyond that are closed on release.
+    """
+
+    def __init__(self, database, options):
+        self.database = database
+        self.options = options
+        self.pool_size = int(options['database_pool_size'])
+        self._idle = queue.LifoQueue()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        connect = sqlite3.connect(self.database,
+                                  timeout=float(self.options['database_timeout']),
+                                  cached_statements=int(self.options['database_cached_statements']),
+                                  check_same_thread=False)
+        connect.row_factory = sqlite3.Row
+        connect.execute('PRAGMA journal_mode = {}'.format(self.options['database_journal_mode']))
+        connect.execute('PRAGMA synchronous = {}'.format(self.options['database_synchronous']))
+        connect.execute('PRAGMA mmap_size = {}'.format(int(self.options['database_mmap_size'])))
+        return connect
+
+    def _check_process(self):
+        # Connections must not be shared with a forked child (e.g. when the WSGI server forks after import), so any
+        # connections inherited from the parent process are abandoned rather than reused.
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        """
+        Obtain a connection from the pool, creating a new one if there are none idle.
+        :return: An open sqlite3 connection.
+        """
+        self._check_process()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, connect):
+        """
+        Return a connection to the pool. Any transaction left open on the connection is rolled back first.
+        :param connect: The connection previously returned by acquire().
+        :return: Nothing.
+        """
+        if connect.in_transaction:
+            connect.rollback()
+        if os.getpid() == self._pid and self._idle.qsize() < self.pool_size:
+            self._idle.put_nowait(connect)
+        else:
+            connect.close()
+
+    def warm_up(self, count, statements):
+        """
+        Open connections ahead of the first requests and prepare statements on each, so that requests do not wait on
+        connecting, reading the schema or compiling their queries. Only read statements can be prepared: each is run
+        with zero for every parameter, stepping to its first row at most, which leaves it in the statement cache.
+        :param count: Number of connections to have ready (at most the pool size).
+        :param statements: SQL of the SELECT statements to prepare.
+        :return: Nothing.
+        """
+        connections = [self.acquire() for _ in range(max(0, min(int(count), self.pool_size)))]
+        try:
+            for connect in connections:
+                for sql in statements:
+                    connect.execute(sql, [0] * sql.count('?')).close()
+        finally:
+            for connect in connections:
+                self.release(connect)
+
+    def close_all(self):
+        """
+        Close every idle connection in the pool.
+        :return: Nothing.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 class Database:
@@ -8,17 +113,67 @@ class Database:
 
     _config = None
     _database = None
+    _pool = None
+    _lock = threading.Lock()
 
     @staticmethod
     def init_database(config):
+        with Database._lock:
+            if Database._config is None:
+                Database._config = config
+                Database._database = config['database']
+                options = {key: config.get(key, value) for key, value in CONNECTION_DEFAULTS.items()}
+                Database._pool = ConnectionPool(Database._database, options)
+
+                connect = Database._pool.acquire()
+                try:
+                    schema.migrate(connect)
+                finally:
+                    Database._pool.release(connect)
+
+    @staticmethod
+    def option(key, default=None):
+        """
+        Look up an optional setting from the configuration file.
+        :param key: The configuration key.
+        :param default: Value to use if the key is not set (or the database has not been configured).
+        :return: The configured value or the default.
+        """
         if Database._config is None:
-            Database._config = config
-            Database._database = config['database']
+            return default
+        return Database._config.get(key, default)
+
+    @staticmethod
+    def warm_up(count=None):
+        """
+        Have the pool's connections opened, with the read queries of every table prepared, see ConnectionPool.warm_up().
+        :param count: Number of connections; defaults to the pool size.
+        :return: Nothing.
+        """
+        # Imported here, as the table classes themselves depend on this module.
+        from .table import select_statements
+
+        if Database._config is None:
+            return
+        pool = Database._pool
+        pool.warm_up(pool.pool_size if count is None else count, select_statements())
 
     @staticmethod
     def open():
+        """
+        Obtain a connection from the pool. Must be handed back with Database.close() rather than closed directly.
+        :return: An open connection, or None if the database has not been configured.
+        """
         if Database._config is None:
             return None
-        connect = sqlite3.connect(Database._database)
-        connect.row_factory = sqlite3.Row
-        return connect
\ No newline at end of file
+        return Database._pool.acquire()
+
+    @staticmethod
+    def close(connect):
+        """
+        Hand a connection obtained from Database.open() back to the pool.
+        :param connect: The connection to release.
+        :return: Nothing.
+        """
+        if connect is not None:
+            Database._pool.release(connect)
@@ -1,11 +1,28 @@
-import random
+import json
 
+from .. import metrics
+from .cache import CachedCount
 from .database import Database
+from .selector import SelectionIndex
+from .table import Table
 
 
 QUERIES = {
     'select_row': 'SELECT * FROM feels WHERE feel_id = ?',
-    'select_not_approved': 'SELECT * FROM feels WHERE approved = 0',
+    # The partial index of pending feels is named, as the planner may otherwise prefer the (approved, selector) index
+    # and sort every pending feel to find the first few.
+    'select_not_approved': 'SELECT * FROM feels INDEXED BY feels_pending WHERE approved = 0 ORDER BY feel_id LIMIT 1',
+    'select_not_approved_page': 'SELECT * FROM feels INDEXED BY feels_pending WHERE approved = 0 AND feel_id > ? '
+                                'ORDER BY feel_id LIMIT ?',
+    # Statements on several feels at once take their ids as a json array. Comparing +approved keeps the lookup on the
+    # primary key.
+    'select_many': 'SELECT feel_id, approved, selector FROM feels WHERE feel_id IN (SELECT value FROM json_each(?))',
+    'count_not_approved_many': 'SELECT count(*) FROM feels '
+                               'WHERE feel_id IN (SELECT value FROM json_each(?)) AND +approved = 0',
+    'update_approved_many': 'UPDATE feels SET approved = 1, selector = coalesce(?, selector) '
+                            'WHERE feel_id IN (SELECT value FROM json_each(?)) AND +approved = 0',
+    'update_blocked_many': 'UPDATE feels SET approved = -1 '
+                           'WHERE feel_id IN (SELECT value FROM json_each(?)) AND +approved != -1',
     'insert_feel': 'INSERT INTO feels(submitted, name, comment) VALUES (?, ?, ?)',
     'update_approved': 'UPDATE feels SET approved = 1 WHERE feel_id = ?',
     'update_not_approved': 'UPDATE feels SET approved = 0 WHERE feel_id = ?',
@@ -13,27 +30,126 @@ QUERIES = {
     'update_selector': 'UPDATE feels SET selector = ? WHERE feel_id = ?',
     'update_feel_count': 'UPDATE feels SET selector = (SELECT selector FROM feels WHERE feel_id = ?) + 1, '
                          'sent_count = (SELECT sent_count FROM feels WHERE feel_id = ?) + 1 WHERE feel_id = ?',
+    'update_feel_count_if': 'UPDATE feels SET selector = selector + 1, sent_count = sent_count + 1 '
+                            'WHERE feel_id = ? AND approved = 1 AND selector = ?',
+    'select_index': 'SELECT feel_id, selector FROM feels WHERE approved = 1',
     'min_selector': 'SELECT min(selector) FROM feels WHERE approved = 1',
     'random_feel_ids': 'SELECT feel_id FROM feels WHERE approved = 1 AND selector <= ?',
-    'count_all': 'SELECT count(feel_id) FROM feels',
-    'count_approved': 'SELECT count(feel_id) FROM feels WHERE approved = 1',
-    'count_not_approved': 'SELECT count(feel_id) FROM feels WHERE approved = 0',
-    'count_blocked': 'SELECT count(feel_id) FROM feels WHERE approved = -1',
+    'count_all': 'SELECT coalesce(sum(total), 0) FROM feel_counts',
+    'count_approved': 'SELECT coalesce(sum(total), 0) FROM feel_counts WHERE approved = 1',
+    'count_not_approved': 'SELECT coalesce(sum(total), 0) FROM feel_counts WHERE approved = 0',
+    'count_blocked': 'SELECT coalesce(sum(total), 0) FROM feel_counts WHERE approved = -1',
+    'counts': 'SELECT approved, total FROM feel_counts',
 }
 
+# Seconds before the selection index is reloaded from the table, unless overridden by 'feels_index_max_age' in the
+# config. Only matters when other processes also approve or block feels.
+INDEX_MAX_AGE_DEFAULT = 600
 
-class FeelsTable:
+# Number of stale picks tolerated (each one corrects the index entry involved) before reloading the whole index.
+STALE_PICK_LIMIT = 3
+
+
+class FeelsTable(Table):
     """
     Class for manipulation of the 'feels' table in the database.
     """
 
-    def __enter__(self):
-        self._connect = Database.open()
-        self._cursor = self._connect.cursor()
-        return self
+    _index = None
+    _need_approval = None
+
+    @staticmethod
+    def index():
+        """
+        The selection index for this process (see SelectionIndex), created on first use.
+        :return: The SelectionIndex shared by every FeelsTable.
+        """
+        if FeelsTable._index is None:
+            FeelsTable._index = SelectionIndex(Database.option('feels_index_max_age', INDEX_MAX_AGE_DEFAULT))
+        return FeelsTable._index
+
+    @staticmethod
+    def need_approval_counter():
+        """
+        The cached number of feels awaiting approval for this process, created on first use. It is adjusted as feels
+        are added, approved and blocked, and reloaded on the same schedule as the selection index.
+        :return: The CachedCount shared by every FeelsTable.
+        """
+        if FeelsTable._need_approval is None:
+            FeelsTable._need_approval = CachedCount(Database.option('feels_index_max_age', INDEX_MAX_AGE_DEFAULT))
+        return FeelsTable._need_approval
+
+    @staticmethod
+    def cached_need_approval():
+        """
+        Count the feels awaiting approval, as count_need_approval(), but from memory when possible. Used where only an
+        approximate answer is needed, e.g. to decide whether to offer "Approve new feels".
+        :return: The number of feels awaiting approval.
+        """
+        counter = FeelsTable.need_approval_counter()
+
+        def load():
+            with FeelsTable() as table:
+                if not table._session.autocommit:
+                    # The count includes this request's own changes, which may yet be rolled back.
+                    table._session.on_rollback(counter.invalidate)
+                return table.count_need_approval()
+        return counter.get(load)
+
+    def preload(self):
+        """
+        Load the selection index and the count of feels awaiting approval now, rather than on first use (e.g. while
+        warming up a new process).
+        :return: Nothing.
+        """
+        self._load_index()
+        self.need_approval_counter().get(self.count_need_approval)
+
+    def _adjust_need_approval(self, delta):
+        counter = self.need_approval_counter()
+        counter.adjust(delta)
+        if not self._session.autocommit:
+            self._session.on_rollback(counter.invalidate)
+
+    def _load_index(self):
+        index = self.index()
+        index.load(tuple(row) for row in self._cursor.execute(QUERIES['select_index']))
+        return index
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._connect.close()
+    def _sync_index(self, feel_id):
+        """
+        Bring the selection index into line with the stored row, after it has been changed.
+        :param feel_id: The id of the row that was changed.
+        :return: Nothing.
+        """
+        index = self.index()
+        if not index.loaded:
+            # Will be read in full the next time a feel is selected.
+            return
+        row = self._select_row(feel_id)
+        if row is not None and row['approved'] == 1:
+            index.set(feel_id, row['selector'])
+        else:
+            index.discard(feel_id)
+        if not self._session.autocommit:
+            self._session.on_rollback(index.invalidate)
+
+    def _sync_index_many(self, feel_ids):
+        """
+        As _sync_index(), for several rows at once.
+        :param feel_ids: The ids of the rows that were changed.
+        :return: Nothing.
+        """
+        index = self.index()
+        if not index.loaded:
+            return
+        for row in self._cursor.execute(QUERIES['select_many'], [json.dumps(feel_ids)]).fetchall():
+            if row['approved'] == 1:
+                index.set(row['feel_id'], row['selector'])
+            else:
+                index.discard(row['feel_id'])
+        if not self._session.autocommit:
+            self._session.on_rollback(index.invalidate)
 
     def _select_row(self, feel_id):
         row = self._cursor.execute(QUERIES['select_row'], [feel_id]).fetchone()
@@ -58,12 +174,13 @@ class FeelsTable:
             self._cursor.execute(QUERIES['update_selector'], (selector, feel_id))
 
     def _is_not_approved(self, feel_id):
+        # False for an unknown id, e.g. a stale one saved in the admin's state.
         row = self._select_row(feel_id)
-        return row['approved'] == 0
+        return row is not None and row['approved'] == 0
 
     def _is_blocked(self, feel_id):
         row = self._select_row(feel_id)
-        return row['approved'] == -1
+        return row is not None and row['approved'] == -1
 
     def insert_feel(self, submitted, name, comment):
         """
@@ -73,8 +190,9 @@ class FeelsTable:
         :param comment: The feel comment to add.
         :return:
         """
-        with self._connect:
+        with self._session.transaction():
             self._cursor.execute(QUERIES['insert_feel'], (submitted, name, comment))
+        self._adjust_need_approval(1)
 
     def insert_feels(self, feels):
         """
@@ -82,8 +200,9 @@ class FeelsTable:
         :param feels: A list containing tuples with multiple sets of values for submitted, name and comment.
         :return:
         """
-        with self._connect:
+        with self._session.transaction():
             self._cursor.executemany(QUERIES['insert_feel'], feels)
+        self._adjust_need_approval(len(feels))
 
     def count_all(self):
         """
@@ -106,6 +225,15 @@ class FeelsTable:
         """
         return self._cursor.execute(QUERIES['count_blocked']).fetchone()[0]
 
+    def counts(self):
+        """
+        Obtain all of the feel totals used in status reports at once.
+        The totals are maintained by triggers on the table (see schema), so this does not depend on the number of feels.
+        :return: Tuple of the total number of feels, the number awaiting approval and the number blocked.
+        """
+        totals = {row['approved']: row['total'] for row in self._cursor.execute(QUERIES['counts'])}
+        return sum(totals.values()), totals.get(0, 0), totals.get(-1, 0)
+
     def select_random_feel(self):
         """
         Select a random feel from those eligible.
@@ -118,18 +246,60 @@ class FeelsTable:
         "clumping" where the same message is selected multiple times in a relatively small number of selections. Hence
         this approach was developed to smooth out the distribution and appears to be working.
 
-        :return: An object containing the fields of the selected row in the table.
-        """
-        min_selector = self._min_selector()
+        The eligible feels are found through the selection index rather than by querying the table. The update only
+        applies if the row still has the selector the index expected, so a pick made stale by another process is
+        detected, corrected in the index and retried.
 
-        feels = self._cursor.execute(QUERIES['random_feel_ids'], [min_selector + 1]).fetchall()
-        rand = random.randrange(len(feels))
-        feel_id = feels[rand]['feel_id']
+        :return: An object containing the fields of the selected row in the table, or None if there are no approved
+        feels (or no pick could be made to match the table).
+        """
+        feels = self.select_random_feels(1)
+        return feels[0] if feels else None
 
-        with self._connect:
-            self._update_selector(feel_id)
-            row = self._cursor.execute(QUERIES['select_row'], [feel_id]).fetchone()
-            return row
+    def select_random_feels(self, count):
+        """
+        Select several distinct random feels at once, with the same fairness rule as select_random_feel(): the result
+        matches what that many calls to select_random_feel() could have produced (without repeats). All of the
+        selector and sent count updates are made together in a single statement and transaction.
+        :param count: The number of feels to select.
+        :return: A list of objects containing the fields of the selected rows. Fewer than count rows are returned if
+        there are not enough approved feels.
+        """
+        with metrics.timer('feelsbot_select_random_feels_seconds'):
+            return self._select_random_feels(count)
+
+    def _select_random_feels(self, count):
+        index = self.index()
+        if not index.loaded:
+            self._load_index()
+
+        selected = []
+        for attempt in range(2 * STALE_PICK_LIMIT):
+            picks = index.pick_many(count - len(selected), exclude=[row['feel_id'] for row in selected])
+            if len(picks) == 0:
+                break
+
+            with self._session.transaction():
+                updated = self._cursor.executemany(QUERIES['update_feel_count_if'], picks).rowcount
+                if not self._session.autocommit:
+                    self._session.on_rollback(index.invalidate)
+                rows = [self._select_row(feel_id) for feel_id, _ in picks]
+
+            if updated == len(picks):
+                selected += rows
+                break
+
+            # Some picks were stale: keep those that were updated and correct the index for the rest.
+            for (feel_id, selector), row in zip(picks, rows):
+                if row is not None and row['approved'] == 1 and row['selector'] == selector + 1:
+                    selected.append(row)
+                else:
+                    self._sync_index(feel_id)
+            if len(selected) >= count:
+                break
+            if attempt + 1 == STALE_PICK_LIMIT:
+                self._load_index()
+        return selected
 
     def select_unapproved(self):
         """
@@ -139,6 +309,16 @@ class FeelsTable:
         feel = self._cursor.execute(QUERIES['select_not_approved']).fetchone()
         return feel
 
+    def select_unapproved_page(self, after=0, limit=10):
+        """
+        Select a page of the feels awaiting approval, oldest first. Pages are read from the index of pending feels
+        starting after the last id of the previous page, so reading a page does not depend on how many come before it.
+        :param after: The last feel id of the previous page, or 0 for the first page.
+        :param limit: The maximum number of feels on the page.
+        :return: A list of objects containing the fields of the selected rows.
+        """
+        return self._cursor.execute(QUERIES['select_not_approved_page'], (after, limit)).fetchall()
+
     def approve(self, feel_id):
         """
         Set a feel to approved status (if it is awaiting approval, see unblock_feel() for approving a blocked message).
@@ -150,11 +330,13 @@ class FeelsTable:
             # TODO maybe exception here?
             return
 
-        with self._connect:
+        with self._session.transaction():
             min_selector = self._min_selector()
             self._update_approved(feel_id)
-            if min_selector > 0:
+            if min_selector is not None and min_selector > 0:
                 self._update_selector(feel_id, min_selector)
+            self._sync_index(feel_id)
+        self._adjust_need_approval(-1)
 
     def block(self, feel_id):
         """
@@ -162,8 +344,12 @@ class FeelsTable:
         :param feel_id: The id of the row to block.
         :return:
         """
-        with self._connect:
+        with self._session.transaction():
+            pending = self._is_not_approved(feel_id)
             self._update_blocked(feel_id)
+            self._sync_index(feel_id)
+        if pending:
+            self._adjust_need_approval(-1)
 
     def unblock(self, feel_id):
         """
@@ -177,9 +363,48 @@ class FeelsTable:
             # TODO maybe exception here instead?
             return
 
-        with self._connect:
+        with self._session.transaction():
             min_selector = self._min_selector()
             row = self._select_row(feel_id)
             self._update_approved(feel_id)
-            if min_selector > row['selector']:
+            if min_selector is not None and min_selector > row['selector']:
                 self._update_selector(feel_id, min_selector)
+            self._sync_index(feel_id)
+
+    def approve_many(self, feel_ids):
+        """
+        Approve several feels awaiting approval at once, as approve() but in a single statement, with the minimum
+        selector looked up once for all of them. Feels that are not awaiting approval are left as they are.
+        :param feel_ids: The ids of the rows to approve.
+        :return: The number of feels approved.
+        """
+        feel_ids = [int(feel_id) for feel_id in feel_ids]
+        if len(feel_ids) == 0:
+            return 0
+
+        with self._session.transaction():
+            min_selector = self._min_selector()
+            selector = min_selector if min_selector is not None and min_selector > 0 else None
+            approved = self._cursor.execute(QUERIES['update_approved_many'],
+                                            (selector, json.dumps(feel_ids))).rowcount
+            self._sync_index_many(feel_ids)
+        self._adjust_need_approval(-approved)
+        return approved
+
+    def block_many(self, feel_ids):
+        """
+        Block several feels at once, as block() but in a single statement.
+        :param feel_ids: The ids of the rows to block.
+        :return: The number of feels blocked (not counting any that already were).
+        """
+        feel_ids = [int(feel_id) for feel_id in feel_ids]
+        if len(feel_ids) == 0:
+            return 0
+
+        ids = json.dumps(feel_ids)
+        with self._session.transaction():
+            pending = self._cursor.execute(QUERIES['count_not_approved_many'], [ids]).fetchone()[0]
+            blocked = self._cursor.execute(QUERIES['update_blocked_many'], [ids]).rowcount
+            self._sync_index_many(feel_ids)
+        self._adjust_need_approval(-pending)
+        return blocked
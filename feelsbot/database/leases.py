@@ -0,0 +1,39 @@
+from .table import Table
+
+
+QUERIES = {
+    'acquire': 'INSERT INTO leases(name, holder, expires) VALUES (?, ?, ?) '
+               'ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires '
+               'WHERE leases.holder = excluded.holder OR leases.expires < ?',
+    'release': 'DELETE FROM leases WHERE name = ? AND holder = ?',
+}
+
+
+class LeasesTable(Table):
+    """
+    Class for manipulation of the 'leases' table in the database, which records which process holds a role that only
+    one process may hold at once, such as leading the scheduler. A lease lapses unless renewed before it expires, so
+    the role passes to another process if its holder dies.
+    """
+
+    def acquire(self, name, holder, duration, now):
+        """
+        Take or renew a lease.
+        :param name: The role the lease is for.
+        :param holder: Unique identifier of the process (or object) asking for it.
+        :param duration: Seconds until the lease expires unless renewed.
+        :param now: The current time.
+        :return: True if the holder now has the lease, False if another holder has it.
+        """
+        with self._session.transaction():
+            return self._cursor.execute(QUERIES['acquire'], (name, holder, now + duration, now)).rowcount == 1
+
+    def release(self, name, holder):
+        """
+        Give up a lease, so another process can take it without waiting for it to expire.
+        :param name: The role the lease is for.
+        :param holder: The identifier it was acquired with.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['release'], (name, holder))
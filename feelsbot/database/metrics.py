@@ -0,0 +1,32 @@
+from .table import Table
+
+
+QUERIES = {
+    'add_value': 'INSERT INTO metrics(name, labels, series, value) VALUES (?, ?, ?, ?) '
+                 'ON CONFLICT(name, labels, series) DO UPDATE SET value = value + excluded.value',
+    'select_all': 'SELECT name, labels, series, value FROM metrics',
+}
+
+
+class MetricsTable(Table):
+    """
+    Class for manipulation of the 'metrics' table in the database, holding the measurement totals of every process.
+    """
+
+    # The queries here are not themselves measured.
+    instrumented = False
+
+    def add(self, values):
+        """
+        Add measurements to the totals.
+        :param values: List of (name, labels, series, value) tuples.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.executemany(QUERIES['add_value'], values)
+
+    def select_all(self):
+        """
+        :return: List of (name, labels, series, value) tuples for every total.
+        """
+        return [tuple(row) for row in self._cursor.execute(QUERIES['select_all'])]
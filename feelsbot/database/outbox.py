@@ -0,0 +1,118 @@
+import json
+import time
+import uuid
+
+from .table import Table
+
+
+QUERIES = {
+    'insert_message': 'INSERT INTO outbox(recipient, message, created, next_attempt) VALUES (?, ?, ?, ?)',
+    'claim_due': 'UPDATE outbox SET claim = ?, next_attempt = ? WHERE outbox_id IN ('
+                 'SELECT outbox_id FROM outbox WHERE sent IS NULL AND next_attempt <= ? AND attempts < ? '
+                 'ORDER BY outbox_id LIMIT ?)',
+    'select_claimed': 'SELECT outbox_id, recipient, message FROM outbox WHERE claim = ? AND sent IS NULL '
+                      'ORDER BY outbox_id',
+    'update_sent': 'UPDATE outbox SET sent = ?, claim = NULL WHERE outbox_id = ?',
+    'update_failed': 'UPDATE outbox SET attempts = attempts + 1, last_error = ?, claim = NULL, '
+                     'next_attempt = ? + min(?, ? * (1 << attempts)) WHERE outbox_id = ?',
+    'update_deferred': 'UPDATE outbox SET claim = NULL, next_attempt = ? WHERE outbox_id = ?',
+    'delete_sent': 'DELETE FROM outbox WHERE sent IS NOT NULL AND sent < ?',
+    'count_pending': 'SELECT count(outbox_id) FROM outbox WHERE sent IS NULL AND attempts < ?',
+}
+
+
+class OutboxTable(Table):
+    """
+    Class for manipulation of the 'outbox' table in the database, which holds messages until Kik has accepted them.
+    Messages are stored as the json representation used by the Kik API.
+    """
+
+    def add(self, recipient, message):
+        """
+        Store a message to be sent. Within a request session it is only committed (and so only sent) along with the
+        rest of the request.
+        :param recipient: The Kik username the message is addressed to.
+        :param message: Dictionary with the json representation of the message (i.e. Message.to_json()).
+        :return: Nothing.
+        """
+        now = time.time()
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['insert_message'], (recipient, json.dumps(message), now, now))
+
+    def add_many(self, messages):
+        """
+        Store several messages to be sent at once (see add()).
+        :param messages: List of (recipient, message) tuples.
+        :return: Nothing.
+        """
+        now = time.time()
+        with self._session.transaction():
+            self._cursor.executemany(QUERIES['insert_message'],
+                                     [(recipient, json.dumps(message), now, now) for recipient, message in messages])
+
+    def claim_due(self, limit, max_attempts, lease):
+        """
+        Claim messages that are due to be sent, so no other process will send them while this one is.
+        :param limit: The maximum number of messages to claim.
+        :param max_attempts: Messages that have failed this many times are no longer retried.
+        :param lease: Seconds before the claim expires, should the process die before marking the messages.
+        :return: A list of (outbox_id, recipient, message) tuples, oldest first, with message as a dictionary.
+        """
+        now = time.time()
+        claim = uuid.uuid4().hex
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['claim_due'], (claim, now + lease, now, max_attempts, limit))
+            rows = self._cursor.execute(QUERIES['select_claimed'], [claim]).fetchall()
+        return [(row['outbox_id'], row['recipient'], json.loads(row['message'])) for row in rows]
+
+    def mark_sent(self, outbox_ids):
+        """
+        Record that messages have been accepted by Kik.
+        :param outbox_ids: The ids of the sent messages.
+        :return: Nothing.
+        """
+        now = time.time()
+        with self._session.transaction():
+            self._cursor.executemany(QUERIES['update_sent'], [(now, outbox_id) for outbox_id in outbox_ids])
+
+    def mark_failed(self, outbox_ids, error, backoff, max_backoff):
+        """
+        Record a failed attempt to send messages, scheduling the next attempt with exponential backoff.
+        :param outbox_ids: The ids of the messages that could not be sent.
+        :param error: Description of the error, kept for diagnosis.
+        :param backoff: Seconds before the first retry; doubled for each further attempt.
+        :param max_backoff: The longest delay between attempts, in seconds.
+        :return: Nothing.
+        """
+        now = time.time()
+        with self._session.transaction():
+            self._cursor.executemany(QUERIES['update_failed'],
+                                     [(error, now, max_backoff, backoff, outbox_id) for outbox_id in outbox_ids])
+
+    def defer(self, outbox_ids, delay):
+        """
+        Release claimed messages to be sent later, without counting it as a failed attempt (e.g. when rate limited).
+        :param outbox_ids: The ids of the messages to defer.
+        :param delay: Seconds until the messages are due again.
+        :return: Nothing.
+        """
+        due = time.time() + delay
+        with self._session.transaction():
+            self._cursor.executemany(QUERIES['update_deferred'], [(due, outbox_id) for outbox_id in outbox_ids])
+
+    def purge_sent(self, older_than):
+        """
+        Delete sent messages that are no longer needed.
+        :param older_than: Age in seconds; messages sent longer ago than this are removed.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['delete_sent'], [time.time() - older_than])
+
+    def count_pending(self, max_attempts):
+        """
+        Count the messages still to be sent (including those waiting for a retry).
+        :param max_attempts: Messages that have failed this many times are not counted.
+        :return: The number of pending messages.
+        """
+        return self._cursor.execute(QUERIES['count_pending'], [max_attempts]).fetchone()[0]
@@ -0,0 +1,79 @@
+from .table import Table
+
+
+QUERIES = {
+    'select_buckets': 'SELECT bucket, tokens, updated FROM rate_buckets WHERE bucket IN ({})',
+    'upsert_bucket': 'INSERT INTO rate_buckets(bucket, tokens, updated) VALUES (?, ?, ?) '
+                     'ON CONFLICT(bucket) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+    'delete_idle': 'DELETE FROM rate_buckets WHERE updated < ?',
+}
+
+
+class RateLimitTable(Table):
+    """
+    Class for manipulation of the 'rate_buckets' table in the database, which holds the token bucket state used to rate
+    limit sending. Should be opened with autocommit=True, so that tokens are taken under the database write lock.
+    """
+
+    def take(self, requests, now):
+        """
+        Take as many tokens as are available (up to the number requested) from a set of buckets, atomically.
+
+        Each request is (bucket, rate, burst, count, parents): the bucket refills at rate tokens per second up to
+        burst, and every token taken from it must also be taken from each of the parent buckets (e.g. a global limit
+        shared by all users). Requests are served in order until the parent buckets run out.
+        :param requests: List of (bucket, rate, burst, count, parents) tuples, parents being a list of
+        (bucket, rate, burst) tuples.
+        :param now: The current time, in seconds.
+        :return: Tuple of a list with the number of tokens granted for each request, and the number of seconds until
+        the next token is available for the requests that were not granted in full (0 if they all were).
+        """
+        limits = {}
+        for bucket, rate, burst, count, parents in requests:
+            limits[bucket] = (rate, burst)
+            for parent, parent_rate, parent_burst in parents:
+                limits[parent] = (parent_rate, parent_burst)
+
+        with self._session.transaction(immediate=True):
+            names = list(limits)
+            stored = {}
+            for start in range(0, len(names), 500):
+                chunk = names[start:start + 500]
+                query = QUERIES['select_buckets'].format(', '.join('?' * len(chunk)))
+                for row in self._cursor.execute(query, chunk):
+                    stored[row['bucket']] = (row['tokens'], row['updated'])
+
+            tokens = {}
+            for bucket, (rate, burst) in limits.items():
+                if bucket in stored:
+                    level, updated = stored[bucket]
+                    tokens[bucket] = min(burst, level + max(0.0, now - updated) * rate)
+                else:
+                    tokens[bucket] = burst
+
+            granted = []
+            delay = 0.0
+            for bucket, rate, burst, count, parents in requests:
+                chain = [bucket] + [parent for parent, _, _ in parents]
+                grant = min([count] + [int(tokens[name]) for name in chain])
+                for name in chain:
+                    tokens[name] -= grant
+                granted.append(grant)
+                if grant < count:
+                    # Wait for whichever bucket in the chain is furthest from its next whole token.
+                    delay = max([delay] + [(1 - tokens[name]) / limits[name][0] for name in chain
+                                           if tokens[name] < 1 and limits[name][0] > 0])
+
+            self._cursor.executemany(QUERIES['upsert_bucket'],
+                                     [(bucket, level, now) for bucket, level in tokens.items()])
+        return granted, delay
+
+    def purge_idle(self, older_than, now):
+        """
+        Delete buckets that have not been used for a while (they would have refilled completely anyway).
+        :param older_than: Age in seconds since last use.
+        :param now: The current time, in seconds.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['delete_idle'], [now - older_than])
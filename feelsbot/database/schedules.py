@@ -0,0 +1,65 @@
+from .table import Table
+
+
+QUERIES = {
+    'select_all': 'SELECT schedule_id, name, interval, count, start, next_run, active FROM schedules',
+    'select_active': 'SELECT schedule_id, interval, count, next_run FROM schedules WHERE active = 1',
+    'insert_schedule': 'INSERT INTO schedules(name, interval, count, start, next_run) VALUES (?, ?, ?, ?, ?)',
+    'update_schedule': 'UPDATE schedules SET interval = ?, count = ?, start = ?, next_run = ?, active = 1 '
+                       'WHERE schedule_id = ?',
+    'update_count': 'UPDATE schedules SET count = ?, active = 1 WHERE schedule_id = ?',
+    'deactivate': 'UPDATE schedules SET active = 0 WHERE schedule_id = ?',
+    'advance': 'UPDATE schedules SET next_run = ?, last_run = ? WHERE schedule_id = ? AND next_run = ? AND active = 1',
+}
+
+
+class SchedulesTable(Table):
+    """
+    Class for manipulation of the 'schedules' table in the database, which holds the timed sends of feels and when each
+    is next due (see scheduler.py).
+    """
+
+    def sync(self, schedules, first_run):
+        """
+        Bring the table in line with the schedules in the configuration. A schedule whose timing is unchanged keeps its
+        next due time, so restarting does not move (or repeat) its runs; schedules no longer configured are disabled.
+        :param schedules: List of (name, interval, count, start) tuples.
+        :param first_run: Function taking an interval and start, returning the time of the first run of a schedule.
+        :return: Nothing.
+        """
+        with self._session.transaction(immediate=True):
+            existing = {row['name']: row for row in self._cursor.execute(QUERIES['select_all']).fetchall()}
+            for name, interval, count, start in schedules:
+                row = existing.pop(name, None)
+                if row is None:
+                    self._cursor.execute(QUERIES['insert_schedule'],
+                                         (name, interval, count, start, first_run(interval, start)))
+                elif row['interval'] != interval or row['start'] != start or not row['active']:
+                    self._cursor.execute(QUERIES['update_schedule'],
+                                         (interval, count, start, first_run(interval, start), row['schedule_id']))
+                elif row['count'] != count:
+                    self._cursor.execute(QUERIES['update_count'], (count, row['schedule_id']))
+            for row in existing.values():
+                if row['active']:
+                    self._cursor.execute(QUERIES['deactivate'], [row['schedule_id']])
+
+    def select_active(self):
+        """
+        :return: List of (schedule_id, interval, count, next_run) tuples for the enabled schedules.
+        """
+        rows = self._cursor.execute(QUERIES['select_active']).fetchall()
+        return [(row['schedule_id'], row['interval'], row['count'], row['next_run']) for row in rows]
+
+    def advance(self, schedule_id, due, next_run, now):
+        """
+        Record a run of a schedule by moving it on to its next due time, provided it is still due at the time given.
+        Whoever moves it on is the only one to run it, so a run is never repeated by another process (or after a
+        restart).
+        :param schedule_id: The schedule.
+        :param due: The due time the run is for, as last read from the table.
+        :param next_run: The time the schedule is next due.
+        :param now: The time of the run.
+        :return: True if the run was recorded, False if the schedule was changed or run by someone else meanwhile.
+        """
+        with self._session.transaction():
+            return self._cursor.execute(QUERIES['advance'], (next_run, now, schedule_id, due)).rowcount == 1
@@ -0,0 +1,189 @@
+"""
+Definition of the database tables, created and upgraded in place through numbered migrations.
+
+The schema version of a database file is held in PRAGMA user_version. Each migration brings the database from the
+version before it to its own number, so a new database runs all of them and an existing one only those it is missing.
+Databases created before the schema was managed here are at version 0; the first migration adopts their tables as
+they are, only rebuilding user_status to give it a primary key.
+"""
+
+
+def _table_exists(connect, name):
+    row = connect.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", [name]).fetchone()
+    return row is not None
+
+
+def _migration_tables(connect):
+    connect.execute('CREATE TABLE IF NOT EXISTS feels('
+                    'feel_id INTEGER PRIMARY KEY, '
+                    'submitted TEXT, '
+                    'name TEXT, '
+                    'comment TEXT, '
+                    'approved INTEGER NOT NULL DEFAULT 0, '
+                    'selector INTEGER NOT NULL DEFAULT 0, '
+                    'sent_count INTEGER NOT NULL DEFAULT 0)')
+
+    existing = _table_exists(connect, 'user_status')
+    if existing:
+        connect.execute('ALTER TABLE user_status RENAME TO user_status_old')
+    connect.execute('CREATE TABLE user_status('
+                    'user_id TEXT PRIMARY KEY, '
+                    'status INTEGER NOT NULL DEFAULT 0, '
+                    'data TEXT, '
+                    'version INTEGER NOT NULL DEFAULT 0)')
+    if existing:
+        # Older tables had no key, so a user could have several rows; the most recent one is kept.
+        connect.execute('INSERT INTO user_status(user_id, status, data) '
+                        'SELECT user_id, coalesce(status, 0), data FROM user_status_old '
+                        'WHERE rowid IN (SELECT max(rowid) FROM user_status_old GROUP BY user_id)')
+        connect.execute('DROP TABLE user_status_old')
+
+
+def _migration_indexes(connect):
+    # Selection (min selector, eligible feels) filters on approved then selector.
+    connect.execute('CREATE INDEX IF NOT EXISTS feels_approved_selector ON feels(approved, selector)')
+    # Feels awaiting approval are few compared to the whole table, and are always read oldest first.
+    connect.execute('CREATE INDEX IF NOT EXISTS feels_pending ON feels(feel_id) WHERE approved = 0')
+
+
+def _migration_counts(connect):
+    # Number of feels for each approved status, kept current by triggers so that status reports do not have to count
+    # the whole table.
+    connect.execute('CREATE TABLE feel_counts('
+                    'approved INTEGER PRIMARY KEY, '
+                    'total INTEGER NOT NULL DEFAULT 0)')
+    connect.execute('INSERT INTO feel_counts(approved, total) SELECT approved, count(*) FROM feels GROUP BY approved')
+    connect.execute('CREATE TRIGGER feel_counts_insert AFTER INSERT ON feels BEGIN '
+                    'INSERT INTO feel_counts(approved, total) VALUES (NEW.approved, 1) '
+                    'ON CONFLICT(approved) DO UPDATE SET total = total + 1; '
+                    'END')
+    connect.execute('CREATE TRIGGER feel_counts_delete AFTER DELETE ON feels BEGIN '
+                    'UPDATE feel_counts SET total = total - 1 WHERE approved = OLD.approved; '
+                    'END')
+    connect.execute('CREATE TRIGGER feel_counts_update AFTER UPDATE OF approved ON feels '
+                    'WHEN OLD.approved IS NOT NEW.approved BEGIN '
+                    'UPDATE feel_counts SET total = total - 1 WHERE approved = OLD.approved; '
+                    'INSERT INTO feel_counts(approved, total) VALUES (NEW.approved, 1) '
+                    'ON CONFLICT(approved) DO UPDATE SET total = total + 1; '
+                    'END')
+
+
+def _migration_outbox(connect):
+    # Messages waiting to be sent to Kik (see MessageQueue). A row is claimed by setting a random token and pushing
+    # next_attempt forward, so that two processes never send the same row at once; sent is set on success.
+    connect.execute('CREATE TABLE outbox('
+                    'outbox_id INTEGER PRIMARY KEY, '
+                    'recipient TEXT NOT NULL, '
+                    'message TEXT NOT NULL, '
+                    'created REAL NOT NULL, '
+                    'attempts INTEGER NOT NULL DEFAULT 0, '
+                    'next_attempt REAL NOT NULL, '
+                    'last_error TEXT, '
+                    'claim TEXT, '
+                    'sent REAL)')
+    connect.execute('CREATE INDEX outbox_due ON outbox(next_attempt) WHERE sent IS NULL')
+    connect.execute('CREATE INDEX outbox_claim ON outbox(claim) WHERE sent IS NULL')
+    connect.execute('CREATE INDEX outbox_sent ON outbox(sent) WHERE sent IS NOT NULL')
+
+
+def _migration_rate_limits(connect):
+    # Token buckets for the Kik send rate limits, shared by every process (see RateLimiter).
+    connect.execute('CREATE TABLE rate_buckets('
+                    'bucket TEXT PRIMARY KEY, '
+                    'tokens REAL NOT NULL, '
+                    'updated REAL NOT NULL)')
+
+
+def _migration_subscribers(connect):
+    # Users that feels are broadcast to. Unsubscribing only clears active, so the row is kept for reference.
+    connect.execute('CREATE TABLE subscribers('
+                    'user_id TEXT PRIMARY KEY, '
+                    'active INTEGER NOT NULL DEFAULT 1, '
+                    'created REAL NOT NULL)')
+    # Broadcasts read the active subscribers in chunks, in order of user_id.
+    connect.execute('CREATE INDEX subscribers_active ON subscribers(user_id) WHERE active = 1')
+
+
+def _migration_seen_messages(connect):
+    # Ids of the Kik messages already handled, so that redeliveries of a message are not processed again. Rows older
+    # than the configured time to live are deleted (see SeenMessagesTable).
+    connect.execute('CREATE TABLE seen_messages('
+                    'message_id TEXT PRIMARY KEY, '
+                    'seen REAL NOT NULL)')
+    connect.execute('CREATE INDEX seen_messages_seen ON seen_messages(seen)')
+
+
+def _migration_metrics(connect):
+    # Totals of the measurements made by every process (see metrics.py). Each histogram series (bucket, sum or count)
+    # has a row of its own; counters use the series ''.
+    connect.execute('CREATE TABLE metrics('
+                    'name TEXT NOT NULL, '
+                    'labels TEXT NOT NULL, '
+                    'series TEXT NOT NULL, '
+                    'value REAL NOT NULL, '
+                    'PRIMARY KEY(name, labels, series)) WITHOUT ROWID')
+
+
+def _migration_schedules(connect):
+    # Timed sends of feels (see scheduler.py). next_run is moved on as each run is made, so a schedule is never run
+    # twice for the same due time, even across restarts.
+    connect.execute('CREATE TABLE schedules('
+                    'schedule_id INTEGER PRIMARY KEY, '
+                    'name TEXT NOT NULL UNIQUE, '
+                    'interval REAL NOT NULL, '
+                    'count INTEGER NOT NULL DEFAULT 1, '
+                    'start TEXT, '
+                    'next_run REAL NOT NULL, '
+                    'last_run REAL, '
+                    'active INTEGER NOT NULL DEFAULT 1)')
+    # Roles held by one process at a time, such as leading the scheduler (see LeasesTable).
+    connect.execute('CREATE TABLE leases('
+                    'name TEXT PRIMARY KEY, '
+                    'holder TEXT NOT NULL, '
+                    'expires REAL NOT NULL)')
+
+
+# Ordered list of migrations; the schema version after running MIGRATIONS[n] is n + 1.
+MIGRATIONS = [
+    _migration_tables,
+    _migration_indexes,
+    _migration_counts,
+    _migration_outbox,
+    _migration_rate_limits,
+    _migration_subscribers,
+    _migration_seen_messages,
+    _migration_metrics,
+    _migration_schedules,
+]
+
+
+def version(connect):
+    """
+    :param connect: An open connection to the database.
+    :return: The schema version of the database.
+    """
+    return connect.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(connect):
+    """
+    Bring the database schema up to date, running any migrations it has not had yet. Each migration runs in its own
+    transaction along with the version change, so a failed migration leaves the database at the previous version.
+    :param connect: An open connection to the database.
+    :return: The schema version after migrating.
+    """
+    current = version(connect)
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= current:
+            continue
+        connect.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while this one waited for the lock.
+            if version(connect) < number:
+                migration(connect)
+                connect.execute('PRAGMA user_version = {}'.format(number))
+            connect.execute('COMMIT')
+        except BaseException:
+            connect.execute('ROLLBACK')
+            raise
+    return version(connect)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from .cache import LRUCache
+from .database import Database
+from .table import Table
+
+
+QUERIES = {
+    'insert_seen': 'INSERT INTO seen_messages(message_id, seen) VALUES (?, ?) ON CONFLICT(message_id) DO NOTHING',
+    'delete_expired': 'DELETE FROM seen_messages WHERE seen < ?',
+}
+
+# Number of message ids held in memory, unless overridden by 'seen_messages_cache_size' in the config.
+CACHE_SIZE_DEFAULT = 4096
+# Seconds that a message id is remembered in the table, unless overridden by 'seen_messages_ttl'. Kik gives up on
+# redelivering a message long before this.
+TTL_DEFAULT = 86400
+# Seconds between deletions of expired ids, unless overridden by 'seen_messages_purge_interval'.
+PURGE_INTERVAL_DEFAULT = 3600
+
+
+class SeenMessagesTable(Table):
+    """
+    Class for manipulation of the 'seen_messages' table in the database, which records the Kik messages already
+    handled so that redeliveries of them are recognised.
+
+    Recently seen ids are also held in memory, shared by every instance in the process, so most redeliveries are
+    recognised without a query. Within a request session an id is only recorded along with the rest of the request: if
+    handling the message fails and is rolled back, a redelivery of it is processed again.
+    """
+
+    _cache = None
+    _purged_at = None
+    _purge_lock = threading.Lock()
+
+    @staticmethod
+    def cache():
+        """
+        The seen message ids for this process, created on first use with the configured capacity.
+        :return: The LRUCache of message ids.
+        """
+        if SeenMessagesTable._cache is None:
+            SeenMessagesTable._cache = LRUCache(Database.option('seen_messages_cache_size', CACHE_SIZE_DEFAULT))
+        return SeenMessagesTable._cache
+
+    def claim(self, message_id):
+        """
+        Record a message as handled, unless it already has been.
+        :param message_id: The Kik id of the message.
+        :return: True if the message has not been seen before and should be processed, False for a redelivery.
+        """
+        cache = self.cache()
+        if cache.get(message_id) is not None:
+            return False
+
+        now = time.time()
+        with self._session.transaction():
+            if self._cursor.execute(QUERIES['insert_seen'], (message_id, now)).rowcount == 0:
+                cache.put(message_id, True)
+                return False
+            self._purge(now)
+        cache.put(message_id, True)
+        if not self._session.autocommit:
+            self._session.on_rollback(lambda: cache.pop(message_id))
+        return True
+
+    def _purge(self, now):
+        # At most once per interval in each process, delete the ids that have expired.
+        with SeenMessagesTable._purge_lock:
+            interval = float(Database.option('seen_messages_purge_interval', PURGE_INTERVAL_DEFAULT))
+            if SeenMessagesTable._purged_at is not None and now - SeenMessagesTable._purged_at < interval:
+                return
+            SeenMessagesTable._purged_at = now
+        ttl = float(Database.option('seen_messages_ttl', TTL_DEFAULT))
+        self._cursor.execute(QUERIES['delete_expired'], [now - ttl])
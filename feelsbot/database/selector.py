@@ -0,0 +1,180 @@
+import heapq
+import random
+import threading
+import time
+
+
+class _Bucket:
+    """
+    Set of feel ids supporting O(1) add, remove and uniform random choice.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, feel_id):
+        if feel_id not in self.positions:
+            self.positions[feel_id] = len(self.ids)
+            self.ids.append(feel_id)
+
+    def remove(self, feel_id):
+        # Swap the last id into the removed slot, so nothing needs to shift along.
+        position = self.positions.pop(feel_id)
+        last = self.ids.pop()
+        if last != feel_id:
+            self.ids[position] = last
+            self.positions[last] = position
+
+
+class SelectionIndex:
+    """
+    In-memory index of the approved feels, grouped into buckets by selector value.
+
+    This keeps the smoothing rule of the original selection (only feels with a selector within 1 of the lowest are
+    eligible) while making each pick O(log n) rather than fetching every eligible id from the table: the lowest
+    selector comes from a heap and a random member of the two lowest buckets is chosen directly.
+
+    The index is loaded from the table on first use and kept up to date by FeelsTable as feels are approved, blocked,
+    unblocked and selected. Changes made by other processes are picked up when a pick turns out to be stale (see
+    FeelsTable.select_random_feel) and by reloading once the index is older than max_age seconds.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._buckets = {}
+        self._selectors = {}
+        self._heap = []
+        self._loaded_at = None
+
+    def __len__(self):
+        return len(self._selectors)
+
+    @property
+    def loaded(self):
+        """
+        Whether the index currently holds usable data (loaded and not expired).
+        """
+        if self._loaded_at is None:
+            return False
+        return self.max_age is None or time.monotonic() - self._loaded_at < self.max_age
+
+    def load(self, rows):
+        """
+        Replace the contents of the index.
+        :param rows: Iterable of (feel_id, selector) pairs for every approved feel.
+        :return: Nothing.
+        """
+        with self._lock:
+            self._buckets = {}
+            self._selectors = {}
+            for feel_id, selector in rows:
+                self._add(feel_id, selector)
+            self._heap = list(self._buckets.keys())
+            heapq.heapify(self._heap)
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """
+        Mark the index as out of date, so it is reloaded before the next pick.
+        :return: Nothing.
+        """
+        self._loaded_at = None
+
+    def _add(self, feel_id, selector):
+        bucket = self._buckets.get(selector)
+        if bucket is None:
+            bucket = self._buckets[selector] = _Bucket()
+            heapq.heappush(self._heap, selector)
+        bucket.add(feel_id)
+        self._selectors[feel_id] = selector
+
+    def _remove(self, feel_id):
+        selector = self._selectors.pop(feel_id, None)
+        if selector is None:
+            return
+        bucket = self._buckets[selector]
+        bucket.remove(feel_id)
+        if len(bucket) == 0:
+            # The selector is left in the heap and skipped lazily by min_selector().
+            del self._buckets[selector]
+
+    def set(self, feel_id, selector):
+        """
+        Record an approved feel and its current selector value.
+        :param feel_id: The id of the feel.
+        :param selector: The selector value now stored in the table.
+        :return: Nothing.
+        """
+        with self._lock:
+            if self._selectors.get(feel_id) == selector:
+                return
+            self._remove(feel_id)
+            self._add(feel_id, selector)
+
+    def discard(self, feel_id):
+        """
+        Remove a feel that is no longer approved.
+        :param feel_id: The id of the feel.
+        :return: Nothing.
+        """
+        with self._lock:
+            self._remove(feel_id)
+
+    def min_selector(self):
+        """
+        :return: The lowest selector value of any approved feel, or None if there are none.
+        """
+        with self._lock:
+            while self._heap and self._heap[0] not in self._buckets:
+                heapq.heappop(self._heap)
+            return self._heap[0] if self._heap else None
+
+    def pick(self):
+        """
+        Choose a random feel from those with a selector within 1 of the lowest.
+        :return: Tuple of (feel_id, selector) for the chosen feel, or None if the index is empty.
+        """
+        with self._lock:
+            lowest = self.min_selector()
+            if lowest is None:
+                return None
+            eligible = [(lowest, self._buckets[lowest])]
+            if lowest + 1 in self._buckets:
+                eligible.append((lowest + 1, self._buckets[lowest + 1]))
+            choice = random.randrange(sum(len(bucket) for _, bucket in eligible))
+            for selector, bucket in eligible:
+                if choice < len(bucket):
+                    return bucket.ids[choice], selector
+                choice -= len(bucket)
+
+    def pick_many(self, count, exclude=()):
+        """
+        Choose up to count distinct feels, as if pick() had been called repeatedly with each chosen feel's selector
+        being incremented in between. Each chosen feel is moved up a bucket ready for the table update.
+        :param count: The number of feels wanted.
+        :param exclude: Ids of feels that must not be chosen (e.g. already chosen in an earlier round).
+        :return: List of (feel_id, selector) tuples with the selector each feel had when chosen. Shorter than count if
+        there are not enough approved feels.
+        """
+        with self._lock:
+            # Chosen and excluded feels are taken out while drawing, so that they cannot be drawn (again).
+            excluded = [(feel_id, self._selectors[feel_id]) for feel_id in exclude if feel_id in self._selectors]
+            for feel_id, _ in excluded:
+                self._remove(feel_id)
+            chosen = []
+            while len(chosen) < count:
+                pick = self.pick()
+                if pick is None:
+                    break
+                chosen.append(pick)
+                self._remove(pick[0])
+            for feel_id, selector in excluded:
+                self._add(feel_id, selector)
+            for feel_id, selector in chosen:
+                self._add(feel_id, selector + 1)
+            return chosen
@@ -0,0 +1,120 @@
+import threading
+from contextlib import contextmanager
+
+from .database import Database
+
+
+class Session:
+    """
+    Unit of work for the database: a single connection, opened lazily, shared by every table used within it.
+
+    A request session (autocommit=False) leaves all writes pending until commit() is called once at the end of the
+    request, so each handler's state changes are applied together or not at all. A table used outside of any request
+    session creates its own autocommit session, which commits each write block as it completes (the previous
+    behaviour).
+    """
+
+    def __init__(self, autocommit=False):
+        self.autocommit = autocommit
+        self._connect = None
+        self._rollback_hooks = []
+
+    @property
+    def connection(self):
+        """
+        The connection for this session, obtained from the pool on first use.
+        """
+        if self._connect is None:
+            self._connect = Database.open()
+        return self._connect
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Context manager wrapping a block of writes made by a table.
+        Commits (or rolls back on error) immediately for an autocommit session, otherwise defers to the end of the
+        session.
+        :param immediate: Take the database write lock at the start of the block, rather than at the first write, so
+        values read within the block cannot be changed by another process before they are written back. Only applies
+        to an autocommit session.
+        """
+        if self.autocommit:
+            with self.connection:
+                if immediate and not self.connection.in_transaction:
+                    self.connection.execute('BEGIN IMMEDIATE')
+                yield
+        else:
+            yield
+
+    def on_rollback(self, callback):
+        """
+        Register a function to be called if the pending writes of this session are discarded, e.g. so an in-memory
+        cache updated ahead of the commit can be invalidated again.
+        :param callback: Function taking no arguments.
+        :return: Nothing.
+        """
+        self._rollback_hooks.append(callback)
+
+    def _run_rollback_hooks(self):
+        hooks = self._rollback_hooks
+        self._rollback_hooks = []
+        for callback in hooks:
+            callback()
+
+    def commit(self):
+        if self._connect is not None:
+            self._connect.commit()
+        self._rollback_hooks = []
+
+    def rollback(self):
+        if self._connect is not None:
+            self._connect.rollback()
+        self._run_rollback_hooks()
+
+    def close(self):
+        """
+        Return the connection to the pool. Anything not yet committed is rolled back.
+        :return: Nothing.
+        """
+        if self._connect is not None:
+            Database.close(self._connect)
+            self._connect = None
+        self._run_rollback_hooks()
+
+
+_local = threading.local()
+
+
+def current_session():
+    """
+    The request session active on this thread, if any.
+    :return: The active Session, or None when not handling a request.
+    """
+    return getattr(_local, 'session', None)
+
+
+@contextmanager
+def request_session():
+    """
+    Context manager for handling a single request as one unit of work.
+
+    Every table opened within the block shares one connection. All writes are committed together when the block exits
+    normally and rolled back if it raises. Nested use joins the session that is already active.
+    :return: The active Session.
+    """
+    session = current_session()
+    if session is not None:
+        yield session
+        return
+
+    session = Session()
+    _local.session = session
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        _local.session = None
+        session.close()
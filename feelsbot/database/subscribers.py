@@ -0,0 +1,91 @@
+import time
+
+from .table import Table
+
+
+QUERIES = {
+    'insert_subscriber': 'INSERT INTO subscribers(user_id, created) VALUES (?, ?) ON CONFLICT(user_id) DO NOTHING',
+    'upsert_active': 'INSERT INTO subscribers(user_id, created) VALUES (?, ?) '
+                     'ON CONFLICT(user_id) DO UPDATE SET active = 1',
+    'update_inactive': 'UPDATE subscribers SET active = 0 WHERE user_id = ?',
+    'select_active': 'SELECT active FROM subscribers WHERE user_id = ?',
+    'select_active_after': 'SELECT user_id FROM subscribers WHERE active = 1 AND user_id > ? ORDER BY user_id LIMIT ?',
+    'count_active': 'SELECT count(user_id) FROM subscribers WHERE active = 1',
+}
+
+
+class SubscribersTable(Table):
+    """
+    Class for manipulation of the 'subscribers' table in the database: the users that feels are broadcast to.
+    """
+
+    def add(self, user_id):
+        """
+        Record a subscriber, leaving them as they are if already known (so someone who unsubscribed stays that way).
+        :param user_id: The Kik username of the user.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['insert_subscriber'], (user_id, time.time()))
+
+    def subscribe(self, user_id):
+        """
+        Make a user an active subscriber.
+        :param user_id: The Kik username of the user.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['upsert_active'], (user_id, time.time()))
+
+    def unsubscribe(self, user_id):
+        """
+        Stop broadcasting to a user. The row is kept, marked as inactive.
+        :param user_id: The Kik username of the user.
+        :return: Nothing.
+        """
+        with self._session.transaction():
+            self._cursor.execute(QUERIES['update_inactive'], [user_id])
+
+    def is_active(self, user_id):
+        """
+        :param user_id: The Kik username of the user.
+        :return: True if the user is an active subscriber.
+        """
+        row = self._cursor.execute(QUERIES['select_active'], [user_id]).fetchone()
+        return row is not None and row['active'] == 1
+
+    def count_active(self):
+        """
+        :return: The number of active subscribers.
+        """
+        return self._cursor.execute(QUERIES['count_active']).fetchone()[0]
+
+    def select_active(self, after, limit):
+        """
+        Read a chunk of the active subscribers, in order of username.
+        :param after: Only usernames after this one are returned ('' for the first chunk).
+        :param limit: The maximum number of usernames to return.
+        :return: List of usernames.
+        """
+        return [row['user_id'] for row in self._cursor.execute(QUERIES['select_active_after'], (after, limit))]
+
+    @staticmethod
+    def active_chunks(size):
+        """
+        Stream the active subscribers in chunks, so that however many there are only one chunk is held at a time.
+
+        Each chunk is read by a separate query continuing from the last username of the one before, rather than from
+        one long running cursor, so no read transaction is left open while the caller works through a chunk.
+        :param size: The number of usernames in each chunk.
+        :return: Generator of lists of usernames.
+        """
+        after = ''
+        while True:
+            with SubscribersTable() as table:
+                users = table.select_active(after, size)
+            if len(users) == 0:
+                return
+            yield users
+            if len(users) < size:
+                return
+            after = users[-1]
@@ -0,0 +1,92 @@
+import sys
+import time
+
+from .. import metrics
+from .session import Session, current_session
+
+
+class Table:
+    """
+    Base class for the table helpers, handling the connection and cursor used within a 'with' block.
+
+    When a request session is active the table joins it, otherwise it opens a private autocommit session for the
+    duration of the block. Passing autocommit=True always uses a private autocommit session, for work that must be
+    committed straight away whatever the surrounding request does.
+
+    With metrics enabled, the time taken by each query is recorded, labelled with its key in the QUERIES dictionary of
+    the table's module.
+    """
+
+    instrumented = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        queries = getattr(sys.modules[cls.__module__], 'QUERIES', {})
+        cls._query_names = {sql: name for name, sql in queries.items()}
+
+    def __init__(self, autocommit=False):
+        self._autocommit = autocommit
+
+    def __enter__(self):
+        self._session = None if self._autocommit else current_session()
+        self._owns_session = self._session is None
+        if self._owns_session:
+            self._session = Session(autocommit=True)
+        self._connect = self._session.connection
+        self._cursor = self._connect.cursor()
+        if self.instrumented and metrics.enabled():
+            self._cursor = _TimedCursor(self._cursor, type(self).__name__, self._query_names)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._cursor.close()
+        if self._owns_session:
+            self._session.close()
+
+
+def select_statements():
+    """
+    :return: The SQL of every SELECT query of the table classes, e.g. for Database.warm_up(). Templates completed when
+    run (e.g. with a list of placeholders) are left out.
+    """
+    statements = set()
+    classes = list(Table.__subclasses__())
+    while classes:
+        cls = classes.pop()
+        classes += cls.__subclasses__()
+        statements.update(sql for sql in cls._query_names
+                          if sql.lstrip().upper().startswith('SELECT') and '{}' not in sql)
+    return sorted(statements)
+
+
+class _TimedCursor:
+    """
+    Wrapper for a cursor recording the time taken by each execute() / executemany() call.
+    """
+
+    def __init__(self, cursor, table, query_names):
+        self._cursor = cursor
+        self._table = table
+        self._query_names = query_names
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def _timed(self, method, sql, args):
+        start = time.perf_counter()
+        try:
+            method(sql, *args)
+        finally:
+            metrics.observe('feelsbot_db_query_seconds',
+                            metrics.labels(table=self._table, query=self._query_names.get(sql, 'other')),
+                            time.perf_counter() - start)
+        return self
+
+    def execute(self, sql, *args):
+        return self._timed(self._cursor.execute, sql, args)
+
+    def executemany(self, sql, *args):
+        return self._timed(self._cursor.executemany, sql, args)
@@ -1,59 +1,111 @@
 import json
 
+from .cache import LRUCache
 from .database import Database
+from .table import Table
 
 
 QUERIES = {
     'select_row': 'SELECT * FROM user_status WHERE user_id = ?',
-    'update_status': 'UPDATE user_status SET status = ?, data = ? WHERE user_id = ?',
-    'insert_status': 'INSERT INTO user_status(user_id) SELECT ? WHERE (SELECT Changes() = 0)'
+    'select_version': 'SELECT version FROM user_status WHERE user_id = ?',
+    'upsert_status': 'INSERT INTO user_status(user_id, status, data) VALUES (?, ?, ?) '
+                     'ON CONFLICT(user_id) DO UPDATE SET '
+                     'status = excluded.status, data = excluded.data, version = user_status.version + 1',
 }
 
+# Number of users whose state is held in memory, unless overridden by 'user_status_cache_size' in the config.
+CACHE_SIZE_DEFAULT = 1024
 
-class UserStatusTable:
+
+class UserStatusTable(Table):
     """
     Class for manipulation of the 'user_status' table in the database.
+
+    Reads are served from a write-through cache of (status, data) keyed by user id, shared by every instance in the
+    process. When more than one process writes to the database, set 'user_status_cache_check_version' in the config:
+    each cached entry is then checked against the row's version (bumped on every update) before use, and reloaded if
+    another process has changed it.
     """
 
-    def __enter__(self):
-        self._connect = Database.open()
-        self._cursor = self._connect.cursor()
-        return self
+    _cache = None
+
+    @staticmethod
+    def cache():
+        """
+        The state cache for this process, created on first use with the configured capacity.
+        :return: The LRUCache holding (status, data, version) tuples.
+        """
+        if UserStatusTable._cache is None:
+            UserStatusTable._cache = LRUCache(Database.option('user_status_cache_size', CACHE_SIZE_DEFAULT))
+        return UserStatusTable._cache
+
+    @staticmethod
+    def invalidate(user_id=None):
+        """
+        Drop cached state, forcing the next lookup to read from the database.
+        :param user_id: The user to invalidate, or None to clear the whole cache.
+        :return: Nothing.
+        """
+        if user_id is None:
+            UserStatusTable.cache().clear()
+        else:
+            UserStatusTable.cache().pop(user_id)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._connect.close()
+    @staticmethod
+    def _check_version():
+        return bool(Database.option('user_status_cache_check_version', False))
 
     def _select_row(self, user_id):
         row = self._cursor.execute(QUERIES['select_row'], [user_id]).fetchone()
         return row
 
+    def _select_version(self, user_id):
+        row = self._cursor.execute(QUERIES['select_version'], [user_id]).fetchone()
+        return None if row is None else row['version']
+
     def _update_status(self, user_id, status, data=None):
-        self._cursor.execute(QUERIES['update_status'], [status, data, user_id])
-        self._cursor.execute(QUERIES['insert_status'], [user_id])
+        self._cursor.execute(QUERIES['upsert_status'], [user_id, status, data])
 
-    def status(self, user_id):
-        """
-        ???
-        :param user_id:
-        :return:
-        """
+    def _load(self, user_id):
         row = self._select_row(user_id)
         if row is None:
-            return 0, None
+            return 0, None, None
         try:
             data = json.loads(row['data'])
-        except ValueError:
+        except (TypeError, ValueError):
             data = None
-        return int(row['status']), data
+        version = row['version'] if self._check_version() else None
+        return int(row['status']), data, version
+
+    def status(self, user_id):
+        """
+        Obtain the current conversation state for a user.
+        Cached data is shared between callers, so it must be treated as read only.
+        :param user_id: The Kik username of the user.
+        :return: Tuple of the state code and any data saved with it; (0, None) for an unknown user.
+        """
+        cache = self.cache()
+        entry = cache.get(user_id)
+        if entry is not None and self._check_version() and self._select_version(user_id) != entry[2]:
+            entry = None
+        if entry is None:
+            entry = self._load(user_id)
+            cache.put(user_id, entry)
+        return entry[0], entry[1]
 
     def update(self, user_id, status, data=None):
         """
-        ???
-        :param user_id:
-        :param status:
-        :param data:
-        :return:
+        Assign a new conversation state for a user, updating the cache along with the database.
+        :param user_id: The Kik username of the user.
+        :param status: The new state code.
+        :param data: Any data to be saved with the state code (must be serialisable as json).
+        :return: Nothing.
         """
         dump = json.dumps(data)
-        with self._connect:
+        with self._session.transaction():
             self._update_status(user_id, status, dump)
+            version = self._select_version(user_id) if self._check_version() else None
+        self.cache().put(user_id, (int(status), json.loads(dump), version))
+        if not self._session.autocommit:
+            # If the surrounding request is rolled back, the cached entry would no longer match the database.
+            self._session.on_rollback(lambda: self.invalidate(user_id))
@@ -0,0 +1,226 @@
+"""
+Bulk import of feels from a CSV or JSON lines file, for seeding a deployment without one /new-feel request per feel.
+
+Each row gives the submitted date / time, name and comment of a feel. A CSV file may start with a header naming those
+columns (in any order, other columns are ignored), otherwise the first three columns are used in that order. Each line
+of a JSON lines file is an object with those keys, or an array of the three values. Imported feels await approval as
+usual.
+
+Usage: python -m feelsbot.importer <config.json> <file> [--format csv|jsonl] [--chunk-size N]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+from .database import Database, FeelsTable
+
+
+FIELDS = ('submitted', 'name', 'comment')
+
+# Rows inserted per transaction, unless overridden by 'import_chunk_size' in the config.
+CHUNK_SIZE_DEFAULT = 1000
+
+# Longest values accepted for each field; longer rows are rejected rather than truncated.
+MAX_LENGTHS = {
+    'submitted': 100,
+    'name': 200,
+    'comment': 5000,
+}
+
+# Number of rejected rows whose details are kept for the report; any further rejections are only counted.
+MAX_REJECTED_REPORTED = 100
+
+
+class ImportResult:
+    """
+    Outcome of an import: the number of feels imported and the rows that were rejected.
+    """
+
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.rejected_rows = []
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        if len(self.rejected_rows) < MAX_REJECTED_REPORTED:
+            self.rejected_rows.append((line, reason))
+
+    def to_json(self):
+        return {
+            'imported': self.imported,
+            'rejected': self.rejected,
+            'rejected_rows': [{'line': line, 'reason': reason} for line, reason in self.rejected_rows],
+        }
+
+
+def read_csv(stream):
+    """
+    Read the rows of a CSV file, one at a time.
+    :param stream: Text stream of the file.
+    :return: Generator of (line number, values) tuples, values being a dictionary of the fields found in the row.
+    """
+    reader = csv.reader(stream)
+    columns = None
+    for row in reader:
+        if columns is None:
+            header = [value.strip().lower() for value in row]
+            if all(field in header for field in FIELDS):
+                columns = {field: header.index(field) for field in FIELDS}
+                continue
+            columns = {field: position for position, field in enumerate(FIELDS)}
+        if len(row) == 0:
+            continue
+        yield reader.line_num, {field: row[position] for field, position in columns.items() if position < len(row)}
+
+
+def read_jsonl(stream):
+    """
+    Read the rows of a JSON lines file, one at a time (see read_csv()).
+    A line that is not valid json gives None as its values, so it is rejected.
+    :param stream: Text stream of the file.
+    :return: Generator of (line number, values) tuples.
+    """
+    for number, line in enumerate(stream, start=1):
+        if line.strip() == '':
+            continue
+        try:
+            values = json.loads(line)
+        except ValueError:
+            yield number, None
+            continue
+        if isinstance(values, list):
+            values = dict(zip(FIELDS, values))
+        yield number, values
+
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def validate(values):
+    """
+    Check the values of one row.
+    :param values: Dictionary of the fields found in the row.
+    :return: Tuple of (submitted, name, comment) ready for insertion.
+    :raises ValueError: If the row is not a valid feel, with the reason as the message.
+    """
+    if not isinstance(values, dict):
+        raise ValueError("not a row of feel values")
+    row = []
+    for field in FIELDS:
+        value = values.get(field)
+        if not isinstance(value, str):
+            raise ValueError("missing '{}'".format(field))
+        value = value.strip()
+        if len(value) > MAX_LENGTHS[field]:
+            raise ValueError("'{}' is longer than {} characters".format(field, MAX_LENGTHS[field]))
+        row.append(value)
+    if row[2] == '':
+        raise ValueError("empty 'comment'")
+    return tuple(row)
+
+
+def import_feels(rows, chunk_size=None, progress=None):
+    """
+    Validate and insert feels, committing a chunk at a time, so that only one chunk of rows is held in memory however
+    large the input. Rejected rows are skipped and reported in the result rather than stopping the import.
+    :param rows: Iterable of (line number, values) tuples, e.g. from read_csv() or read_jsonl().
+    :param chunk_size: Rows inserted per transaction; defaults to the configured 'import_chunk_size'.
+    :param progress: Function called with the ImportResult after each chunk is committed, if given.
+    :return: The ImportResult.
+    """
+    if chunk_size is None:
+        chunk_size = Database.option('import_chunk_size', CHUNK_SIZE_DEFAULT)
+    chunk_size = max(1, int(chunk_size))
+
+    result = ImportResult()
+    chunk = []
+    for line, values in rows:
+        try:
+            chunk.append(validate(values))
+        except ValueError as e:
+            result.reject(line, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            _insert(chunk, result, progress)
+            chunk = []
+    if len(chunk) > 0:
+        _insert(chunk, result, progress)
+    return result
+
+
+def _insert(chunk, result, progress):
+    # Committed straight away, whatever request the import is part of, so each chunk is kept once inserted.
+    with FeelsTable(autocommit=True) as table:
+        table.insert_feels(chunk)
+    result.imported += len(chunk)
+    if progress is not None:
+        progress(result)
+
+
+def import_stream(stream, fmt, chunk_size=None, progress=None):
+    """
+    Import feels from a file (see import_feels()).
+    :param stream: Binary or text stream of the file, read as it is imported.
+    :param fmt: The file format, one of the keys of READERS.
+    :param chunk_size: Rows inserted per transaction.
+    :param progress: Function called with the ImportResult after each chunk.
+    :return: The ImportResult.
+    """
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    return import_feels(READERS[fmt](stream), chunk_size, progress)
+
+
+def guess_format(name):
+    """
+    :param name: File name or content type.
+    :return: The format it indicates ('csv' or 'jsonl'), or None if neither.
+    """
+    name = name.lower()
+    if 'csv' in name:
+        return 'csv'
+    if 'jsonl' in name or 'ndjson' in name or 'json' in name:
+        return 'jsonl'
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import feels from a CSV or JSON lines file.")
+    parser.add_argument('config', help="Location of the json configuration file for the application.")
+    parser.add_argument('file', help="File of feels to import, or - for standard input.")
+    parser.add_argument('--format', choices=sorted(READERS), help="File format (default: from the file extension).")
+    parser.add_argument('--chunk-size', type=int, help="Rows inserted per transaction.")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or guess_format(args.file)
+    if fmt is None:
+        parser.error("cannot tell the format of {}, use --format".format(args.file))
+
+    with open(args.config) as config_file:
+        Database.init_database(json.load(config_file))
+
+    def progress(result):
+        print("Imported {} feels, rejected {} rows".format(result.imported, result.rejected))
+
+    if args.file == '-':
+        result = import_stream(sys.stdin.buffer, fmt, args.chunk_size, progress)
+    else:
+        with open(args.file, 'rb') as stream:
+            result = import_stream(stream, fmt, args.chunk_size, progress)
+
+    for line, reason in result.rejected_rows:
+        print("Rejected line {}: {}".format(line, reason))
+    if result.rejected > len(result.rejected_rows):
+        print("... and {} more rejected rows".format(result.rejected - len(result.rejected_rows)))
+    print("Done: {} feels imported, {} rows rejected.".format(result.imported, result.rejected))
+    return 0 if result.rejected == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+import json
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from kik import Configuration, KikApi, KikError
+from kik.api import ROOT_URL
+
+
+# aiohttp (if installed) and asyncio are only imported once the ASGI client is used, as they are slow to import and
+# the WSGI app never needs them. False until the import has been attempted, then the module or None if not installed.
+_aiohttp = False
+
+
+def load_aiohttp():
+    """
+    :return: The aiohttp module, or None if it is not installed.
+    """
+    global _aiohttp
+    if _aiohttp is False:
+        try:
+            import aiohttp
+            _aiohttp = aiohttp
+        except ImportError:
+            _aiohttp = None
+    return _aiohttp
+
+
+class PooledKikApi(KikApi):
+    """
+    KikApi client that sends messages over a shared keep-alive HTTP session, instead of opening a new connection for
+    every call as the base client does. The session's connection pool is sized for the number of threads that may send
+    at once (see MessageQueue concurrent delivery).
+
+    The API can be served from another root URL (a format string taking the path, as kik.api.ROOT_URL), such as a local
+    stand in for Kik when load testing (see loadtest.py).
+    """
+
+    def __init__(self, bot, api_key, pool_size=1, timeout=60, root_url=ROOT_URL):
+        super(PooledKikApi, self).__init__(bot, api_key)
+        self.pool_size = max(1, int(pool_size))
+        self.timeout = timeout
+        self.root_url = root_url
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                session.auth = (self.bot, self.api_key)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def send_messages(self, messages):
+        """
+        Sends a batch of messages, as per KikApi.send_messages().
+        :param messages: List of messages to be sent.
+        :return: A dict containing the response from the API.
+        """
+        response = self._get_session().post(
+            self.root_url.format('/v1/message'),
+            timeout=self.timeout,
+            headers={
+                'Content-Type': 'application/json'
+            },
+            data=json.dumps({'messages': [m.to_json() for m in messages]})
+        )
+
+        if response.status_code != 200:
+            raise KikError(response.text, response.status_code)
+
+        return response.json()
+
+    def set_configuration(self, config):
+        """
+        Sets the bot's configuration, as per KikApi.set_configuration().
+        :param config: The new Configuration.
+        :return: The Configuration confirmed by the API.
+        """
+        response = self._get_session().post(
+            self.root_url.format('/v1/config'),
+            timeout=self.timeout,
+            headers={
+                'Content-Type': 'application/json'
+            },
+            data=json.dumps(config.to_json())
+        )
+
+        if response.status_code != 200:
+            raise KikError(response.text, response.status_code)
+
+        return Configuration.from_json(response.json())
+
+    def close(self):
+        """
+        Close the pooled connections.
+        :return: Nothing.
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class AsyncKikApi:
+    """
+    Client for sending messages from an asyncio event loop (see asgi.py), so that waiting on Kik does not hold a thread.
+
+    Uses aiohttp when it is installed, with up to pool_size connections open at once. Without it, the calls are made
+    through the blocking client on the event loop's default executor instead, so the event loop is still never
+    blocked but each call in progress takes a thread.
+    """
+
+    def __init__(self, fallback, pool_size=10, timeout=60):
+        """
+        :param fallback: The PooledKikApi for this bot, whose credentials are used and which makes the calls if aiohttp
+        is not installed.
+        :param pool_size: Maximum number of calls to Kik open at the same time.
+        :param timeout: Seconds before a call to Kik is abandoned.
+        """
+        self.fallback = fallback
+        self.pool_size = max(1, int(pool_size))
+        self.timeout = timeout
+        self._session = None
+
+    def _get_session(self):
+        # Created on first use, as the session must belong to the running event loop.
+        if self._session is None:
+            aiohttp = load_aiohttp()
+            self._session = aiohttp.ClientSession(
+                auth=aiohttp.BasicAuth(self.fallback.bot, self.fallback.api_key),
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def send_messages(self, messages):
+        """
+        Sends a batch of messages, as per KikApi.send_messages().
+        :param messages: List of messages to be sent.
+        :return: A dict containing the response from the API.
+        """
+        if load_aiohttp() is None:
+            import asyncio
+
+            return await asyncio.get_running_loop().run_in_executor(None, self.fallback.send_messages, messages)
+
+        async with self._get_session().post(
+            self.fallback.root_url.format('/v1/message'),
+            headers={
+                'Content-Type': 'application/json'
+            },
+            data=json.dumps({'messages': [m.to_json() for m in messages]})
+        ) as response:
+            text = await response.text()
+            if response.status != 200:
+                raise KikError(text, response.status)
+            return json.loads(text)
+
+    async def close(self):
+        """
+        Close the pooled connections.
+        :return: Nothing.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,425 @@
+"""
+End-to-end load generator, for measuring what one process of the bot sustains.
+
+The Flask app from init_app() is run in a process of its own and sent a mix of signed /incoming messages (recipients
+asking for a feel and strangers saying hello) and Zapier calls to /message and /new-feel, at a given rate and
+concurrency. Kik is replaced by a local stand in for its API, which records each batch sent and can add latency and
+fail a fraction of the batches. Throughput, latency percentiles and the number of batches sent to Kik are reported.
+
+The app is given a fresh database of approved feels and the users it needs. Other options, such as the message queue,
+cache or metrics settings, can be taken from a configuration file.
+
+When a rate is set, each request's latency is measured from the time it was due to be sent, so time spent waiting for
+a free worker counts against the app rather than being hidden.
+
+Usage: python -m feelsbot.loadtest [config.json] [--rate N] [--concurrency N] [--duration S | --requests N]
+       [--mix incoming=8,message=1,new-feel=1] [--kik-latency S] [--kik-error-rate F] [--output FILE]
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from .database import Database, FeelsTable, request_session
+from .parser import BUTTONS
+
+
+API_KEY = 'loadtest-key'
+ADMIN = 'loadtest-admin'
+WEBHOOK_AUTH = ('loadtest', 'loadtest')
+
+# Kinds of request sent, to their route.
+ROUTES = {
+    'incoming': '/incoming',
+    'message': '/message',
+    'new-feel': '/new-feel',
+}
+MIX_DEFAULT = 'incoming=8,message=1,new-feel=1'
+
+# Seconds to wait for the app process to start serving.
+STARTUP_TIMEOUT = 30
+
+
+class FakeKikServer(ThreadingHTTPServer):
+    """
+    Local stand in for the Kik API, accepting /v1/config and /v1/message calls and recording the batches of messages.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """
+        :param latency: Seconds added to each call.
+        :param error_rate: Fraction of the message batches answered with an error instead of being accepted.
+        """
+        super(FakeKikServer, self).__init__(('127.0.0.1', 0), FakeKikHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.batches = 0
+        self.messages = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def root_url(self):
+        """
+        :return: Root URL of the server, in the form of the 'kik_api_url' option.
+        """
+        return 'http://127.0.0.1:{}{{}}'.format(self.server_address[1])
+
+    def handle_call(self, path, body):
+        """
+        :param path: Path of the API call.
+        :param body: Json body of the call.
+        :return: Tuple of (status, response json).
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if path == '/v1/config':
+            return 200, json.loads(body)
+        if path != '/v1/message':
+            return 404, {'error': 'NotFound'}
+
+        with self._lock:
+            if random.random() < self.error_rate:
+                self.errors += 1
+                return 500, {'error': 'InjectedError'}
+            self.batches += 1
+            self.messages += len(json.loads(body)['messages'])
+        return 200, {}
+
+
+class FakeKikHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as used by the pooled client.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, response = self.server.handle_call(self.path, body)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+def serve_app(path, log, ports):
+    """
+    Run the app in the current process until it is terminated. Started as a separate process, so the load generator
+    does not compete with the app for the interpreter.
+    :param path: Location of the configuration file for the app.
+    :param log: File to write the app's output to.
+    :param ports: Queue to put the port the app is served on.
+    :return: Nothing.
+    """
+    sys.stdout = sys.stderr = open(log, 'a', buffering=1)
+    from .server import init_app
+
+    server = make_server('127.0.0.1', 0, init_app(path), threaded=True, request_handler=QuietRequestHandler)
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def write_config(directory, base, kik, recipients):
+    """
+    Write the configuration for the app under test.
+    :param directory: Directory for the configuration and database.
+    :param base: Dictionary of options from the configuration file given, if any.
+    :param kik: The FakeKikServer.
+    :param recipients: Names of the recipients to subscribe.
+    :return: Tuple of (configuration, location of the configuration file).
+    """
+    config = dict(base)
+    config.update({
+        'database': os.path.join(directory, 'loadtest.db'),
+        'bot_username': 'loadtest-bot',
+        'bot_api_key': API_KEY,
+        'kik_api_url': kik.root_url,
+        'webhook': 'http://127.0.0.1/incoming',
+        'webhook_user': WEBHOOK_AUTH[0],
+        'webhook_pass': WEBHOOK_AUTH[1],
+        'admin': ADMIN,
+        'recipients': recipients,
+    })
+    config.pop('recipient', None)
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as config_file:
+        json.dump(config, config_file)
+    return config, path
+
+
+def seed_feels(config, count):
+    """
+    Create the database with a number of approved feels, before the app is started.
+    :param config: The app configuration.
+    :param count: Number of feels.
+    :return: Nothing.
+    """
+    Database.init_database(config)
+    with request_session():
+        with FeelsTable() as table:
+            table.insert_feels([('loadtest', 'loadtest', 'Load test feel {}'.format(i)) for i in range(count)])
+            for feel_id in range(1, count + 1):
+                table.approve(feel_id)
+    Database._pool.close_all()
+
+
+def parse_mix(text):
+    """
+    :param text: Comma separated kind=weight pairs, e.g. 'incoming=8,message=1'.
+    :return: Tuple of (kinds, weights).
+    """
+    kinds, weights = [], []
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ROUTES:
+            raise ValueError("Unknown request kind '{}', expected one of {}.".format(kind, ', '.join(ROUTES)))
+        kinds.append(kind)
+        weights.append(float(weight or 1))
+    return kinds, weights
+
+
+class LoadGenerator:
+    """
+    Sends requests to the app from a number of worker threads, recording the latency and status of each.
+    """
+
+    def __init__(self, url, recipients, kinds, weights, rate, concurrency, duration, total):
+        self.url = url
+        self.recipients = recipients
+        self.kinds = kinds
+        self.weights = weights
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.total = total
+        self.request_feel = BUTTONS['recipient_request_feel']
+        self.results = []
+        self._lock = threading.Lock()
+        self._numbers = itertools.count()
+        self._start = None
+
+    def run(self):
+        """
+        Send the requests and wait for every response.
+        :return: Seconds taken.
+        """
+        self._start = time.perf_counter()
+        workers = [threading.Thread(target=self._work, args=(seed,), daemon=True) for seed in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - self._start
+
+    def _next(self):
+        # The number of the next request and when it is due, or None once the test is over.
+        with self._lock:
+            number = next(self._numbers)
+        due = self._start + number / self.rate if self.rate > 0 else time.perf_counter()
+        if self.total is not None and number >= self.total:
+            return None
+        if self.total is None and due - self._start >= self.duration:
+            return None
+        return number, due
+
+    def _work(self, seed):
+        session = requests.Session()
+        choose = random.Random(seed)
+        while True:
+            scheduled = self._next()
+            if scheduled is None:
+                break
+            number, due = scheduled
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind = choose.choices(self.kinds, self.weights)[0]
+            try:
+                status = self._send(session, kind, number).status_code
+            except requests.RequestException:
+                status = 'error'
+            latency = time.perf_counter() - due
+            with self._lock:
+                self.results.append((kind, status, latency))
+        session.close()
+
+    def _send(self, session, kind, number):
+        url = self.url + ROUTES[kind]
+        if kind == 'message':
+            return session.post(url, auth=WEBHOOK_AUTH, data={'source': 'push'})
+        if kind == 'new-feel':
+            return session.post(url, auth=WEBHOOK_AUTH, data={
+                'submitted': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'name': 'loadtest',
+                'comment': 'New feel {}'.format(number),
+            })
+
+        # Alternately a recipient asking for a feel, and a stranger whose message is only acknowledged.
+        if number % 2 == 0:
+            user, body = self.recipients[number // 2 % len(self.recipients)], self.request_feel
+        else:
+            user, body = 'loadtest-stranger-{}'.format(number), 'Hello {}'.format(number)
+        data = json.dumps({'messages': [{
+            'type': 'text', 'id': str(uuid.uuid4()), 'from': user, 'chatId': 'loadtest-chat-{}'.format(user),
+            'body': body, 'participants': [user], 'timestamp': int(time.time() * 1000),
+        }]}).encode('utf-8')
+        signature = base64.b16encode(hmac.new(API_KEY.encode('utf-8'), data, hashlib.sha1).digest()).decode('utf-8')
+        return session.post(url, data=data, headers={'Content-Type': 'application/json', 'X-Kik-Signature': signature})
+
+
+def percentile(values, fraction):
+    """
+    :param values: Sorted list of values.
+    :param fraction: The percentile wanted, e.g. 0.95.
+    :return: The value at that percentile (nearest rank), or None if there are no values.
+    """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def milliseconds(seconds):
+    """
+    :param seconds: A latency in seconds, or None.
+    :return: The latency in milliseconds, or None.
+    """
+    return None if seconds is None else seconds * 1000
+
+
+def summarise(results, elapsed, kik):
+    """
+    :param results: List of (kind, status, latency) tuples for every request.
+    :param elapsed: Seconds the test took.
+    :param kik: The FakeKikServer.
+    :return: Dictionary of the report.
+    """
+    routes = {}
+    for kind in sorted(set(result[0] for result in results)) + ['all']:
+        selected = [result for result in results if kind == 'all' or result[0] == kind]
+        latencies = sorted(result[2] for result in selected)
+        statuses = {}
+        for result in selected:
+            statuses[str(result[1])] = statuses.get(str(result[1]), 0) + 1
+        routes[kind] = {
+            'requests': len(selected),
+            'per_second': len(selected) / elapsed if elapsed > 0 else 0,
+            'statuses': statuses,
+            # None when no requests completed, e.g. with the app down.
+            'p50_ms': milliseconds(percentile(latencies, 0.50)),
+            'p95_ms': milliseconds(percentile(latencies, 0.95)),
+            'p99_ms': milliseconds(percentile(latencies, 0.99)),
+        }
+    return {
+        'seconds': elapsed,
+        'routes': routes,
+        'kik': {'batches': kik.batches, 'messages': kik.messages, 'injected_errors': kik.errors},
+    }
+
+
+def print_report(report):
+    print("{:<10} {:>9} {:>9} {:>9} {:>9} {:>9}  {}".format('route', 'requests', 'per sec', 'p50 ms', 'p95 ms',
+                                                             'p99 ms', 'statuses'))
+    for kind, route in report['routes'].items():
+        latencies = ['n/a' if route[key] is None else '{:.1f}'.format(route[key])
+                     for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print("{:<10} {:>9} {:>9.1f} {:>9} {:>9} {:>9}  {}".format(
+            kind, route['requests'], route['per_second'], *latencies,
+            ' '.join('{}:{}'.format(status, count) for status, count in sorted(route['statuses'].items()))))
+    kik = report['kik']
+    print("Kik: {} batches of {} messages ({:.1f} per batch), {} injected errors".format(
+        kik['batches'], kik['messages'], kik['messages'] / kik['batches'] if kik['batches'] else 0,
+        kik['injected_errors']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the throughput and latency of the bot under load.")
+    parser.add_argument('config', nargs='?', help="Configuration file whose options are used for the app (its "
+                                                  "database, Kik credentials and users are replaced).")
+    parser.add_argument('--rate', type=float, default=0, help="Requests per second (default: as fast as possible).")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once.")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to send requests for.")
+    parser.add_argument('--requests', type=int, help="Number of requests to send, instead of a duration.")
+    parser.add_argument('--mix', default=MIX_DEFAULT, help="Relative weights of each kind of request.")
+    parser.add_argument('--feels', type=int, default=1000, help="Approved feels in the database.")
+    parser.add_argument('--recipients', type=int, default=10, help="Subscribed recipients.")
+    parser.add_argument('--kik-latency', type=float, default=0, help="Seconds added to each call to Kik.")
+    parser.add_argument('--kik-error-rate', type=float, default=0, help="Fraction of batches Kik fails.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="Save the report to this json file.")
+    parser.add_argument('--app-log', default=os.devnull, help="File for the app's output (default: discarded).")
+    args = parser.parse_args(argv)
+
+    try:
+        kinds, weights = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    base = {}
+    if args.config is not None:
+        with open(args.config) as config_file:
+            base = json.load(config_file)
+    random.seed(args.seed)
+
+    kik = FakeKikServer(args.kik_latency, args.kik_error_rate)
+    threading.Thread(target=kik.serve_forever, name='feelsbot-fake-kik', daemon=True).start()
+    directory = tempfile.mkdtemp()
+    app_process = None
+    try:
+        recipients = ['loadtest-recipient-{}'.format(i) for i in range(max(1, args.recipients))]
+        config, path = write_config(directory, base, kik, recipients)
+        seed_feels(config, args.feels)
+
+        context = multiprocessing.get_context('spawn')
+        ports = context.Queue()
+        app_process = context.Process(target=serve_app, args=(path, os.path.abspath(args.app_log), ports), daemon=True)
+        app_process.start()
+        port = ports.get(timeout=STARTUP_TIMEOUT)
+
+        generator = LoadGenerator('http://127.0.0.1:{}'.format(port), recipients, kinds, weights, args.rate,
+                                  max(1, args.concurrency), args.duration, args.requests)
+        print("Sending requests to the app on port {} ({}, concurrency {})...".format(
+            port, '{:g}/s'.format(args.rate) if args.rate > 0 else 'unthrottled', generator.concurrency))
+        elapsed = generator.run()
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            app_process.join()
+        kik.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = summarise(generator.results, elapsed, kik)
+    report['options'] = {key: value for key, value in vars(args).items() if key not in ('output', 'app_log')}
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
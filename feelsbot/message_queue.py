@@ -1,5 +1,128 @@
+import atexit
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import Queue, Empty, Full
+
 from kik import KikError
-from kik.messages import TextMessage, SuggestedResponseKeyboard
+from kik.messages import TextMessage, SuggestedResponseKeyboard, messages_from_json
+
+from . import metrics
+from .database import OutboxTable, SubscribersTable
+from .rate_limiter import RATE_LIMIT_DEFAULTS, RateLimiter
+
+
+# Kik rate limits for a single call to send_messages().
+MAX_PER_USER = 5
+MAX_PER_BATCH = 25
+
+# Defaults used for the sending options not present in the configuration file.
+QUEUE_DEFAULTS = {
+    # 'inline' sends during send_all(), 'background' hands the messages to a worker thread and returns at once.
+    'message_queue_mode': 'inline',
+    # Maximum number of pending send_all() calls waiting for the worker before sending falls back to inline.
+    'message_queue_depth': 100,
+    # Seconds to wait for the worker to finish sending when the process shuts down.
+    'message_queue_shutdown_timeout': 10,
+    # Number of batches sent to Kik at the same time; 1 sends them one after another.
+    'message_queue_concurrency': 1,
+    # In background mode, how often (in seconds) the worker checks the outbox for messages due to be retried.
+    'message_queue_poll_interval': 30,
+    # Store messages in the outbox table until Kik accepts them, rather than only in memory.
+    'message_queue_outbox': False,
+    # Maximum number of outbox messages claimed for sending at a time.
+    'outbox_batch_limit': 250,
+    # Messages that have failed this many times are left in the outbox but no longer retried.
+    'outbox_max_attempts': 8,
+    # Seconds before the first retry of a failed message, doubling with each further attempt up to the maximum.
+    'outbox_backoff': 30,
+    'outbox_max_backoff': 3600,
+    # Seconds a claim on messages lasts, should the process die while sending them.
+    'outbox_lease': 300,
+    # Seconds that sent messages are kept in the outbox before being deleted.
+    'outbox_retention': 86400,
+    # Check shared rate limits before sending each batch (see RateLimiter for the limits themselves).
+    'rate_limit': False,
+    # Number of subscribers read, queued and sent at a time when broadcasting.
+    'broadcast_chunk_size': 500,
+}
+QUEUE_DEFAULTS.update(RATE_LIMIT_DEFAULTS)
+
+
+class Dispatcher:
+    """
+    Worker thread that sends queued messages in the background, so that request handlers can return before the calls
+    to Kik are complete.
+
+    Each item handed to the dispatcher is a function that sends messages, e.g. the full contents of a MessageQueue at
+    the time send_all() was called. The number of items waiting is bounded; once full, submit() refuses further items
+    so the caller can send inline instead (slowing down requests rather than growing without limit or dropping
+    messages). When idle for poll_interval seconds, the idle function (if any) is called, which is used to retry
+    messages from the outbox.
+    """
+
+    def __init__(self, depth, poll_interval=None, idle=None):
+        self.poll_interval = poll_interval
+        self.idle = idle
+        self._pending = Queue(maxsize=depth)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        with self._lock:
+            # A worker thread does not survive a fork, so each process starts its own.
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='feelsbot-dispatcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                work = self._pending.get(timeout=self.poll_interval if self.idle is not None else None)
+            except Empty:
+                work = self.idle
+            else:
+                self._pending.task_done()
+                if work is None:
+                    return
+            try:
+                work()
+            except Exception as e:
+                print("Unexpected error in message dispatcher: {}".format(e))
+
+    def submit(self, work):
+        """
+        Hand some sending work to the worker thread.
+        :param work: Function taking no arguments that sends the messages.
+        :return: True if accepted, False if the dispatcher is already at its maximum depth.
+        """
+        self._ensure_started()
+        try:
+            self._pending.put_nowait(work)
+            return True
+        except Full:
+            return False
+
+    def stop(self, timeout=None):
+        """
+        Send everything still waiting and stop the worker thread.
+        :param timeout: Maximum number of seconds to wait for the worker to finish, in total.
+        :return: Nothing.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            # The queue may be full behind a worker stuck on slow calls to Kik, so this wait is bounded too.
+            self._pending.put(None, timeout=timeout)
+        except Full:
+            print("Message dispatcher still busy after {} seconds, giving up on sending the rest.".format(timeout))
+            return
+        self._thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
 
 
 class MessageQueue:
@@ -7,15 +130,52 @@ class MessageQueue:
         self.config = config
         self.kik = kik
         self.queue = {}
+        self.broadcasts = []
+        self.dispatcher = None
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+        options = dict(QUEUE_DEFAULTS)
+        if config is not None:
+            options.update((key, config[key]) for key in QUEUE_DEFAULTS if key in config)
+        self.options = options
+        self.outbox = bool(options['message_queue_outbox'])
+        self.concurrency = max(1, int(options['message_queue_concurrency']))
+        self.rate_limiter = RateLimiter(options) if options['rate_limit'] else None
+        if options['message_queue_mode'] == 'background':
+            self.dispatcher = Dispatcher(int(options['message_queue_depth']),
+                                         float(options['message_queue_poll_interval']),
+                                         self.send_outbox if self.outbox else None)
+            atexit.register(self.flush, float(options['message_queue_shutdown_timeout']))
 
     def add_message(self, to, body, chat_id=None, keyboards=None):
         """
-        ???
-        :param to:
-        :param body:
-        :param chat_id:
-        :param keyboards:
-        :return:
+        Add a message to the shared queue. Safe to call from several threads, but everything queued by any thread is
+        sent by the next send_all(); request handlers should use pending() for a queue of their own.
+        :param to: The Kik username to send the message to.
+        :param body: The text of the message.
+        :param chat_id: The chat to send the message in, if replying to a message.
+        :param keyboards: List of Kik keyboard responses to offer with the message.
+        :return: Nothing.
+        """
+        message = self.build_message(to, body, chat_id, keyboards)
+        with self._lock:
+            self.store(self.queue, message)
+
+    def add_broadcast(self, bodies, keyboards=None):
+        """
+        Add messages for every active subscriber to the shared queue (see PendingMessages.add_broadcast()).
+        :return: Nothing.
+        """
+        with self._lock:
+            self.broadcasts.append((list(bodies), keyboards))
+
+    def build_message(self, to, body, chat_id=None, keyboards=None):
+        """
+        Create a text message ready for sending (see add_message() for the parameters).
+        :return: The TextMessage.
         """
         if chat_id is not None:
             message = TextMessage(
@@ -31,63 +191,383 @@ class MessageQueue:
 
         if keyboards is not None:
             self._build_keyboard(message, to, keyboards)
+        return message
+
+    def store(self, queue, message):
+        """
+        Hold a message until it is sent: in the outbox table if enabled, otherwise in the given dictionary.
+        :param queue: Dictionary of recipient to list of messages.
+        :param message: The message to hold.
+        :return: Nothing.
+        """
+        if self.outbox:
+            with OutboxTable() as table:
+                table.add(message.to, message.to_json())
+            return
 
         try:
-            self.queue[to].append(message)
+            queue[message.to].append(message)
         except KeyError:
-            self.queue[to] = [message]
+            queue[message.to] = [message]
+
+    def store_many(self, queue, messages):
+        """
+        Hold several messages until they are sent, as per store() but writing them to the outbox together.
+        :param queue: Dictionary of recipient to list of messages.
+        :param messages: List of messages to hold.
+        :return: Nothing.
+        """
+        if self.outbox:
+            with OutboxTable() as table:
+                table.add_many([(message.to, message.to_json()) for message in messages])
+            return
+
+        for message in messages:
+            self.store(queue, message)
+
+    def pending(self):
+        """
+        Create a separate queue for the messages generated by handling one request, sharing this queue's way of
+        sending them. Nothing added to it can be sent by (or mixed up with) another request.
+        :return: A new PendingMessages.
+        """
+        return PendingMessages(self)
 
     def send_all(self):
         """
-        Send all messages within the queue and make the queue empty again
+        Send all messages within the queue and make the queue empty again.
+        In background mode the messages are handed to the dispatcher thread and this returns without waiting for them
+        to be sent (errors are then reported through error_handler() only).
         :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
         """
-        queue = self.queue
-        count = {}
-        self.queue = {}
-        for person in queue.keys():
-            count[person] = 0
-
-        # Function within a function
-        # For use with the while loop, to save have to do these tests within the loop itself (looks messy)
-        def count_unprocessed():
-            result = False
-            for c in count:
-                if count[c] < len(queue[c]):
-                    result = True
-            return result
-
-        while count_unprocessed():
-            sending = []
-            for person in queue:
-                # Should never exceed 25, but playing safe in case of other errors
-                if len(sending) >= 25:
-                    break
-
-                add = min(5, 25-len(sending))
-                if count[person] < len(queue[person]):
-                    # Add the next messages by getting the appropriate splice of the queue
-                    # Based upon rate limit of 5 messages per person, 25 messages per batch
-                    sending += queue[person][count[person]:count[person] + add]
-                    count[person] += add
-
-            # Be certain there is actually something to send
-            if len(sending) > 0:
-                try:
-                    self.kik.send_messages(sending)
-                except KikError as e:
-                    # Log the error, will appear in apache error logs when running under wsgi
-                    error_handler(self, e, queue, count, sending)
-                    # Also need to make certain we don't cause Kik server to go into a loop of resending the message
-                    # Returning 500 would cause the message to be resent up to a total of 4 times.
-                    # Hence 202 is a received and being processed but no guarantee of any outcome.
-                    #
-                    # NOTE: returning 202 has not actually been tested yet (to confirm it doesn't cause loop).
-                    # Other option might be to return 504 instead.
-                    return 202
+        with self._lock:
+            queue, broadcasts = self.queue, self.broadcasts
+            self.queue, self.broadcasts = {}, []
+        return self.send_chunks(self.chunks(queue, broadcasts))
+
+    def chunks(self, queue, broadcasts):
+        """
+        Split queued messages and broadcasts into the sets of messages to send one after another: first the queued
+        messages, then each broadcast a chunk of subscribers at a time. Subscribers are only read (and their messages
+        built) as each chunk is reached, so a broadcast to any number of subscribers holds one chunk in memory at once.
+        :param queue: Dictionary of recipient to list of messages.
+        :param broadcasts: List of (bodies, keyboards) tuples, as given to add_broadcast().
+        :return: Generator of dictionaries of recipient to list of messages, each to be passed to send_pending().
+        """
+        yield queue
+        for bodies, keyboards in broadcasts:
+            for users in SubscribersTable.active_chunks(int(self.options['broadcast_chunk_size'])):
+                yield self.broadcast_chunk(users, bodies, keyboards)
+
+    def broadcast_chunk(self, users, bodies, keyboards=None):
+        """
+        Build the messages of a broadcast for a chunk of subscribers.
+        :param users: List of usernames.
+        :param bodies: List of message texts, each sent to every user.
+        :param keyboards: Function taking a username and returning the keyboard responses for that user, or None.
+        :return: Dictionary of recipient to list of messages (empty if the messages went to the outbox).
+        """
+        chunk = {}
+        messages = []
+        for user in users:
+            keyboard = None if keyboards is None else keyboards(user)
+            messages += [self.build_message(user, body, keyboards=keyboard) for body in bodies]
+        self.store_many(chunk, messages)
+        return chunk
+
+    def send_chunks(self, chunks):
+        """
+        Send each set of messages from chunks() in turn.
+        :param chunks: Iterable of dictionaries of recipient to list of messages.
+        :return: 200 if successful, 202 if kik returned an error for any of them.
+        """
+        result = 200
+        for queue in chunks:
+            if self.send_pending(queue) != 200:
+                result = 202
+        return result
+
+    def send_pending(self, queue):
+        """
+        Send a set of queued messages, in the background or inline depending on the mode (see send_all()).
+        :param queue: Dictionary of recipient to list of messages.
+        :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
+        """
+        if self.outbox:
+            if self.dispatcher is not None and self.dispatcher.submit(self.send_outbox):
+                return 200
+            return self.send_outbox()
+
+        if len(queue) == 0:
+            return 200
+        if self.dispatcher is not None and self.dispatcher.submit(lambda: self.send_queue(queue)):
+            return 200
+        return self.send_queue(queue)
 
+    def flush(self, timeout=None):
+        """
+        Send anything still waiting for the background dispatcher and stop it; for use when the process shuts down.
+        :param timeout: Maximum number of seconds to wait.
+        :return: Nothing.
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.stop(timeout)
+
+    def send_queue(self, queue):
+        """
+        Send a set of queued messages, in batches within the Kik rate limits.
+        :param queue: Dictionary of recipient to list of messages, as held in self.queue.
+        :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
+        """
+        planned = self._plan_queue(queue)
+        errors = self.deliver([sending for sending, _ in planned])
+        return self._report(queue, planned, errors)
+
+    async def send_pending_async(self, queue, kik, run_blocking):
+        """
+        Counterpart of send_pending() for use on an asyncio event loop (see asgi.py), sending the batches through a
+        non-blocking Kik client. Database work (rate limits) is passed to run_blocking. With the outbox or background
+        mode enabled, the whole of send_pending() is passed to run_blocking instead, as that work is mostly database
+        work or returns at once.
+        :param queue: Dictionary of recipient to list of messages.
+        :param kik: Client with a coroutine send_messages(), e.g. AsyncKikApi.
+        :param run_blocking: Coroutine function taking a function and its arguments, running it off the event loop.
+        :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
+        """
+        if self.outbox or self.dispatcher is not None:
+            return await run_blocking(self.send_pending, queue)
+        if len(queue) == 0:
+            return 200
+
+        if self.rate_limiter is None:
+            planned = self._plan_queue(queue)
+        else:
+            planned = await run_blocking(self._plan_queue, queue)
+        errors = await self.deliver_async([sending for sending, _ in planned], kik)
+        if any(error is not None for error in errors):
+            # Error reporting notifies the admin through the blocking client.
+            return await run_blocking(self._report, queue, planned, errors)
         return 200
 
+    def _plan_queue(self, queue):
+        """
+        Split a set of queued messages into batches and apply the rate limits, scheduling anything deferred to be sent
+        later.
+        :param queue: Dictionary of recipient to list of messages.
+        :return: List of (batch, count) tuples that may be sent now (see _batches()).
+        """
+        planned, deferred, delay = self._admit(list(_batches(queue)), lambda message: message)
+        if len(deferred) > 0:
+            later = {}
+            for message in deferred:
+                later.setdefault(message.to, []).append(message)
+            self._schedule(delay, lambda: self.send_queue(later))
+        return planned
+
+    def _report(self, queue, planned, errors):
+        """
+        Report any batches that were rejected.
+        :param queue: Dictionary of recipient to list of messages that was sent.
+        :param planned: List of (batch, count) tuples that was sent.
+        :param errors: The result of sending each batch, as returned by deliver().
+        :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
+        """
+        result = 200
+        for (sending, count), error in zip(planned, errors):
+            if error is not None:
+                # Log the error, will appear in apache error logs when running under wsgi
+                error_handler(self, error, queue, count, sending)
+                # Also need to make certain we don't cause Kik server to go into a loop of resending the message
+                # Returning 500 would cause the message to be resent up to a total of 4 times.
+                # Hence 202 is a received and being processed but no guarantee of any outcome.
+                #
+                # NOTE: returning 202 has not actually been tested yet (to confirm it doesn't cause loop).
+                # Other option might be to return 504 instead.
+                result = 202
+        return result
+
+    def send_outbox(self):
+        """
+        Send the messages in the outbox that are due, in batches within the Kik rate limits.
+
+        Batches that Kik accepts are marked as sent. A batch that Kik rejects is scheduled for a retry with exponential
+        backoff and the remaining batches are still sent, so a single failure only delays the messages in that batch.
+        :return: 200 if every batch was sent, 202 if kik returned an error for any of them.
+        """
+        options = self.options
+        result = 200
+        while True:
+            with OutboxTable(autocommit=True) as table:
+                rows = table.claim_due(int(options['outbox_batch_limit']), int(options['outbox_max_attempts']),
+                                       float(options['outbox_lease']))
+            if len(rows) == 0:
+                break
+
+            queue = {}
+            for outbox_id, recipient, message in rows:
+                queue.setdefault(recipient, []).append((outbox_id, messages_from_json([message])[0]))
+
+            planned, deferred, delay = self._admit(list(_batches(queue)), lambda item: item[1])
+            if len(deferred) > 0:
+                with OutboxTable(autocommit=True) as table:
+                    table.defer([outbox_id for outbox_id, _ in deferred], delay)
+                if self.dispatcher is None:
+                    self._schedule(delay, self.send_outbox)
+
+            errors = self.deliver([[message for _, message in sending] for sending, _ in planned])
+            sent = []
+            for (sending, count), error in zip(planned, errors):
+                outbox_ids = [outbox_id for outbox_id, _ in sending]
+                if error is None:
+                    sent += outbox_ids
+                    continue
+                error_handler(self, error, queue, count, sending)
+                with OutboxTable(autocommit=True) as table:
+                    table.mark_failed(outbox_ids, str(error), float(options['outbox_backoff']),
+                                      float(options['outbox_max_backoff']))
+                result = 202
+            with OutboxTable(autocommit=True) as table:
+                table.mark_sent(sent)
+
+            if len(rows) < int(options['outbox_batch_limit']) or len(deferred) > 0:
+                break
+
+        with OutboxTable(autocommit=True) as table:
+            table.purge_sent(float(options['outbox_retention']))
+        return result
+
+    def _admit(self, planned, message_of):
+        """
+        Apply the rate limits (if enabled) to planned batches, taking tokens for each batch in turn.
+        Once any message for a recipient is deferred, so are all of their later messages, to keep them in order.
+        :param planned: List of (batch, count) tuples from _batches().
+        :param message_of: Function returning the message for an item in a batch.
+        :return: Tuple of the (batch, count) tuples that may be sent now, a list of the deferred items and the number
+        of seconds to wait before sending those.
+        """
+        if self.rate_limiter is None:
+            return planned, [], 0
+
+        admitted = []
+        deferred = []
+        held = set()
+        delay = 0.0
+        for sending, count in planned:
+            counts = {}
+            for item in sending:
+                to = message_of(item).to
+                if to not in held:
+                    counts[to] = counts.get(to, 0) + 1
+            granted, wait = self.rate_limiter.acquire(list(counts.items())) if counts else ({}, 0)
+            delay = max(delay, wait)
+
+            batch = []
+            for item in sending:
+                to = message_of(item).to
+                if granted.get(to, 0) > 0:
+                    granted[to] -= 1
+                    batch.append(item)
+                else:
+                    held.add(to)
+                    deferred.append(item)
+            if len(batch) > 0:
+                admitted.append((batch, count))
+        return admitted, deferred, delay
+
+    @staticmethod
+    def _schedule(delay, work):
+        """
+        Run some sending work on a timer thread once a delay has passed (used to send rate limited messages).
+        :param delay: Seconds to wait.
+        :param work: Function taking no arguments.
+        :return: Nothing.
+        """
+        timer = threading.Timer(delay, work)
+        timer.daemon = True
+        timer.start()
+
+    def deliver(self, batches):
+        """
+        Send planned batches of messages to Kik, reporting the outcome of each batch separately.
+
+        With a concurrency above 1, batches are sent on a pool of threads. A batch still waits for any earlier batch
+        with a recipient in common, so each recipient receives their messages in order.
+        :param batches: List of lists of messages, each within the Kik rate limits (see plan_batches()).
+        :return: List with, for each batch, None if it was sent or the KikError raised if it was rejected.
+        """
+        if self.concurrency <= 1 or len(batches) <= 1:
+            return [self._send_batch(sending) for sending in batches]
+
+        executor = self._get_executor()
+        futures = []
+        latest = {}
+        for sending in batches:
+            recipients = {message.to for message in sending}
+            earlier = {latest[to] for to in recipients if to in latest}
+            future = executor.submit(self._send_batch, sending, earlier)
+            for to in recipients:
+                latest[to] = future
+            futures.append(future)
+        # Batches are started in order, so anything a batch waits on is already running or done.
+        return [future.result() for future in futures]
+
+    def _send_batch(self, sending, earlier=()):
+        if earlier:
+            wait(earlier)
+        start = time.perf_counter()
+        try:
+            self.kik.send_messages(sending)
+        except KikError as e:
+            _record_send(sending, start, 'error')
+            return e
+        _record_send(sending, start, 'sent')
+        return None
+
+    async def deliver_async(self, batches, kik):
+        """
+        Counterpart of deliver() for use on an asyncio event loop. Every batch is sent at once, apart from those
+        waiting on an earlier batch with a recipient in common; the client limits how many calls are open at a time.
+        :param batches: List of lists of messages, each within the Kik rate limits (see plan_batches()).
+        :param kik: Client with a coroutine send_messages(), e.g. AsyncKikApi.
+        :return: List with, for each batch, None if it was sent or the KikError raised if it was rejected.
+        """
+        # Imported here, as asyncio is slow to import and only needed when serving through the ASGI app.
+        import asyncio
+
+        tasks = []
+        latest = {}
+        for sending in batches:
+            recipients = {message.to for message in sending}
+            earlier = {latest[to] for to in recipients if to in latest}
+            task = asyncio.ensure_future(self._send_batch_async(kik, sending, earlier))
+            for to in recipients:
+                latest[to] = task
+            tasks.append(task)
+        return await asyncio.gather(*tasks)
+
+    @staticmethod
+    async def _send_batch_async(kik, sending, earlier=()):
+        import asyncio
+
+        if earlier:
+            await asyncio.wait(earlier)
+        start = time.perf_counter()
+        try:
+            await kik.send_messages(sending)
+        except KikError as e:
+            _record_send(sending, start, 'error')
+            return e
+        _record_send(sending, start, 'sent')
+        return None
+
+    def _get_executor(self):
+        with self._executor_lock:
+            # Threads do not survive a fork, so each process needs its own pool.
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='feelsbot-send')
+                self._executor_pid = os.getpid()
+            return self._executor
+
     @staticmethod
     def _build_keyboard(message, to, responses):
         """
@@ -107,6 +587,99 @@ class MessageQueue:
             )
 
 
+class PendingMessages:
+    """
+    Messages queued while handling a single request, sent together at the end of it through the MessageQueue that
+    created it (see MessageQueue.pending()). Has the same add_message() / send_all() interface as MessageQueue.
+    """
+
+    def __init__(self, message_queue):
+        self.message_queue = message_queue
+        self.config = message_queue.config
+        self.queue = {}
+        self.broadcasts = []
+
+    def add_message(self, to, body, chat_id=None, keyboards=None):
+        """
+        Add a message to this request's queue (see MessageQueue.add_message() for the parameters).
+        :return: Nothing.
+        """
+        self.message_queue.store(self.queue, self.message_queue.build_message(to, body, chat_id, keyboards))
+
+    def add_broadcast(self, bodies, keyboards=None):
+        """
+        Add messages for every active subscriber. The subscribers are not read until the messages are sent, after the
+        request's database work is complete (see MessageQueue.chunks()).
+        :param bodies: List of message texts, each sent to every subscriber.
+        :param keyboards: Function taking a username and returning the keyboard responses for that user.
+        :return: Nothing.
+        """
+        self.broadcasts.append((list(bodies), keyboards))
+
+    def chunks(self):
+        """
+        Take everything queued for this request, as the sets of messages to send in turn (see MessageQueue.chunks()).
+        :return: Generator of dictionaries of recipient to list of messages.
+        """
+        queue, broadcasts = self.queue, self.broadcasts
+        self.queue, self.broadcasts = {}, []
+        return self.message_queue.chunks(queue, broadcasts)
+
+    def send_all(self):
+        """
+        Send the messages queued for this request and make the queue empty again.
+        :return: 200 if successful, 202 if kik returned an error (based upon http status codes)
+        """
+        return self.message_queue.send_chunks(self.chunks())
+
+
+def _batches(queue, per_user=MAX_PER_USER, per_batch=MAX_PER_BATCH):
+    """
+    Split queued messages into batches for sending, within the Kik rate limits.
+
+    Recipients are served round robin: each takes up to per_user messages in turn, then goes to the back of the line
+    if it still has messages waiting, and the next batch carries on from wherever the previous one stopped. A batch is
+    closed once it is full or the line comes back round to a recipient already in it. Every step places at least one
+    message, so planning is O(total messages) however many batches there are.
+    :param queue: Dictionary of recipient to list of messages (or of items wrapping a message).
+    :param per_user: The maximum number of messages for one recipient in a batch.
+    :param per_batch: The maximum number of messages in a batch.
+    :return: Generator of (batch, count) tuples, where count is the number of messages taken so far for each person.
+    """
+    count = {person: 0 for person in queue}
+    waiting = deque(person for person in queue if len(queue[person]) > 0)
+
+    while waiting:
+        sending = []
+        included = set()
+        while waiting and len(sending) < per_batch and waiting[0] not in included:
+            person = waiting.popleft()
+            start = count[person]
+            taken = queue[person][start:start + min(per_user, per_batch - len(sending))]
+            sending += taken
+            count[person] = start + len(taken)
+            included.add(person)
+            if count[person] < len(queue[person]):
+                waiting.append(person)
+        yield sending, count
+
+
+def plan_batches(queue, per_user=MAX_PER_USER, per_batch=MAX_PER_BATCH):
+    """
+    The batches that send_queue() would send for a set of queued messages, without sending anything.
+    :param queue: Dictionary of recipient to list of messages.
+    :param per_user: The maximum number of messages for one recipient in a batch.
+    :param per_batch: The maximum number of messages in a batch.
+    :return: List of batches, each a list of messages.
+    """
+    return [sending for sending, _ in _batches(queue, per_user, per_batch)]
+
+
+def _record_send(sending, start, outcome):
+    metrics.observe('feelsbot_kik_send_seconds', metrics.labels(outcome=outcome), time.perf_counter() - start)
+    metrics.observe('feelsbot_kik_batch_messages', '', len(sending))
+
+
 def error_handler(message_queue, e, queue, count, sending):
     """
     Error handler called in the event of problems sending the message batch.
@@ -129,10 +702,10 @@ def error_handler(message_queue, e, queue, count, sending):
     print("Sending: {}". format(sending))
     print(e)
     try:
-        message_queue.kik.send_messages(TextMessage(
+        message_queue.kik.send_messages([TextMessage(
             to=message_queue.config['admin'],
             body="Error encountered during message send. See apache logs for details."
-        ))
+        )])
         print("Admin notification sent.")
     except KikError:
         print("Admin notify failed.")
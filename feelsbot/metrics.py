@@ -0,0 +1,232 @@
+"""
+Counters and latency histograms for the hot paths of the bot, exposed in the Prometheus text format on /metrics.
+
+Measurements are gathered in memory by each process and added to the 'metrics' table every flush interval (and when
+/metrics is requested), so the totals reported by any worker cover every worker sharing the database. Measurements a
+worker has not flushed yet (at most one interval's worth) are not included.
+
+Disabled unless 'metrics_enabled' is set in the config, in which case nothing is measured at all.
+"""
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the histogram buckets for the number of messages in a batch sent to Kik (at most 25).
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 15, 20, 25)
+
+# Every metric: name to (type, help text, histogram buckets).
+METRICS = {
+    'feelsbot_http_requests_total': ('counter', "Webhook requests handled, by route and status code.", None),
+    'feelsbot_http_request_seconds': ('histogram', "Time taken to handle webhook requests, by route.",
+                                      LATENCY_BUCKETS),
+    'feelsbot_parser_handler_seconds': ('histogram', "Time taken by each parser handler function.", LATENCY_BUCKETS),
+    'feelsbot_db_query_seconds': ('histogram', "Time taken to execute each database query, by table and query.",
+                                  LATENCY_BUCKETS),
+    'feelsbot_select_random_feels_seconds': ('histogram', "Time taken to select random feels.", LATENCY_BUCKETS),
+    'feelsbot_kik_send_seconds': ('histogram', "Time taken by each call to send a batch of messages to Kik, by "
+                                               "outcome.", LATENCY_BUCKETS),
+    'feelsbot_kik_batch_messages': ('histogram', "Number of messages in each batch sent to Kik.", BATCH_SIZE_BUCKETS),
+}
+
+# Seconds between each process adding its measurements to the table, unless overridden by 'metrics_flush_interval'.
+FLUSH_INTERVAL_DEFAULT = 10
+
+_registry = None
+
+
+class Registry:
+    """
+    The measurements made by this process since they were last flushed to the table.
+
+    Values are held as deltas keyed by (metric name, label string, series), the series being '' for a counter and
+    the bucket bound, 'sum' or 'count' for a histogram.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def _add(self, key, value):
+        self._pending[key] = self._pending.get(key, 0) + value
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            self._add((name, labels, ''), value)
+
+    def observe(self, name, labels, value):
+        bound = '+Inf'
+        for upper in METRICS[name][2]:
+            if value <= upper:
+                bound = repr(upper)
+                break
+        with self._lock:
+            self._add((name, labels, bound), 1)
+            self._add((name, labels, 'sum'), value)
+            self._add((name, labels, 'count'), 1)
+
+    def flush(self):
+        """
+        Add the pending measurements to the table. Must not be called within a request session, as it writes through a
+        connection of its own. If the table cannot be written, the measurements are kept for the next attempt.
+        :return: Nothing.
+        """
+        # Imported here as the database package itself records query times through this module.
+        from .database import MetricsTable
+
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._flushed_at = time.monotonic()
+        if len(pending) == 0:
+            return
+        try:
+            with MetricsTable(autocommit=True) as table:
+                table.add([key + (value,) for key, value in pending.items()])
+        except Exception as e:
+            print("Unable to store metrics: {}".format(e))
+            with self._lock:
+                for key, value in pending.items():
+                    self._add(key, value)
+
+    def flush_due(self):
+        return time.monotonic() - self._flushed_at >= self.flush_interval
+
+
+def configure(config):
+    """
+    Enable or disable measurements as set in the configuration.
+    :param config: The application configuration.
+    :return: Nothing.
+    """
+    global _registry
+    if config.get('metrics_enabled', False):
+        if _registry is None:
+            atexit.register(flush)
+        _registry = Registry(float(config.get('metrics_flush_interval', FLUSH_INTERVAL_DEFAULT)))
+    else:
+        _registry = None
+
+
+def enabled():
+    """
+    :return: Whether measurements are being recorded.
+    """
+    return _registry is not None
+
+
+def labels(**values):
+    """
+    Format labels for a measurement.
+    :param values: The label names and values.
+    :return: The label string, as written within the braces of the Prometheus format.
+    """
+    return ','.join('{}="{}"'.format(name, _escape(value)) for name, value in sorted(values.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def inc(name, label_string='', value=1):
+    """
+    Increase a counter.
+    :param name: The metric name, a key of METRICS.
+    :param label_string: The labels, from labels().
+    :param value: The amount to add.
+    :return: Nothing.
+    """
+    if _registry is not None:
+        _registry.inc(name, label_string, value)
+
+
+def observe(name, label_string, value):
+    """
+    Record a value in a histogram.
+    :param name: The metric name, a key of METRICS.
+    :param label_string: The labels, from labels().
+    :param value: The value observed (seconds, for the latency histograms).
+    :return: Nothing.
+    """
+    if _registry is not None:
+        _registry.observe(name, label_string, value)
+
+
+@contextmanager
+def timer(name, label_string=''):
+    """
+    Context manager recording the time taken by the block in a latency histogram, even if it raises.
+    :param name: The metric name, a key of METRICS.
+    :param label_string: The labels, from labels().
+    """
+    if _registry is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _registry.observe(name, label_string, time.perf_counter() - start)
+
+
+def maybe_flush():
+    """
+    Flush this process's measurements to the table if the flush interval has passed. Called after each request has
+    been handled, outside of its request session.
+    :return: Nothing.
+    """
+    if _registry is not None and _registry.flush_due():
+        _registry.flush()
+
+
+def flush():
+    """
+    Flush this process's measurements to the table now.
+    :return: Nothing.
+    """
+    if _registry is not None:
+        _registry.flush()
+
+
+def render():
+    """
+    Flush this process's measurements, then report the totals of every process in the Prometheus text format.
+    :return: The text of the report.
+    """
+    from .database import MetricsTable
+
+    flush()
+    series = {}
+    with MetricsTable() as table:
+        for name, label_string, key, value in table.select_all():
+            series.setdefault(name, {}).setdefault(label_string, {})[key] = value
+
+    lines = []
+    for name, (kind, description, buckets) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(name, description))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for label_string, values in sorted(series.get(name, {}).items()):
+            if kind == 'counter':
+                lines.append('{}{} {}'.format(name, _braces(label_string), _number(values.get('', 0))))
+                continue
+            cumulative = 0
+            for bound in [repr(upper) for upper in buckets] + ['+Inf']:
+                cumulative += values.get(bound, 0)
+                bucket_labels = ','.join(part for part in (label_string, 'le="{}"'.format(bound)) if part)
+                lines.append('{}_bucket{{{}}} {}'.format(name, bucket_labels, _number(cumulative)))
+            lines.append('{}_sum{} {}'.format(name, _braces(label_string), repr(float(values.get('sum', 0)))))
+            lines.append('{}_count{} {}'.format(name, _braces(label_string), _number(values.get('count', 0))))
+    return '\n'.join(lines) + '\n'
+
+
+def _braces(label_string):
+    return '{' + label_string + '}' if label_string else ''
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
@@ -1,6 +1,9 @@
+import itertools
+
 from kik.messages import TextResponse
 
-from .database import FeelsTable, UserStatusTable
+from . import metrics, profiler
+from .database import FeelsTable, SubscribersTable, UserStatusTable
 
 
 SOURCE_ADMIN = {
@@ -24,28 +27,87 @@ SOURCE_RECIPIENT = {
 }
 
 
+# Number of feels listed on each page when reviewing those awaiting approval, unless overridden by
+# 'moderation_page_size' in the config.
+MODERATION_PAGE_SIZE_DEFAULT = 10
+# Longest part of each comment shown in a review listing.
+MODERATION_PREVIEW_LENGTH = 300
+
+
 class MessageParser:
+    """
+    Entry point for parsing messages. Holds only configuration and the shared message queue, so a single parser can be
+    used by concurrent requests: everything about the message being handled lives in a ParseContext created for it.
+    """
+
     def __init__(self, config, queue):
         self.config = config
         self.queue = queue
-        self.message = None
 
-    def process_text_message(self, message):
+    def context(self, message=None, queue=None):
+        """
+        Create the context for handling one message (or one trigger with no message).
+        :param message: The message being processed, if any.
+        :param queue: Where replies are queued, normally a per-request MessageQueue.pending(); defaults to the shared
+        queue.
+        :return: A new ParseContext.
+        """
+        return ParseContext(self.config, self.queue if queue is None else queue, message)
+
+    def process_text_message(self, message, queue=None):
         """
         Process a received message, generating an appropriate response.
         :param message: The message object to process, should be an instance of TextMessage.
+        :param queue: Where the replies are queued (see context()).
         :return: Status code indicating the result of parsing the message.
         """
+        return self.context(message, queue).process()
+
+    def queue_feel(self, source, count=1, queue=None):
+        """
+        Queue random feels for the recipient, see ParseContext.queue_feel().
+        :param source: The trigger source, one of the keys of SOURCE_ADMIN / SOURCE_RECIPIENT.
+        :param count: The number of feels to send.
+        :param queue: Where the messages are queued (see context()).
+        :return: Nothing.
+        """
+        self.context(queue=queue).queue_feel(source, count)
+
+
+class ParseContext:
+    """
+    Everything needed while handling a single message: the message itself and where replies are queued. The handler
+    functions below are each given the context for the message they are handling.
+    """
+
+    def __init__(self, config, queue, message=None):
+        self.config = config
+        self.queue = queue
         self.message = message
+        # What is known about the sender, kept current as the handler changes it, so the reply's keyboard can be chosen
+        # without reading any of it back from the database.
+        self.admin = False
+        self.recipient = False
+        self.state = STATE_DEFAULT
 
+    def process(self):
+        """
+        Process the message for this context, generating an appropriate response.
+        :return: Status code indicating the result of parsing the message.
+        """
+        message = self.message
         func = None
-        admin = self._test_admin(message.from_user)
-        recipient = self._test_recipient(message.from_user)
+        admin = self.admin = self._test_admin(message.from_user)
+        recipient = self.recipient = self._test_recipient(message.from_user)
 
         if not (admin or recipient):
-            func = user_invalid
+            if self._subscriptions_open() and message.body == BUTTONS['subscribe']:
+                func = user_subscribe
+            else:
+                func = user_invalid
         else:
             state, data = self.user_state()
+            self.state = state
             if state in STATUS_CUSTOM_MESSAGES.keys():
                 func = STATUS_CUSTOM_MESSAGES.get(state)
             else:
@@ -67,14 +129,17 @@ class MessageParser:
             else:
                 func = recipient_unknown_command
 
-        body, code = func(self)
+        with metrics.timer('feelsbot_parser_handler_seconds', metrics.labels(handler=func.__name__)):
+            if profiler.enabled():
+                body, code = profiler.call_handler(func, self, self.state)
+            else:
+                body, code = func(self)
         if code == 0:
             code = 200
         else:
             keyboard = self._current_keyboard()
             self._add_message(body, keyboard)
 
-        self.message = None
         return code
 
     def _add_message(self, body, keyboards):
@@ -86,15 +151,22 @@ class MessageParser:
         self.queue.add_message(to=self.message.from_user, chat_id=self.message.chat_id, body=body, keyboards=keyboards)
 
     def recipient_message(self, body):
-        to = self.config['recipient']
-        keyboard = self.current_user_keyboard(to)
-        self.queue.add_message(to=to, body=body, keyboards=keyboard)
+        """
+        Queue a message for every subscriber.
+        :param body: The text of the message.
+        :return: Nothing.
+        """
+        self.queue.add_broadcast([body], self.subscriber_keyboard)
 
     def _test_admin(self, user):
         return self.config['admin'] == user
 
     def _test_recipient(self, user):
-        return self.config['recipient'] == user
+        with SubscribersTable() as table:
+            return table.is_active(user)
+
+    def _subscriptions_open(self):
+        return bool(self.config.get('subscriptions_open', False))
 
     def user_state(self, user=None):
         """
@@ -116,6 +188,7 @@ class MessageParser:
         """
         with UserStatusTable() as table:
             table.update(self.message.from_user, state, data)
+        self.state = state
 
     def default_state(self):
         """
@@ -126,58 +199,113 @@ class MessageParser:
 
     def _current_keyboard(self):
         """
-        Shortcut helper method
-        :return:
+        The keyboard for a reply to the sender of the current message, from what the context already knows of them.
+        :return: Tuple of the keyboard responses.
         """
-        return self.current_user_keyboard(self.message.from_user)
-
-    def current_user_keyboard(self, user):
-        keyboard = keyboard_basic()
-        state, data = self.user_state(user)
-        admin = self._test_admin(user)
-        recipient = self._test_recipient(user)
-
-        if recipient:
-            if state in KEYBOARDS_RECIPIENT.keys():
-                func = KEYBOARDS_RECIPIENT.get(state)
-                keyboard += func()
-            else:
-                keyboard += keyboard_recipient_default()
+        return keyboard_for(self.state, self.admin, self.recipient, self._subscriptions_open())
 
-        if admin:
-            if state in KEYBOARDS_ADMIN.keys():
-                func = KEYBOARDS_ADMIN.get(state)
-                keyboard += func()
-            else:
-                keyboard += keyboard_admin_default()
+    def current_user_keyboard(self, user, state=None):
+        """
+        The keyboard for a message to any user.
+        :param user: The Kik username of the user.
+        :param state: The user's current state, if the caller already knows it; otherwise it is looked up.
+        :return: Tuple of the keyboard responses.
+        """
+        if self.message is not None and user == self.message.from_user:
+            return self._current_keyboard()
+        if state is None:
+            state, data = self.user_state(user)
+        return keyboard_for(state, self._test_admin(user), self._test_recipient(user), self._subscriptions_open())
 
-        return keyboard
+    def subscriber_keyboard(self, user):
+        """
+        The keyboard for a message broadcast to a subscriber. Called once per subscriber, so it avoids looking up the
+        user's state where the keyboard cannot depend on it.
+        :param user: The Kik username of the subscriber.
+        :return: Tuple of the keyboard responses.
+        """
+        if len(KEYBOARDS_RECIPIENT) == 0 and not self._test_admin(user):
+            return keyboard_for(STATE_DEFAULT, recipient=True)
+        return self.current_user_keyboard(user)
 
-    def queue_feel(self, source):
+    def review_page(self, after=0, note=None):
+        """
+        List a page of the feels awaiting approval for the admin to approve or block together, and put the admin in the
+        review state for that page. Once past the last page, starts again from the first (i.e. any feels skipped).
+        :param after: The last feel id of the previous page, 0 for the first page.
+        :param note: Text to show before the listing, e.g. the outcome of acting on the previous page.
+        :return: Tuple of the reply and status code, as returned by the handler functions.
+        """
+        size = max(1, int(self.config.get('moderation_page_size', MODERATION_PAGE_SIZE_DEFAULT)))
         with FeelsTable() as table:
-            feel = table.select_random_feel()
+            feels = table.select_unapproved_page(after, size)
+            if len(feels) == 0 and after > 0:
+                feels = table.select_unapproved_page(0, size)
+
+        lines = [] if note is None else [note]
+        if len(feels) == 0:
+            self.change_state(STATE_ADMIN_STATUS_REQUEST)
+            return '\n\n'.join(lines + [REPLIES['admin_review_done']]), 200
+
+        lines.append(REPLIES['admin_review_page'].format(len(feels)))
+        for feel in feels:
+            comment = feel['comment']
+            if len(comment) > MODERATION_PREVIEW_LENGTH:
+                comment = comment[:MODERATION_PREVIEW_LENGTH].rstrip() + u'\u2026'
+            lines.append("#{} {} ({}):\n{}".format(feel['feel_id'], feel['name'], feel['submitted'], comment))
+        lines.append(REPLIES['admin_review_help'])
+        self.change_state(STATE_ADMIN_REVIEW_PENDING, {'ids': [feel['feel_id'] for feel in feels],
+                                                       'after': feels[-1]['feel_id']})
+        return '\n\n'.join(lines), 200
+
+    def queue_feel(self, source, count=1, recipient=None):
+        """
+        Select random feels and queue them for every subscriber (or for one user), with a notification of each for the
+        admin.
+        :param source: The trigger source, one of the keys of SOURCE_ADMIN / SOURCE_RECIPIENT.
+        :param count: The number of feels to send. They are all selected together in one transaction.
+        :param recipient: The Kik username of the only user to send the feels to, e.g. the subscriber asking for more;
+        None to send them to every subscriber.
+        :return: Nothing.
+        """
+        with FeelsTable() as table:
+            feels = table.select_random_feels(count)
+
+        if len(feels) == 0:
+            return
 
-        msg = u"\n\n{}\n\u00A0  \u2015{} ({})".format(feel['comment'], feel['name'], feel['submitted'])
-        body_notify = SOURCE_ADMIN[source] + msg
-        body_message = SOURCE_RECIPIENT[source] + msg
+        keyboard_admin = self.current_user_keyboard(self.config['admin'])
 
-        self.queue.add_message(to=self.config['admin'],
-                               body=body_notify,
-                               keyboards=self.current_user_keyboard(self.config['admin']))
+        bodies = []
+        for feel in feels:
+            msg = u"\n\n{}\n\u00A0  \u2015{} ({})".format(feel['comment'], feel['name'], feel['submitted'])
+            body_notify = SOURCE_ADMIN[source] + msg
+            bodies.append(SOURCE_RECIPIENT[source] + msg)
 
-        self.queue.add_message(to=self.config['recipient'],
-                               body=body_message,
-                               keyboards=self.current_user_keyboard(self.config['recipient']))
+            self.queue.add_message(to=self.config['admin'],
+                                   body=body_notify,
+                                   keyboards=keyboard_admin)
+
+        if recipient is not None:
+            sender = self.message is not None and recipient == self.message.from_user
+            keyboard = self.current_user_keyboard(recipient)
+            for body in bodies:
+                self.queue.add_message(to=recipient, body=body, chat_id=self.message.chat_id if sender else None,
+                                       keyboards=keyboard)
+            return
+
+        # The subscribers are streamed in chunks when the messages are sent, rather than all being queued here.
+        self.queue.add_broadcast(bodies, self.subscriber_keyboard)
 
 
 # ======================================================================================================================
 
 
-def zapier_error_handler(parser, response, source):
+def zapier_error_handler(context, response, source):
     """
     Error handler used by the functions called by the parser when interacting with Zapier. Specifically, if there is an
     error code returned from a push request to the server.
-    :param parser: Reference to the parser object currently processing a message.
+    :param context: The context of the message currently being processed.
     :param response: The server response as a
     :param source:
     :return:
@@ -185,136 +313,203 @@ def zapier_error_handler(parser, response, source):
     print("Error with posting to Zapier from {}.".format(source))
     print("Full response:\n{}".format(response))
     print("Requesting admin notification.")
-    parser.queue.add_message(to=parser.config['admin'],
-                             body="Error with request to Zapier. See Apache logs for details.")
-    parser.queue.send_all()
+    context.queue.add_message(to=context.config['admin'],
+                              body="Error with request to Zapier. See Apache logs for details.")
+    context.queue.send_all()
 
 
 # ======================================================================================================================
 
 
-def user_invalid(parser):
-    # Avoid IDE throwing up warning about not using parser parameter.
+def user_invalid(context):
+    # Avoid IDE throwing up warning about not using context parameter.
     # Will also not generate database entry as no update to the sate was triggered.
-    parser.user_state()
+    context.user_state()
     return REPLIES['invalid_user'], 200
 
 
-def admin_error(parser):
-    parser.default_state()
+def admin_error(context):
+    context.default_state()
     return REPLIES['admin_error'], 200
 
 
-def admin_reset(parser):
-    parser.change_state(STATE_DEFAULT)
+def admin_reset(context):
+    context.change_state(STATE_DEFAULT)
     return REPLIES['admin_reset'], 200
 
 
-def admin_unknown_command(parser):
-    parser.default_state()
+def admin_unknown_command(context):
+    context.default_state()
     return REPLIES['admin_unknown_command'], 200
 
 
-def recipient_reset(parser):
-    parser.change_state(STATE_DEFAULT)
+def recipient_reset(context):
+    context.change_state(STATE_DEFAULT)
     return REPLIES['recipient_reset'], 200
 
 
-def recipient_unknown_command(parser):
-    parser.default_state()
+def recipient_unknown_command(context):
+    context.default_state()
     return REPLIES['recipient_unknown_command'], 200
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def admin_send_feel(parser):
-    parser.queue_feel('admin')
+def admin_send_feel(context):
+    context.queue_feel('admin')
     return None, 0
 
 
-def admin_send_manual(parser):
-    parser.change_state(STATE_ADMIN_MANUAL_MESSAGE)
+def admin_send_manual(context):
+    context.change_state(STATE_ADMIN_MANUAL_MESSAGE)
     return REPLIES['admin_send_manual'], 200
 
 
-def admin_manual_message(parser):
-    msg = parser.message.body
-    parser.change_state(STATE_ADMIN_MANUAL_CONFIRM, msg)
+def admin_manual_message(context):
+    msg = context.message.body
+    context.change_state(STATE_ADMIN_MANUAL_CONFIRM, msg)
     return REPLIES['admin_confirm_manual'], 200
 
 
-def admin_manual_confirm(parser):
-    state, msg = parser.user_state()
+def admin_manual_confirm(context):
+    state, msg = context.user_state()
     if state != STATE_ADMIN_MANUAL_CONFIRM:
-        return admin_error(parser)
+        return admin_error(context)
 
-    to = parser.config['recipient']
-    parser.queue.add_message(to=to, body=msg, keyboards=parser.current_user_keyboard(to))
-    parser.default_state()
+    context.recipient_message(msg)
+    context.default_state()
     return REPLIES['admin_manual_sent'], 200
 
 
-def admin_status(parser):
+def admin_status(context):
     with FeelsTable() as table:
         msg = "Total feels: {}\nAwaiting approval: {}\nBlocked: {}"
-        msg = msg.format(table.count_all(), table.count_need_approval(), table.count_blocked())
-    parser.change_state(STATE_ADMIN_STATUS_REQUEST)
+        msg = msg.format(*table.counts())
+    context.change_state(STATE_ADMIN_STATUS_REQUEST)
     return msg, 200
 
 
-def admin_approve_new(parser):
+def admin_approve_new(context):
     with FeelsTable() as table:
-        if table.count_need_approval() < 1:
-            return admin_error(parser)
         feel = table.select_unapproved()
-        msg = "From: {}\nDate: {}\nComment:\n{}".format(feel['name'], feel['submitted'], feel['comment'])
-    parser.change_state(STATE_ADMIN_APPROVE_MESSAGE, feel['feel_id'])
+    if feel is None:
+        return admin_error(context)
+    msg = "From: {}\nDate: {}\nComment:\n{}".format(feel['name'], feel['submitted'], feel['comment'])
+    context.change_state(STATE_ADMIN_APPROVE_MESSAGE, feel['feel_id'])
     return msg, 200
 
 
-def admin_approve(parser):
-    state, feel_id = parser.user_state()
+def admin_approve(context):
+    state, feel_id = context.user_state()
     if state != STATE_ADMIN_APPROVE_MESSAGE:
-        return admin_error(parser)
+        return admin_error(context)
 
     with FeelsTable() as table:
         table.approve(feel_id)
-    parser.change_state(STATE_ADMIN_STATUS_REQUEST)
+    context.change_state(STATE_ADMIN_STATUS_REQUEST)
     return REPLIES['admin_approve'], 200
 
 
-def admin_block(parser):
-    state, feel_id = parser.user_state()
+def admin_block(context):
+    state, feel_id = context.user_state()
     if state != STATE_ADMIN_APPROVE_MESSAGE:
-        return admin_error(parser)
+        return admin_error(context)
 
     with FeelsTable() as table:
         table.block(feel_id)
-    parser.change_state(STATE_ADMIN_STATUS_REQUEST)
+    context.change_state(STATE_ADMIN_STATUS_REQUEST)
     return REPLIES['admin_block'], 200
 
 
+def admin_review_pending(context):
+    return context.review_page()
+
+
+def admin_review_message(context):
+    """
+    Handle any message from the admin while reviewing a page of feels awaiting approval: the buttons to approve or
+    block the whole page or to move on to the next, or typed commands approving or blocking some of the feels shown
+    (e.g. 'block 12 15'). Other admin buttons leave the review.
+    """
+    state, page = context.user_state()
+    if state != STATE_ADMIN_REVIEW_PENDING:
+        return admin_error(context)
+    body = context.message.body
+    shown = page['ids']
+
+    if body == BUTTONS['admin_review_next']:
+        return context.review_page(page['after'])
+    if body == BUTTONS['admin_approve_shown']:
+        with FeelsTable() as table:
+            approved = table.approve_many(shown)
+        return context.review_page(page['after'], REPLIES['admin_approved_many'].format(approved))
+    if body == BUTTONS['admin_block_shown']:
+        with FeelsTable() as table:
+            blocked = table.block_many(shown)
+        return context.review_page(page['after'], REPLIES['admin_blocked_many'].format(blocked))
+    if body in MESSAGES_ADMIN:
+        return MESSAGES_ADMIN[body](context)
+
+    words = body.lower().replace(',', ' ').replace('#', ' ').split()
+    if len(words) < 2 or words[0] not in ('approve', 'block'):
+        return REPLIES['admin_review_help'], 200
+    try:
+        selected = [feel_id for feel_id in (int(word) for word in words[1:]) if feel_id in shown]
+    except ValueError:
+        return REPLIES['admin_review_help'], 200
+    if len(selected) == 0:
+        return REPLIES['admin_review_not_shown'], 200
+
+    with FeelsTable() as table:
+        if words[0] == 'approve':
+            note = REPLIES['admin_approved_many'].format(table.approve_many(selected))
+        else:
+            note = REPLIES['admin_blocked_many'].format(table.block_many(selected))
+    remaining = [feel_id for feel_id in shown if feel_id not in selected]
+    if len(remaining) == 0:
+        return context.review_page(page['after'], note)
+    context.change_state(STATE_ADMIN_REVIEW_PENDING, {'ids': remaining, 'after': page['after']})
+    return note + ' ' + REPLIES['admin_review_remaining'].format(len(remaining)), 200
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def recipient_request_feel(parser):
-    parser.queue_feel('recipient')
+def recipient_request_feel(context):
+    context.queue_feel('recipient', recipient=context.message.from_user)
     return None, 0
 
 
+def recipient_unsubscribe(context):
+    with SubscribersTable() as table:
+        table.unsubscribe(context.message.from_user)
+    context.recipient = False
+    context.default_state()
+    return REPLIES['recipient_unsubscribed'], 200
+
+
+def user_subscribe(context):
+    with SubscribersTable() as table:
+        table.subscribe(context.message.from_user)
+    context.recipient = True
+    context.default_state()
+    return REPLIES['user_subscribed'], 200
+
+
 # ======================================================================================================================
 
 
-def keyboard_basic():
+def keyboard_basic(pending=False):
     """
     Create a basic keyboard. This will only have any responses that are applicable in all situations.
+    :param pending: Whether any feels are awaiting approval (as for every keyboard function).
     :return: An array with the responses that should be sent on the present message.
     """
     return []
 
 
-def keyboard_empty():
+def keyboard_empty(pending=False):
     """
     Create an explicitly empty keyboard.
     :return: An empty list.
@@ -322,7 +517,7 @@ def keyboard_empty():
     return []
 
 
-def keyboard_admin_default():
+def keyboard_admin_default(pending=False):
     """
     Create default keyboard responses that are sent to an admin user.
     :return: An array with the responses that should be sent on the present message.
@@ -334,24 +529,25 @@ def keyboard_admin_default():
     ]
 
 
-def keyboard_admin_status():
+def keyboard_admin_status(pending=False):
     """
     Keyboard for the system status report, allowing options related to the status.
+    :param pending: Whether any feels are awaiting approval, in which case approving them is offered.
     :return:
     """
     keyboard = []
-    with FeelsTable() as table:
-        if table.count_need_approval() > 0:
-            keyboard += [
-                TextResponse(BUTTONS['admin_approve_new']),
-            ]
+    if pending:
+        keyboard += [
+            TextResponse(BUTTONS['admin_approve_new']),
+            TextResponse(BUTTONS['admin_review_pending']),
+        ]
     keyboard += [
         TextResponse(BUTTONS['admin_reset']),
     ]
     return keyboard
 
 
-def keyboard_admin_approval():
+def keyboard_admin_approval(pending=False):
     """
     Keyboard for approving or blocking a new feels message.
     :return:
@@ -363,7 +559,20 @@ def keyboard_admin_approval():
     ]
 
 
-def keyboard_admin_confirm_manual():
+def keyboard_admin_review(pending=False):
+    """
+    Keyboard for reviewing a page of feels awaiting approval.
+    :return:
+    """
+    return [
+        TextResponse(BUTTONS['admin_approve_shown']),
+        TextResponse(BUTTONS['admin_block_shown']),
+        TextResponse(BUTTONS['admin_review_next']),
+        TextResponse(BUTTONS['admin_reset']),
+    ]
+
+
+def keyboard_admin_confirm_manual(pending=False):
     """
     Keyboard for confirming a manual message.
     :return:
@@ -374,12 +583,61 @@ def keyboard_admin_confirm_manual():
     ]
 
 
-def keyboard_recipient_default():
+def keyboard_recipient_default(pending=False):
     """
     Create keyboard responses that are sent to a message recipient.
     :return: An array with the responses that should be sent on the present message.
     """
-    return [TextResponse(BUTTONS['recipient_request_feel'])]
+    return [TextResponse(BUTTONS['recipient_request_feel']), TextResponse(BUTTONS['recipient_unsubscribe'])]
+
+
+def keyboard_subscribe(pending=False):
+    """
+    Keyboard for a user who is not subscribed, when anyone may subscribe.
+    :return:
+    """
+    return [TextResponse(BUTTONS['subscribe'])]
+
+
+def build_keyboards():
+    """
+    Build every keyboard that can be sent, from the keyboard functions and maps below, so that no keyboard has to be
+    built (or the database read) for each message. Keyboards are tuples, shared by every message they are sent with.
+
+    Keyboards are keyed by (state, admin, recipient, subscribe, pending): the user's state (None standing for any state
+    without a keyboard of its own), whether they are the admin, whether they are a subscriber, whether to offer
+    subscribing and whether any feels are awaiting approval.
+    :return: Dictionary of key to tuple of keyboard responses.
+    """
+    keyboards = {}
+    for state in [None] + sorted(set(KEYBOARDS_ADMIN) | set(KEYBOARDS_RECIPIENT)):
+        for admin, recipient, subscribe, pending in itertools.product((False, True), repeat=4):
+            keyboard = keyboard_basic(pending)
+            if recipient:
+                keyboard += KEYBOARDS_RECIPIENT.get(state, keyboard_recipient_default)(pending)
+            if admin:
+                keyboard += KEYBOARDS_ADMIN.get(state, keyboard_admin_default)(pending)
+            if subscribe and not (admin or recipient):
+                keyboard += keyboard_subscribe(pending)
+            keyboards[(state, admin, recipient, subscribe, pending)] = tuple(keyboard)
+    return keyboards
+
+
+def keyboard_for(state, admin=False, recipient=False, subscribe=False):
+    """
+    Look up the prebuilt keyboard for a user (see build_keyboards()).
+    The only thing read at the time is whether feels are awaiting approval, from a cached count, and only for the admin
+    keyboards that depend on it.
+    :param state: The user's current state.
+    :param admin: Whether the user is the admin.
+    :param recipient: Whether the user is a subscriber.
+    :param subscribe: Whether anyone may subscribe.
+    :return: Tuple of the keyboard responses.
+    """
+    if state not in KEYBOARD_STATES:
+        state = None
+    pending = admin and state in KEYBOARD_PENDING_STATES and FeelsTable.cached_need_approval() > 0
+    return KEYBOARDS[(state, admin, recipient, subscribe, pending)]
 
 
 # ======================================================================================================================
@@ -391,6 +649,7 @@ STATE_DEFAULT = 0
 
 STATE_ADMIN_STATUS_REQUEST = 100
 STATE_ADMIN_APPROVE_MESSAGE = 101
+STATE_ADMIN_REVIEW_PENDING = 102
 STATE_ADMIN_MANUAL_MESSAGE = 110
 STATE_ADMIN_MANUAL_CONFIRM = 111
 
@@ -399,29 +658,45 @@ STATE_RECIPIENT_SOMETHING = 500
 BUTTONS = {
     'admin_approve_new': 'Approve new feels',
     'admin_approve': 'Approve feel',
+    'admin_approve_shown': 'Approve all shown',
     'admin_block': 'Block feel',
+    'admin_block_shown': 'Block all shown',
     'admin_confirm_manual': 'Confirm manual message',
     'admin_reset': 'Return to Admin Menu',
+    'admin_review_next': 'Next page',
+    'admin_review_pending': 'Review pending feels',
     'admin_send_feel': 'Send feels',
     'admin_send_manual': 'Send manual message',
     'admin_status': 'System status',
     'recipient_request_feel': 'Get more feels',
     'recipient_reset': 'Return to Main Menu',
     'recipient_reset_alt': 'Cancel',
+    'recipient_unsubscribe': 'Unsubscribe',
+    'subscribe': 'Subscribe',
 }
 REPLIES = {
     'admin_approve': 'Message approved.',
+    'admin_approved_many': 'Approved {} feels.',
     'admin_block': 'Message blocked.',
+    'admin_blocked_many': 'Blocked {} feels.',
     'admin_confirm_manual': 'Are you certain you wish to send this message?',
     'admin_error': 'I cannot perform that function at the present time. (Invalid state.)',
     'admin_manual_sent': 'Manual message sent.',
     'admin_reset': 'What function do you require?',
+    'admin_review_done': 'No more feels awaiting approval.',
+    'admin_review_help': "Approve or block all of these with the buttons, or only some by typing e.g. 'block 12 15' "
+                         "or 'approve 7'.",
+    'admin_review_not_shown': 'None of those feels are on this page.',
+    'admin_review_page': 'Feels awaiting approval ({} shown):',
+    'admin_review_remaining': '{} feels still shown.',
     'admin_send_manual': 'Enter your custom message here:',
     'admin_unknown_command': 'That command is not recognised.',
     'invalid_user': 'You are not a recognised user for this bot. Sorry.',
     'recipient_unknown_command': "Sorry, I'm not smart enough to understand. Try looking for the response buttons or "
                                  "just tell me me '{}'.".format(BUTTONS['recipient_request_feel']),
-    'recipient_reset': 'What can I help you with?'
+    'recipient_reset': 'What can I help you with?',
+    'recipient_unsubscribed': "You won't be sent any more feels.",
+    'user_subscribed': "You're subscribed, so you'll be sent feels from now on.",
 }
 
 # Construct the message processing maps.
@@ -433,6 +708,7 @@ MESSAGES_ADMIN = {
     BUTTONS['admin_block']: admin_block,
     BUTTONS['admin_confirm_manual']: admin_manual_confirm,
     BUTTONS['admin_reset']: admin_reset,
+    BUTTONS['admin_review_pending']: admin_review_pending,
     BUTTONS['admin_send_feel']: admin_send_feel,
     BUTTONS['admin_send_manual']: admin_send_manual,
     BUTTONS['admin_status']: admin_status,
@@ -441,9 +717,11 @@ MESSAGES_RECIPIENT = {
     BUTTONS['recipient_request_feel']: recipient_request_feel,
     BUTTONS['recipient_reset']: recipient_reset,
     BUTTONS['recipient_reset_alt']: recipient_reset,
+    BUTTONS['recipient_unsubscribe']: recipient_unsubscribe,
 }
 STATUS_CUSTOM_MESSAGES = {
     STATE_ADMIN_MANUAL_MESSAGE: admin_manual_message,
+    STATE_ADMIN_REVIEW_PENDING: admin_review_message,
 }
 
 # Construct the keyboard processing maps.
@@ -453,8 +731,17 @@ KEYBOARDS_ADMIN = {
     STATE_ADMIN_APPROVE_MESSAGE: keyboard_admin_approval,
     STATE_ADMIN_MANUAL_CONFIRM: keyboard_admin_confirm_manual,
     STATE_ADMIN_MANUAL_MESSAGE: keyboard_empty,
+    STATE_ADMIN_REVIEW_PENDING: keyboard_admin_review,
     STATE_ADMIN_STATUS_REQUEST: keyboard_admin_status,
 }
 KEYBOARDS_RECIPIENT = {
 
 }
+
+# Every keyboard, built once (see build_keyboards()).
+KEYBOARDS = build_keyboards()
+KEYBOARD_STATES = set(KEYBOARDS_ADMIN) | set(KEYBOARDS_RECIPIENT)
+# States whose keyboards differ depending on whether feels are awaiting approval.
+KEYBOARD_PENDING_STATES = {state for state in KEYBOARD_STATES | {None}
+                           if KEYBOARDS[(state, True, False, False, False)] !=
+                           KEYBOARDS[(state, True, False, False, True)]}
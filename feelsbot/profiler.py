@@ -0,0 +1,227 @@
+"""
+Opt-in profiling of a sample of live requests, for finding where the time goes under real traffic.
+
+A fraction of requests (profile_rate) is profiled, either the whole of a Flask route or the parser handler for a
+message, and each profile is written to its own file in profile_dir:
+- 'cprofile' mode writes .pstats files, for use with pstats or snakeviz;
+- 'sample' mode samples the request's stack every profile_sample_interval seconds from a separate thread, which costs
+  the request far less, and writes .folded files of collapsed stacks, for use with flamegraph.pl or speedscope.
+Only the newest profile_max_files files are kept.
+
+Profiling can be limited to some routes (profile_routes, e.g. ["/message"]) and to messages from users in some parser
+states or handled by some handler functions (profile_states, e.g. [101] or ["admin_approve"]). It is disabled unless
+'profile_enabled' is set in the config, in which case nothing is added to requests at all.
+"""
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+# Defaults used for the profiling options not present in the configuration file.
+PROFILE_DEFAULTS = {
+    'profile_enabled': False,
+    # 'cprofile' or 'sample', see above.
+    'profile_mode': 'cprofile',
+    # Fraction of the eligible requests that are profiled.
+    'profile_rate': 0.01,
+    'profile_dir': 'profiles',
+    'profile_max_files': 200,
+    # Routes and parser states (or handler names) to profile; empty to profile any.
+    'profile_routes': [],
+    'profile_states': [],
+    'profile_sample_interval': 0.001,
+}
+
+_profiler = None
+_local = threading.local()
+
+
+class Profiler:
+    def __init__(self, options):
+        self.mode = options['profile_mode']
+        if self.mode not in ('cprofile', 'sample'):
+            raise ValueError("Unknown profile_mode '{}', expected 'cprofile' or 'sample'.".format(self.mode))
+        self.rate = float(options['profile_rate'])
+        self.directory = options['profile_dir']
+        self.max_files = int(options['profile_max_files'])
+        self.routes = set(options['profile_routes'])
+        self.states = set(str(state) for state in options['profile_states'])
+        self.interval = float(options['profile_sample_interval'])
+        self._lock = threading.Lock()
+        # Held while a cProfile is active, see start().
+        self._cprofile_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def wants(self, targets, allowed):
+        """
+        Decide whether to profile something.
+        :param targets: The names it may be selected by (e.g. a route, or a parser state and handler name).
+        :param allowed: The names selected in the config; empty to select anything.
+        :return: True if it should be profiled.
+        """
+        if getattr(_local, 'active', False):
+            # Already within a profiled route; profiles cannot be nested.
+            return False
+        if allowed and not any(str(target) in allowed for target in targets):
+            return False
+        return random.random() < self.rate
+
+    def start(self):
+        """
+        Start profiling the current thread. Only one cProfile can be active in a process (enforced from Python 3.12),
+        so in 'cprofile' mode a request that overlaps one already being profiled is not sampled.
+        :return: The running profile, to be passed to stop(), or None if it could not be started.
+        """
+        if self.mode == 'cprofile':
+            if not self._cprofile_lock.acquire(blocking=False):
+                return None
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) is active.
+                self._cprofile_lock.release()
+                return None
+            _local.active = True
+            return profile
+        _local.active = True
+        sampler = _StackSampler(threading.get_ident(), self.interval)
+        sampler.start()
+        return sampler
+
+    def stop(self, profile, name):
+        """
+        Stop a profile and write it to a file.
+        :param profile: The profile returned by start().
+        :param name: Description of what was profiled, used in the file name.
+        :return: Nothing.
+        """
+        _local.active = False
+        if self.mode == 'cprofile':
+            profile.disable()
+            self._cprofile_lock.release()
+        else:
+            profile.stop()
+        try:
+            self._write(profile, name)
+        except OSError as e:
+            print("Unable to write profile: {}".format(e))
+
+    def _write(self, profile, name):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        base = '{}-{:06d}-{}-{}'.format(stamp, int(time.time() * 1000000) % 1000000, os.getpid(),
+                                        re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_'))
+        if self.mode == 'cprofile':
+            profile.dump_stats(os.path.join(self.directory, base + '.pstats'))
+        else:
+            with open(os.path.join(self.directory, base + '.folded'), 'w') as output:
+                for stack, count in profile.stacks.items():
+                    output.write('{} {}\n'.format(stack, count))
+        self._rotate()
+
+    def _rotate(self):
+        with self._lock:
+            files = sorted(entry for entry in os.listdir(self.directory)
+                           if entry.endswith('.pstats') or entry.endswith('.folded'))
+            for entry in files[:max(0, len(files) - self.max_files)]:
+                try:
+                    os.remove(os.path.join(self.directory, entry))
+                except OSError:
+                    pass
+
+
+class _StackSampler:
+    """
+    Thread recording the stack of another thread at regular intervals, as counts of collapsed stacks
+    ('outermost;...;innermost' function names).
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='feelsbot-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+
+def configure(config):
+    """
+    Enable or disable profiling as set in the configuration.
+    :param config: The application configuration.
+    :return: Nothing.
+    """
+    global _profiler
+    options = dict(PROFILE_DEFAULTS)
+    options.update((key, config[key]) for key in PROFILE_DEFAULTS if key in config)
+    _profiler = Profiler(options) if options['profile_enabled'] else None
+
+
+def enabled():
+    """
+    :return: Whether profiling is enabled, so that callers can skip the hooks entirely when it is not.
+    """
+    return _profiler is not None
+
+
+def start_route(route):
+    """
+    Start profiling a request to a route, if it is selected.
+    :param route: The route handling the request.
+    :return: The running profile, or None if the request is not being profiled.
+    """
+    if _profiler is None or not _profiler.wants([route], _profiler.routes):
+        return None
+    return _profiler.start()
+
+
+def stop_route(profile, route):
+    """
+    Stop a profile started by start_route() and write it out.
+    :param profile: The running profile.
+    :param route: The route handling the request.
+    :return: Nothing.
+    """
+    _profiler.stop(profile, 'route-' + route)
+
+
+def call_handler(func, context, state):
+    """
+    Call a parser handler function, profiling it if it is selected.
+    :param func: The handler function.
+    :param context: The ParseContext to call it with.
+    :param state: The state of the user that sent the message.
+    :return: Whatever the handler returns.
+    """
+    if _profiler is None or not _profiler.wants([state, func.__name__], _profiler.states):
+        return func(context)
+    profile = _profiler.start()
+    if profile is None:
+        return func(context)
+    try:
+        return func(context)
+    finally:
+        _profiler.stop(profile, 'state-{}-{}'.format(state, func.__name__))
@@ -0,0 +1,52 @@
+import time
+
+from .database import RateLimitTable
+
+
+# Defaults used for the rate limiting options not present in the configuration file.
+RATE_LIMIT_DEFAULTS = {
+    # Messages per second (and the burst allowed above that) for each recipient.
+    'rate_limit_user_rate': 1.0,
+    'rate_limit_user_burst': 5,
+    # Messages per second (and burst) across all recipients.
+    'rate_limit_global_rate': 50.0,
+    'rate_limit_global_burst': 100,
+    # Seconds after which unused buckets are deleted.
+    'rate_limit_idle': 3600,
+}
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits on sending, per recipient and globally.
+
+    The buckets are stored in the database, so every thread and process sending for the bot draws from the same
+    limits. A message is only sent once a token has been taken from both its recipient's bucket and the global bucket.
+    """
+
+    def __init__(self, options):
+        self.user_rate = float(options['rate_limit_user_rate'])
+        self.user_burst = float(options['rate_limit_user_burst'])
+        self.global_rate = float(options['rate_limit_global_rate'])
+        self.global_burst = float(options['rate_limit_global_burst'])
+        self.idle = float(options['rate_limit_idle'])
+        if min(self.user_rate, self.user_burst, self.global_rate, self.global_burst) <= 0:
+            raise ValueError("Rate limits must be greater than zero.")
+        self._last_purge = time.time()
+
+    def acquire(self, counts):
+        """
+        Take tokens for sending messages.
+        :param counts: List of (recipient, number of messages) pairs, in the order they should be served.
+        :return: Tuple of a dictionary with the number of messages that may be sent now for each recipient, and the
+        number of seconds to wait before trying again for the rest (0 if everything may be sent).
+        """
+        parents = [('global', self.global_rate, self.global_burst)]
+        requests = [('user:' + to, self.user_rate, self.user_burst, count, parents) for to, count in counts]
+        now = time.time()
+        with RateLimitTable(autocommit=True) as table:
+            granted, delay = table.take(requests, now)
+            if now - self._last_purge > self.idle:
+                self._last_purge = now
+                table.purge_idle(self.idle, now)
+        return {to: grant for (to, _), grant in zip(counts, granted)}, delay
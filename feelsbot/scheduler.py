@@ -0,0 +1,249 @@
+"""
+Built-in scheduler for timed sends of feels, in place of an external cron calling /message.
+
+Schedules are set in the configuration as a list under 'schedules', each with a 'name', an 'interval' in seconds, the
+number of feels to send each time ('count', default 1) and optionally a local 'start' time ('HH:MM') for the first
+run, e.g. {"name": "morning", "interval": 86400, "start": "09:00"}. They are stored in the 'schedules' table along
+with when each is next due, so a restart neither repeats nor skips ahead of a run. Runs missed while no process was
+running are made once, late, rather than once for every interval missed.
+
+Every process running the app starts a scheduler thread, but only the one holding the scheduler lease in the database
+runs schedules; if it stops renewing the lease another process takes over. The leader keeps the schedules in a heap
+ordered by due time and sleeps until the earliest is due. All the schedules due at once are sent together, as one
+trigger of the combined number of feels. Each run is recorded before its feels are sent, so a process dying at that
+moment loses the run rather than repeating it.
+
+Disabled unless 'scheduler_enabled' is set in the config.
+"""
+import atexit
+import datetime
+import heapq
+import os
+import threading
+import time
+import uuid
+
+from .database import LeasesTable, SchedulesTable, request_session
+
+
+# Defaults used for the scheduler options not present in the configuration file.
+SCHEDULER_DEFAULTS = {
+    'scheduler_enabled': False,
+    # Longest time in seconds the scheduler thread sleeps between renewing its lease and reloading the schedules.
+    'scheduler_poll_interval': 15,
+    # Seconds the leader's lease lasts without being renewed, after which another process may take over.
+    'scheduler_lease': 60,
+    'schedules': [],
+}
+
+LEASE_NAME = 'scheduler'
+
+
+def parse_schedules(schedules):
+    """
+    Check the schedules given in the configuration.
+    :param schedules: List of dictionaries, as described above.
+    :return: List of (name, interval, count, start) tuples.
+    :raises ValueError: If a schedule is not valid.
+    """
+    parsed = []
+    for schedule in schedules:
+        try:
+            name = str(schedule['name'])
+            interval = float(schedule['interval'])
+            count = int(schedule.get('count', 1))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each schedule needs a 'name' and a numeric 'interval': {}".format(schedule))
+        start = schedule.get('start')
+        if start is not None:
+            try:
+                datetime.datetime.strptime(start, '%H:%M')
+            except (TypeError, ValueError):
+                raise ValueError("Expected 'HH:MM' for the start of schedule '{}'.".format(name))
+        if interval <= 0 or count < 1:
+            raise ValueError("Schedule '{}' needs an interval above zero and a count of at least one.".format(name))
+        parsed.append((name, interval, count, start))
+    if len(set(schedule[0] for schedule in parsed)) != len(parsed):
+        raise ValueError("Schedule names must be unique.")
+    return parsed
+
+
+def first_run(interval, start, now=None):
+    """
+    :param interval: Seconds between runs.
+    :param start: Local time of day of the first run ('HH:MM'), or None to start one interval from now.
+    :param now: The current time, defaults to now.
+    :return: The time of the first run of a new (or changed) schedule.
+    """
+    now = time.time() if now is None else now
+    if start is None:
+        return now + interval
+    hour, minute = (int(part) for part in start.split(':'))
+    current = datetime.datetime.fromtimestamp(now)
+    run = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run <= current:
+        run += datetime.timedelta(days=1)
+    return run.timestamp()
+
+
+def next_run(due, interval, now):
+    """
+    :param due: The due time of the run being made.
+    :param interval: Seconds between runs.
+    :param now: The current time.
+    :return: The first due time after now, skipping any runs that were missed.
+    """
+    return due + interval * (int((now - due) // interval) + 1)
+
+
+class Scheduler:
+    """
+    Thread running the configured schedules, in whichever process holds the scheduler lease (see above).
+    """
+
+    def __init__(self, config, parser, queue):
+        """
+        :param config: The application configuration.
+        :param parser: The MessageParser used to queue feels.
+        :param queue: The MessageQueue used to send them.
+        """
+        options = dict(SCHEDULER_DEFAULTS)
+        if config is not None:
+            options.update((key, config[key]) for key in SCHEDULER_DEFAULTS if key in config)
+        self.enabled = bool(options['scheduler_enabled'])
+        self.poll_interval = float(options['scheduler_poll_interval'])
+        self.lease = float(options['scheduler_lease'])
+        self.schedules = parse_schedules(options['schedules'])
+        if self.lease <= self.poll_interval:
+            raise ValueError("scheduler_lease must be longer than scheduler_poll_interval.")
+        self.parser = parser
+        self.queue = queue
+        self.holder = uuid.uuid4().hex
+        self.leader = False
+        # Heap of (next_run, schedule_id, interval, count) for the enabled schedules, held while leading.
+        self._heap = []
+        self._loaded_at = None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def sync(self):
+        """
+        Store the configured schedules in the table (see SchedulesTable.sync()).
+        :return: Nothing.
+        """
+        with SchedulesTable() as table:
+            table.sync(self.schedules, first_run)
+
+    def ensure_started(self):
+        """
+        Start the scheduler thread for this process, if it is not already running.
+        :return: Nothing.
+        """
+        with self._lock:
+            # A thread does not survive a fork, so each process starts its own.
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                if self._thread is None:
+                    atexit.register(self.stop, self.poll_interval)
+                if self._pid != os.getpid():
+                    # A forked process must not share its parent's claim to the lease.
+                    self.holder = uuid.uuid4().hex
+                self._pid = os.getpid()
+                self._stopped.clear()
+                self.leader = False
+                self._thread = threading.Thread(target=self._run, name='feelsbot-scheduler', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the scheduler thread and give up the lease, so another process can lead straight away.
+        :param timeout: Maximum number of seconds to wait for a run in progress.
+        :return: Nothing.
+        """
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            self._thread.join(timeout)
+        if self.leader:
+            self.leader = False
+            try:
+                with LeasesTable(autocommit=True) as table:
+                    table.release(LEASE_NAME, self.holder)
+            except Exception as e:
+                print("Unable to release the scheduler lease: {}".format(e))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                wait = self.tick()
+            except Exception as e:
+                print("Unexpected error in scheduler: {}".format(e))
+                self._loaded_at = None
+                wait = self.poll_interval
+            self._stopped.wait(wait)
+
+    def tick(self, now=None):
+        """
+        Renew (or try to take) the lease and, if leading, run the schedules that are due.
+        :param now: The current time, defaults to now.
+        :return: Seconds until the next tick is needed.
+        """
+        now = time.time() if now is None else now
+        with LeasesTable(autocommit=True) as table:
+            leader = table.acquire(LEASE_NAME, self.holder, self.lease, now)
+        if leader != self.leader:
+            print("Scheduler {} leading in process {}.".format('now' if leader else 'no longer', os.getpid()))
+            self.leader = leader
+            self._loaded_at = None
+        if not leader:
+            self._heap = []
+            return self.poll_interval
+
+        # Reloaded regularly, to pick up schedules changed by other processes starting with a new configuration.
+        if self._loaded_at is None or now - self._loaded_at >= self.poll_interval:
+            self._load(now)
+
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap))
+        if due:
+            self.run(due, now)
+
+        if not self._heap:
+            return self.poll_interval
+        return max(0.0, min(self.poll_interval, self._heap[0][0] - time.time()))
+
+    def _load(self, now):
+        with SchedulesTable() as table:
+            self._heap = [(due, schedule_id, interval, count)
+                          for schedule_id, interval, count, due in table.select_active()]
+        heapq.heapify(self._heap)
+        self._loaded_at = now
+
+    def run(self, due, now):
+        """
+        Run schedules together: record each run, then queue and send the combined number of feels.
+        :param due: List of heap entries of the schedules that are due.
+        :param now: The current time.
+        :return: Nothing.
+        """
+        count = 0
+        changed = False
+        pending = self.queue.pending()
+        with request_session():
+            with SchedulesTable() as table:
+                for scheduled, schedule_id, interval, feels in due:
+                    following = next_run(scheduled, interval, now)
+                    if table.advance(schedule_id, scheduled, following, now):
+                        count += feels
+                        heapq.heappush(self._heap, (following, schedule_id, interval, feels))
+                    else:
+                        changed = True
+            if count > 0:
+                self.parser.queue_feel('schedule', count, pending)
+        if changed:
+            # Changed or run elsewhere; the table has the current due times.
+            self._loaded_at = None
+        if count > 0:
+            print("Scheduler sending {} feels for {} schedules.".format(count, len(due)))
+            pending.send_all()
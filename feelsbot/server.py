@@ -1,12 +1,19 @@
+import csv
 import json
+import threading
+import time
 
-from flask import Flask, request, Response
-from kik import KikApi, Configuration
+from flask import Flask, g, request, Response
+from kik import Configuration
+from kik.api import ROOT_URL
 from kik.messages import messages_from_json, TextMessage
 
-from .database import Database, FeelsTable
+from . import metrics, profiler, startup
+from .database import Database, FeelsTable, SeenMessagesTable, SubscribersTable, request_session
+from .kik_api import PooledKikApi
 from .message_queue import MessageQueue
 from .parser import MessageParser
+from .scheduler import Scheduler
 
 
 print("Begin server / WSGI initialisation")
@@ -17,6 +24,51 @@ kik = None
 # Doing initialisation here, so the IDE knows what the objects are
 queue = MessageQueue(None, None)
 parser = MessageParser(None, None)
+scheduler = Scheduler(None, None, None)
+
+# Configuration keys the app cannot run without.
+REQUIRED_CONFIG = ('database', 'bot_username', 'bot_api_key', 'webhook', 'admin', 'webhook_user', 'webhook_pass')
+
+startup.step('import')
+
+
+def validate_config(config):
+    """
+    Check the configuration once, as it is loaded, rather than failing on the first request that needs a missing key.
+    :param config: The loaded configuration.
+    :return: Nothing.
+    :raises ValueError: If the configuration is not usable.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("The configuration file must hold a json object.")
+    missing = [key for key in REQUIRED_CONFIG if not config.get(key)]
+    if missing:
+        raise ValueError("Missing from the configuration: {}".format(', '.join(missing)))
+    if not isinstance(config.get('recipients', []), list):
+        raise ValueError("'recipients' must be a list of user names.")
+
+
+def warm_up(kik_api, webhook):
+    """
+    Start up work deferred by fast_start, done in the background while the first requests are served: configure the
+    Kik webhook (leaving a connection to Kik open for the first sends), then open the database connections with their
+    queries prepared and load the feels caches.
+    :param kik_api: The PooledKikApi to configure.
+    :param webhook: The webhook URL to give Kik.
+    :return: Nothing.
+    """
+    started = time.perf_counter()
+    try:
+        kik_api.set_configuration(Configuration(webhook=webhook))
+    except Exception as e:
+        print("Unable to set the Kik configuration: {}".format(e))
+    try:
+        Database.warm_up()
+        with FeelsTable() as table:
+            table.preload()
+    except Exception as e:
+        print("Unable to warm up the database: {}".format(e))
+    print("Warm up took {:.0f} ms".format((time.perf_counter() - started) * 1000))
 
 
 def init_app(path):
@@ -25,98 +77,318 @@ def init_app(path):
     :param path: Location of the json configuration file for the application to be run.
     :return: The flask app object, to be used as the WSGI application.
     """
-    global config, kik, queue, parser
+    global config, kik, queue, parser, scheduler
 
+    startup.restart()
     with open(path) as config_file:
         config = json.load(config_file)
+    validate_config(config)
+    startup.step('config')
 
     Database.init_database(config)
-
-    kik = KikApi(config['bot_username'], config['bot_api_key'])
-    kik.set_configuration(Configuration(webhook=config['webhook']))
+    metrics.configure(config)
+    profiler.configure(config)
+    if profiler.enabled() and start_profile not in app.before_request_funcs.get(None, []):
+        # Only added when enabled, so that requests are not touched at all otherwise.
+        app.before_request(start_profile)
+        app.teardown_request(stop_profile)
+
+    # Recipients named in the configuration are subscribed, unless they have since unsubscribed.
+    with request_session():
+        with SubscribersTable() as table:
+            for recipient in ([config['recipient']] if 'recipient' in config else []) + config.get('recipients', []):
+                table.add(recipient)
+    startup.step('database')
+
+    kik = PooledKikApi(config['bot_username'], config['bot_api_key'],
+                       pool_size=config.get('message_queue_concurrency', 1),
+                       root_url=config.get('kik_api_url', ROOT_URL))
+    if config.get('fast_start', False):
+        # Requests are accepted straight away; Kik keeps the previous webhook configuration until this is done.
+        threading.Thread(target=warm_up, args=(kik, config['webhook']), name='feelsbot-warm-up', daemon=True).start()
+    else:
+        kik.set_configuration(Configuration(webhook=config['webhook']))
+    startup.step('kik')
     queue = MessageQueue(config, kik)
     parser = MessageParser(config, queue)
 
+    scheduler = Scheduler(config, parser, queue)
+    if scheduler.enabled:
+        scheduler.sync()
+        scheduler.ensure_started()
+        if start_scheduler not in app.before_request_funcs.get(None, []):
+            app.before_request(start_scheduler)
+    startup.step('scheduler')
+
+    startup.report()
     return app
 
 
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_timing(response):
+    if metrics.enabled():
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        record_request(route, response.status_code, time.perf_counter() - g.started)
+        # Stored once the response has been sent, so the client does not wait on it.
+        response.call_on_close(metrics.maybe_flush)
+    return response
+
+
+def start_scheduler():
+    # Restarts the scheduler thread in worker processes forked after init_app() (e.g. gunicorn --preload).
+    scheduler.ensure_started()
+
+
+def start_profile():
+    if request.url_rule is not None:
+        g.profile = profiler.start_route(request.url_rule.rule)
+
+
+def stop_profile(exception):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.stop_route(profile, request.url_rule.rule)
+
+
 @app.route('/')
 def hello_world():
-    with FeelsTable() as table:
-        return "Hello Developer World!\n" \
-               "<p>Total feels: {}</p>\n" \
-               "<p>Awaiting approval: {}</p>" \
-               "<p>Blocked: {}</p>".format(
-                    table.count_all(),
-                    table.count_need_approval(),
-                    table.count_blocked())
+    return status_page()
 
 
 @app.route('/incoming', methods=['POST'])
 def incoming():
-    if not kik.verify_signature(request.headers.get('X-Kik-Signature'), request.get_data()):
-        return Response(status=403, response="Unable to verify message signature.")
+    result, response, pending = receive_incoming(request)
+    if pending is None:
+        return Response(status=result, response=response)
+    return Response(status=finish_incoming(result, pending.send_all()))
 
-    messages = messages_from_json(request.json['messages'])
 
-    for message in messages:
-        if isinstance(message, TextMessage):
-            result = parser.process_text_message(message)
-            if result != 200:
-                qr = queue.send_all()
-                if qr != 200:
-                    incoming_error_handler(result, qr)
-                return Response(status=result)
+@app.route('/message', methods=['POST'])
+def zapier_trigger():
+    result, response, pending = receive_trigger(request)
+    if pending is None:
+        return Response(status=result, response=response)
 
-    # Note the function call to send_all().
     # As per documentation, send_all() returns an appropriate response code based upon success or failure.
-    return Response(status=queue.send_all())
+    return Response(status=pending.send_all())
 
 
-@app.route('/message', methods=['POST'])
-def zapier_trigger():
+@app.route('/new-feel', methods=['POST'])
+def zapier_new_feel():
+    result, response = receive_new_feel(request)
+    return Response(status=result, response=response)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    result, response = metrics_page(request)
+    return Response(status=result, response=response, content_type='text/plain; version=0.0.4')
+
+
+@app.route('/import-feels', methods=['POST'])
+def import_feels():
+    result, response = receive_import(request, request.stream)
+    return Response(status=result, response=response, content_type='application/json')
+
+
+# =================================================================================================================
+# Request handling shared by the Flask app above and the ASGI app (see asgi.py). These functions do all the database
+# work for a request, but leave sending the queued replies to the caller.
+# =================================================================================================================
+
+
+def status_page():
+    """
+    :return: The text of the status page.
+    """
+    with FeelsTable() as table:
+        return "Hello Developer World!\n" \
+               "<p>Total feels: {}</p>\n" \
+               "<p>Awaiting approval: {}</p>" \
+               "<p>Blocked: {}</p>".format(*table.counts())
+
+
+def record_request(route, status, seconds):
+    """
+    Record the handling of a request in the metrics.
+    :param route: The route that handled the request.
+    :param status: The response status code.
+    :param seconds: The time taken to handle the request.
+    :return: Nothing.
+    """
+    metrics.inc('feelsbot_http_requests_total', metrics.labels(route=route, status=status))
+    metrics.observe('feelsbot_http_request_seconds', metrics.labels(route=route), seconds)
+
+
+def metrics_page(req):
+    """
+    Report the metrics of every process, for /metrics (only when metrics are enabled).
+    :param req: The request (a werkzeug / Flask request object).
+    :return: Tuple of (status, response), the response being in the Prometheus text format.
+    """
+    if not metrics.enabled():
+        return 404, "Metrics are not enabled."
+    error = _check_webhook_auth(req)
+    if error is not None:
+        return error
+    return 200, metrics.render()
+
+
+def _check_webhook_auth(req):
+    """
+    :param req: The request (a werkzeug / Flask request object).
+    :return: Tuple of (status, response) if the request does not carry the webhook credentials, otherwise None.
+    """
     try:
-        auth = request.authorization
+        auth = req.authorization
         if auth.username != config['webhook_user'] or auth.password != config['webhook_pass']:
-            return Response(status=403, response="Invalid user name or password.")
+            return 403, "Invalid user name or password."
     except AttributeError:
-        return Response(status=401, response="Authorization required.")
+        return 401, "Authorization required."
+    return None
+
+
+def receive_incoming(req):
+    """
+    Verify and parse the messages posted by Kik to /incoming, queueing the replies.
+    :param req: The request (a werkzeug / Flask request object).
+    :return: Tuple of (status, response, pending): the status code from parsing the messages and the replies to send,
+    or an error status and response with pending None if the request was rejected.
+    """
+    if not kik.verify_signature(req.headers.get('X-Kik-Signature'), req.get_data()):
+        return 403, "Unable to verify message signature.", None
+
+    messages = messages_from_json(req.json['messages'])
+
+    # Replies are queued separately for each request, so concurrent requests cannot send each other's messages.
+    pending = queue.pending()
+
+    # All database work for the request shares one connection and is committed once, before anything is sent.
+    result = 200
+    with request_session():
+        # Kik redelivers messages when a response is slow or fails; a message already handled is acknowledged without
+        # processing it again. The ids are recorded first, so a concurrent redelivery waits for this request to finish.
+        fresh = []
+        with SeenMessagesTable() as table:
+            for message in messages:
+                if not isinstance(message, TextMessage):
+                    continue
+                if message.id is not None and not table.claim(message.id):
+                    print("Ignoring redelivered message {}.".format(message.id))
+                    continue
+                fresh.append(message)
+
+        for message in fresh:
+            result = parser.process_text_message(message, pending)
+            if result != 200:
+                break
+
+    return result, None, pending
+
+
+def finish_incoming(result, queue_result):
+    """
+    Work out the response to /incoming once the replies have been sent.
+    :param result: The status code from receive_incoming().
+    :param queue_result: The status code from sending the replies.
+    :return: The status code for the response.
+    """
+    if result != 200:
+        if queue_result != 200:
+            incoming_error_handler(result, queue_result)
+        return result
+
+    # Note that sending returns an appropriate response code based upon success or failure.
+    return queue_result
+
+
+def receive_trigger(req):
+    """
+    Handle a Zapier trigger posted to /message, queueing feels for the recipient.
+    :param req: The request (a werkzeug / Flask request object).
+    :return: Tuple of (status, response, pending) as for receive_incoming().
+    """
+    error = _check_webhook_auth(req)
+    if error is not None:
+        return error + (None,)
 
     try:
-        source = request.form['source']
+        source = req.form['source']
     except KeyError:
         source = 'unknown'
 
-    parser.queue_feel(source)
+    # Optional number of feels to send for this trigger (e.g. when a backlog of triggers is delivered at once).
+    try:
+        count = max(1, int(req.form.get('count', 1)))
+    except ValueError:
+        return 400, "Expected an integer for 'count'.", None
+
+    pending = queue.pending()
+    with request_session():
+        parser.queue_feel(source, count, pending)
 
-    # As above, note the function call to send_all().
-    return Response(status=queue.send_all())
+    return 200, None, pending
 
 
-@app.route('/new-feel', methods=['POST'])
-def zapier_new_feel():
-    try:
-        auth = request.authorization
-        if auth.username != config['webhook_user'] or auth.password != config['webhook_pass']:
-            return Response(status=403, response="Invalid user name or password.")
-    except AttributeError:
-        return Response(status=401, response="Authorization required.")
+def receive_new_feel(req):
+    """
+    Handle a new feel posted to /new-feel by Zapier, adding it to the database to await approval.
+    :param req: The request (a werkzeug / Flask request object).
+    :return: Tuple of (status, response).
+    """
+    error = _check_webhook_auth(req)
+    if error is not None:
+        return error
 
-    post = request.form
+    post = req.form
 
     try:
         submitted = post['submitted']
         name = post['name']
         comment = post['comment']
     except KeyError:
-        return Response(status=400,
-                        response="Expected post data for 'submitted', 'name' and 'comment' but POST request did not "
-                                 "contain one or more of these.")
+        return 400, "Expected post data for 'submitted', 'name' and 'comment' but POST request did not contain one " \
+                    "or more of these."
 
-    with FeelsTable() as table:
-        table.insert_feel(submitted, name, comment)
+    with request_session():
+        with FeelsTable() as table:
+            table.insert_feel(submitted, name, comment)
+
+    return 200, "New feel added and awaiting approval."
+
+
+def receive_import(req, stream):
+    """
+    Handle a bulk import posted to /import-feels: the body is a CSV or JSON lines file of feels (see importer.py), read
+    as it is imported. The format is given by a 'format' query parameter, or else by the content type.
+    :param req: The request (a werkzeug / Flask request object).
+    :param stream: Binary stream of the request body.
+    :return: Tuple of (status, response), the response being a json summary of the import.
+    """
+    # Imported here rather than at the top, so that 'python -m feelsbot.importer' does not import itself via server.
+    from .importer import guess_format, import_stream
+
+    error = _check_webhook_auth(req)
+    if error is not None:
+        return error[0], json.dumps({'error': error[1]})
+
+    fmt = req.args.get('format') or guess_format(req.content_type or '')
+    if fmt not in ('csv', 'jsonl'):
+        return 400, json.dumps({'error': "Expected a 'format' of csv or jsonl, or a matching content type."})
+
+    try:
+        chunk_size = req.args.get('chunk_size', type=int)
+        result = import_stream(stream, fmt, chunk_size)
+    except (UnicodeDecodeError, csv.Error) as e:
+        return 400, json.dumps({'error': "Unable to read the import: {}".format(e)})
 
-    return Response(status=200, response="New feel added and awaiting approval.")
+    print("Imported {} feels, rejected {} rows.".format(result.imported, result.rejected))
+    return 200, json.dumps(result.to_json())
 
 
 # =================================================================================================================
@@ -137,6 +409,7 @@ def incoming_error_handler(parser_result, queue_result):
     print("Multiple errors when handling response to /incoming.")
     print("Status code {} from parser, status code {} from sending message queue.".format(parser_result, queue_result))
     print("Sending admin notification.")
-    queue.add_message(config['admin'], "Multiple error statuses when processing an incoming server message. "
-                                       "See error logs for details.")
-    queue.send_all()
+    pending = queue.pending()
+    pending.add_message(config['admin'], "Multiple error statuses when processing an incoming server message. "
+                                         "See error logs for details.")
+    pending.send_all()
@@ -0,0 +1,44 @@
+"""
+Timings of the start of a process, from importing the package to the end of init_app(), printed once the app is ready.
+Worker processes are recycled by mod_wsgi and similar servers, and the requests that reach a new worker wait on all of
+this.
+"""
+import time
+
+
+# Taken as the package starts to be imported (this module is imported first, see __init__.py).
+_last = time.perf_counter()
+_steps = []
+
+
+def step(name):
+    """
+    Record the time taken by a step of starting up, since the previous step.
+    :param name: Description of the step.
+    :return: Nothing.
+    """
+    global _last
+    now = time.perf_counter()
+    _steps.append((name, now - _last))
+    _last = now
+
+
+def restart():
+    """
+    Start timing again without recording a step, so that time between steps (e.g. between importing the package and
+    calling init_app()) is not counted.
+    :return: Nothing.
+    """
+    global _last
+    _last = time.perf_counter()
+
+
+def report():
+    """
+    Print the steps recorded so far, then clear them.
+    :return: Nothing.
+    """
+    total = sum(seconds for _, seconds in _steps)
+    print("Startup took {:.0f} ms: {}".format(
+        total * 1000, ', '.join('{} {:.0f} ms'.format(name, seconds * 1000) for name, seconds in _steps)))
+    del _steps[:]
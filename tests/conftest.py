@@ -0,0 +1,36 @@
+import pytest
+
+from feelsbot.database import Database, FeelsTable, SeenMessagesTable, UserStatusTable
+
+
+def reset_database():
+    # The database and its caches are process-wide, so each test starts them afresh.
+    if Database._pool is not None:
+        Database._pool.close_all()
+    Database._config = None
+    Database._pool = None
+    FeelsTable._index = None
+    FeelsTable._need_approval = None
+    UserStatusTable._cache = None
+    SeenMessagesTable._cache = None
+    SeenMessagesTable._purged_at = None
+
+
+@pytest.fixture
+def config(tmp_path):
+    """
+    A minimal application configuration, with a new database initialised from it.
+    """
+    reset_database()
+    config = {
+        'database': str(tmp_path / 'feelsbot.db'),
+        'bot_username': 'test-bot',
+        'bot_api_key': 'test-key',
+        'webhook': 'http://localhost/incoming',
+        'webhook_user': 'user',
+        'webhook_pass': 'pass',
+        'admin': 'test-admin',
+    }
+    Database.init_database(config)
+    yield config
+    reset_database()
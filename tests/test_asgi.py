@@ -0,0 +1,82 @@
+import asyncio
+import base64
+import json
+import sqlite3
+
+import pytest
+
+from feelsbot import metrics
+from feelsbot.asgi import init_asgi_app
+from feelsbot.kik_api import PooledKikApi
+
+
+@pytest.fixture
+def asgi_app(config, tmp_path, monkeypatch):
+    # Nothing is sent to Kik: setting the webhook is the only call made while starting up.
+    monkeypatch.setattr(PooledKikApi, 'set_configuration', lambda self, configuration: {})
+    config['metrics_enabled'] = True
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(config))
+    app = init_asgi_app(str(path))
+    yield app
+    asyncio.run(app.close())
+    metrics.configure({})
+
+
+def call(app, method, path, chunks=(b'',), headers=(), query=b'', on_receive=None):
+    """
+    Make a request to the ASGI app, with the body sent in the given chunks.
+    :param on_receive: Function called each time the app receives a chunk.
+    :return: Tuple of the status, headers (as a dictionary) and body of the response.
+    """
+    events = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+              for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if on_receive is not None:
+            on_receive()
+        return events.pop(0) if events else {'type': 'http.disconnect'}
+
+    async def send(event):
+        sent.append(event)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], {name.decode(): value.decode() for name, value in sent[0]['headers']}, sent[1]['body']
+
+
+def auth(config):
+    credentials = '{}:{}'.format(config['webhook_user'], config['webhook_pass']).encode()
+    return [('Authorization', 'Basic ' + base64.b64encode(credentials).decode())]
+
+
+def test_content_types(asgi_app, config):
+    status, headers, body = call(asgi_app, 'GET', '/metrics', headers=auth(config))
+    assert status == 200
+    assert headers['content-type'] == 'text/plain; version=0.0.4'
+
+    status, headers, body = call(asgi_app, 'GET', '/')
+    assert status == 200
+    assert headers['content-type'] == 'text/html; charset=utf-8'
+
+
+def test_import_is_streamed(asgi_app, config):
+    rows = [json.dumps({'submitted': 'today', 'name': 'name', 'comment': 'feel {}'.format(i)}).encode() + b'\n'
+            for i in range(20)]
+    imported = []
+
+    def count_imported():
+        connect = sqlite3.connect(config['database'])
+        imported.append(connect.execute('SELECT COUNT(*) FROM feels').fetchone()[0])
+        connect.close()
+
+    status, headers, body = call(asgi_app, 'POST', '/import-feels', rows, auth(config), b'format=jsonl&chunk_size=1',
+                                 count_imported)
+    assert status == 200
+    assert headers['content-type'] == 'application/json'
+    assert json.loads(body.decode())['imported'] == 20
+    # Rows are imported as the body arrives, rather than once all of it has been received.
+    assert len(imported) == len(rows)
+    assert imported[-1] > 0
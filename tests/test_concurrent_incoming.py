@@ -0,0 +1,86 @@
+"""
+Smaller version of benchmarks/concurrent_incoming.py: concurrent /incoming requests to one app must each send only
+their own replies, to their own sender and chat, and change only their own sender's state.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from feelsbot import server
+from feelsbot.database import FeelsTable, SubscribersTable
+from feelsbot.kik_api import PooledKikApi
+from feelsbot.parser import BUTTONS, REPLIES
+
+THREADS = 4
+SUBSCRIBERS = 12
+
+
+def test_concurrent_requests_do_not_cross(config, tmp_path, monkeypatch):
+    lock = threading.Lock()
+    local = threading.local()
+    sent = {}
+
+    def send_messages(self, messages):
+        with lock:
+            sent.setdefault(getattr(local, 'request', None), []).extend(m.to_json() for m in messages)
+        return {}
+    monkeypatch.setattr(PooledKikApi, 'set_configuration', lambda self, configuration: {})
+    monkeypatch.setattr(PooledKikApi, 'send_messages', send_messages)
+
+    subscribers = ['subscriber-{}'.format(i) for i in range(SUBSCRIBERS)]
+    config['recipients'] = subscribers
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(config))
+    client = server.init_app(str(path)).test_client()
+    with FeelsTable() as table:
+        table.insert_feels([('today', 'name', 'feel {}'.format(i)) for i in range(10)])
+        for feel_id in range(1, 11):
+            table.approve(feel_id)
+
+    # Every other subscriber asks for a feel and the rest unsubscribe, mixed with messages from strangers.
+    requests = []
+    for number in range(60):
+        if number % 3 == 0:
+            requests.append((number, 'stranger-{}'.format(number), 'hello'))
+        else:
+            user = subscribers[number // 3 % SUBSCRIBERS]
+            button = 'recipient_unsubscribe' if subscribers.index(user) % 2 else 'recipient_request_feel'
+            requests.append((number, user, BUTTONS[button]))
+
+    def post(number, user, body):
+        data = json.dumps({'messages': [{
+            'type': 'text', 'id': 'message-{}'.format(number), 'from': user, 'chatId': 'chat-{}'.format(number),
+            'body': body, 'participants': [user], 'timestamp': int(time.time() * 1000),
+        }]}).encode('utf-8')
+        signature = base64.b16encode(hmac.new(config['bot_api_key'].encode('utf-8'), data, hashlib.sha1).digest())
+        local.request = number
+        try:
+            return client.post('/incoming', data=data, content_type='application/json',
+                               headers={'X-Kik-Signature': signature.decode('utf-8')}).status_code
+        finally:
+            local.request = None
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        statuses = list(executor.map(lambda request: post(*request), requests))
+    assert statuses == [200] * len(requests)
+
+    for number, user, body in requests:
+        messages = sent.pop(number, [])
+        if body == BUTTONS['recipient_request_feel']:
+            # A feel for the subscriber and the matching notification for the admin, and nothing else.
+            assert sorted(m['to'] for m in messages) == sorted([config['admin'], user])
+        elif body == BUTTONS['recipient_unsubscribe']:
+            # Either unsubscribed, or told they are not subscribed if an earlier request unsubscribed them.
+            assert [(m['to'], m['chatId']) for m in messages] == [(user, 'chat-{}'.format(number))]
+        else:
+            assert [(m['to'], m['chatId'], m['body']) for m in messages] == \
+                   [(user, 'chat-{}'.format(number), REPLIES['invalid_user'])]
+    assert sent == {}
+
+    with SubscribersTable() as table:
+        for i, user in enumerate(subscribers):
+            assert table.is_active(user) == (i % 2 == 0)
@@ -0,0 +1,10 @@
+from feelsbot.database import FeelsTable
+
+
+def test_unknown_feel_ids_are_ignored(config):
+    with FeelsTable() as table:
+        table.insert_feel('today', 'name', 'comment')
+        table.approve(99)
+        table.block(99)
+        table.unblock(99)
+        assert table.counts() == (1, 1, 0)
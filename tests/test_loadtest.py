@@ -0,0 +1,22 @@
+from feelsbot.loadtest import print_report, summarise
+
+
+class NoKik:
+    batches = 0
+    messages = 0
+    errors = 0
+
+
+def test_report_with_no_completed_requests(capsys):
+    report = summarise([], 2.0, NoKik())
+    assert report['routes']['all']['requests'] == 0
+    assert report['routes']['all']['p95_ms'] is None
+    print_report(report)
+    assert 'n/a' in capsys.readouterr().out
+
+
+def test_report_latencies():
+    report = summarise([('incoming', 200, 0.010), ('incoming', 202, 0.030), ('new-feel', 200, 0.020)], 2.0, NoKik())
+    assert report['routes']['incoming']['statuses'] == {'200': 1, '202': 1}
+    assert report['routes']['all']['p50_ms'] == 20.0
+    assert report['routes']['all']['per_second'] == 1.5
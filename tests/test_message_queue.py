@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import Counter
+
+from feelsbot.message_queue import MAX_PER_BATCH, MAX_PER_USER, Dispatcher, plan_batches
+
+
+def build_queue(counts):
+    """
+    :param counts: Dictionary of recipient to the number of messages queued for them.
+    :return: Queue of (recipient, number) items, as planned by plan_batches().
+    """
+    return {person: [(person, i) for i in range(count)] for person, count in counts.items()}
+
+
+def test_plan_keeps_to_the_batch_limits():
+    queue = build_queue({'user{}'.format(i): 3 + i * 4 for i in range(12)})
+    batches = plan_batches(queue)
+    for batch in batches:
+        assert 0 < len(batch) <= MAX_PER_BATCH
+        assert max(Counter(person for person, _ in batch).values()) <= MAX_PER_USER
+    # Every message is planned exactly once.
+    assert sorted(item for batch in batches for item in batch) == sorted(item for items in queue.values()
+                                                                        for item in items)
+
+
+def test_plan_keeps_each_recipients_order():
+    queue = build_queue({'one': 23, 'two': 7, 'three': 1})
+    batches = plan_batches(queue, per_user=2, per_batch=5)
+    for person in queue:
+        assert [item for batch in batches for item in batch if item[0] == person] == queue[person]
+
+
+def test_plan_serves_recipients_round_robin():
+    queue = build_queue({'busy': 20, 'quiet': 2, 'other': 2})
+    batches = plan_batches(queue, per_user=2, per_batch=4)
+    # Each takes its turn before the busy recipient is given more, rather than waiting for it to be done.
+    assert [person for person, _ in batches[0]] == ['busy', 'busy', 'quiet', 'quiet']
+    assert [person for person, _ in batches[1]] == ['other', 'other', 'busy', 'busy']
+    assert all(person == 'busy' for batch in batches[2:] for person, _ in batch)
+
+
+def test_plan_of_an_empty_queue():
+    assert plan_batches({}) == []
+    assert plan_batches({'nobody': []}) == []
+
+
+def test_stop_keeps_to_the_timeout_when_full():
+    release = threading.Event()
+    dispatcher = Dispatcher(depth=1)
+    # One item being sent (stuck, as on slow calls to Kik) and one waiting, so the queue is full.
+    assert dispatcher.submit(lambda: release.wait(5))
+    time.sleep(0.05)
+    assert dispatcher.submit(lambda: None)
+
+    started = time.monotonic()
+    dispatcher.stop(0.2)
+    assert time.monotonic() - started < 1
+    release.set()
+
+
+def test_stop_sends_everything_waiting():
+    sent = []
+    dispatcher = Dispatcher(depth=10)
+    for i in range(5):
+        assert dispatcher.submit(lambda i=i: sent.append(i))
+    dispatcher.stop(5)
+    assert sent == list(range(5))
+    assert not dispatcher._thread.is_alive()
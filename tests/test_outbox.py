@@ -0,0 +1,74 @@
+import time
+
+from kik import KikError
+from kik.messages import TextMessage
+
+from feelsbot.database import OutboxTable
+from feelsbot.message_queue import MessageQueue
+
+
+class FlakyKik:
+    """
+    Stand in for KikApi, rejecting a given number of calls before accepting the rest.
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.sent = []
+
+    def send_messages(self, messages):
+        if self.failures > 0:
+            self.failures -= 1
+            raise KikError("unavailable", 503)
+        self.sent += [message.to for message in messages]
+        return {}
+
+
+def add_messages(*recipients):
+    with OutboxTable() as table:
+        for recipient in recipients:
+            table.add(recipient, TextMessage(to=recipient, body='hello').to_json())
+
+
+def outbox_rows():
+    with OutboxTable() as table:
+        return [dict(row) for row in table._cursor.execute(
+            'SELECT recipient, attempts, next_attempt, sent, claim FROM outbox ORDER BY outbox_id')]
+
+
+def test_claimed_messages_are_not_claimed_again(config):
+    add_messages('one', 'two', 'three')
+    with OutboxTable() as table:
+        first = table.claim_due(2, 8, 0.2)
+        second = table.claim_due(10, 8, 0.2)
+        assert [recipient for _, recipient, _ in first] == ['one', 'two']
+        assert [recipient for _, recipient, _ in second] == ['three']
+        assert table.claim_due(10, 8, 0.2) == []
+
+        # Once the claims expire (the process holding them having died), the messages can be claimed again.
+        time.sleep(0.25)
+        assert [recipient for _, recipient, _ in table.claim_due(10, 8, 0.2)] == ['one', 'two', 'three']
+
+
+def test_failed_send_retried_after_backoff(config):
+    config.update(message_queue_outbox=True, outbox_backoff=0.2, outbox_max_backoff=10)
+    kik = FlakyKik(failures=2)
+    queue = MessageQueue(config, kik)
+    add_messages('one')
+
+    before = time.time()
+    # The batch and then the admin notification of the error are both rejected.
+    assert queue.send_outbox() == 202
+    row = outbox_rows()[0]
+    assert row['attempts'] == 1 and row['sent'] is None and row['claim'] is None
+    assert before + 0.2 <= row['next_attempt'] <= time.time() + 0.2
+
+    # Not retried before the backoff has passed.
+    assert queue.send_outbox() == 200
+    assert kik.sent == []
+
+    time.sleep(0.25)
+    assert queue.send_outbox() == 200
+    assert kik.sent == ['one']
+    row = outbox_rows()[0]
+    assert row['attempts'] == 1 and row['sent'] is not None
@@ -0,0 +1,67 @@
+from kik.messages import TextMessage
+
+from feelsbot.database import FeelsTable, SubscribersTable
+from feelsbot.parser import BUTTONS, MessageParser, REPLIES, SOURCE_RECIPIENT
+
+
+class RecordingQueue:
+    """
+    Stand in for a pending message queue, keeping the messages added.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.broadcasts = []
+
+    def add_message(self, to, body, chat_id=None, keyboards=None):
+        self.messages.append((to, body, keyboards))
+
+    def add_broadcast(self, bodies, keyboards=None):
+        self.broadcasts.append(bodies)
+
+
+def process(config, user, body):
+    queue = RecordingQueue()
+    MessageParser(config, queue).process_text_message(TextMessage(from_user=user, chat_id='chat', body=body), queue)
+    return queue
+
+
+def send(config, user, body):
+    queue = process(config, user, body)
+    assert len(queue.messages) == 1
+    return queue.messages[0]
+
+
+def buttons(keyboards):
+    return [response.body for response in keyboards]
+
+
+def test_keyboard_after_subscribe_and_unsubscribe(config):
+    config['subscriptions_open'] = True
+
+    to, body, keyboards = send(config, 'new-user', BUTTONS['subscribe'])
+    assert body == REPLIES['user_subscribed']
+    assert buttons(keyboards) == [BUTTONS['recipient_request_feel'], BUTTONS['recipient_unsubscribe']]
+    with SubscribersTable() as table:
+        assert table.is_active('new-user')
+
+    to, body, keyboards = send(config, 'new-user', BUTTONS['recipient_unsubscribe'])
+    assert body == REPLIES['recipient_unsubscribed']
+    assert buttons(keyboards) == [BUTTONS['subscribe']]
+    with SubscribersTable() as table:
+        assert not table.is_active('new-user')
+
+
+def test_requested_feel_only_sent_to_the_requester(config):
+    with SubscribersTable() as table:
+        table.add('first')
+        table.add('second')
+    with FeelsTable() as table:
+        table.insert_feel('today', 'name', 'comment')
+        table.approve(table.select_unapproved()['feel_id'])
+
+    queue = process(config, 'first', BUTTONS['recipient_request_feel'])
+    assert queue.broadcasts == []
+    assert sorted(to for to, body, keyboards in queue.messages) == sorted([config['admin'], 'first'])
+    body = [body for to, body, keyboards in queue.messages if to == 'first'][0]
+    assert body.startswith(SOURCE_RECIPIENT['recipient'])
@@ -0,0 +1,54 @@
+import os
+import threading
+
+from feelsbot import profiler
+
+
+def cprofiler(tmp_path):
+    options = dict(profiler.PROFILE_DEFAULTS, profile_enabled=True, profile_rate=1.0, profile_dir=str(tmp_path))
+    return profiler.Profiler(options)
+
+
+def test_overlapping_cprofiles_are_skipped(tmp_path):
+    instance = cprofiler(tmp_path)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def first():
+        profile = instance.start()
+        started.set()
+        finish.wait(5)
+        instance.stop(profile, 'first')
+    thread = threading.Thread(target=first)
+    thread.start()
+    started.wait(5)
+
+    # A request profiled at the same time on another thread is not sampled, rather than failing.
+    assert instance.start() is None
+    finish.set()
+    thread.join(5)
+    files = os.listdir(str(tmp_path))
+    assert len(files) == 1 and files[0].endswith('-first.pstats')
+
+    # Once the first has stopped, the next request can be profiled.
+    profile = instance.start()
+    assert profile is not None
+    instance.stop(profile, 'second')
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def test_cprofile_skipped_when_another_profiler_is_active(tmp_path, monkeypatch):
+    class ActiveProfile:
+        def enable(self):
+            raise ValueError("Another profiling tool is already active")
+
+    instance = cprofiler(tmp_path)
+    monkeypatch.setattr(profiler.cProfile, 'Profile', ActiveProfile)
+    monkeypatch.setattr(profiler, '_profiler', instance)
+    assert instance.start() is None
+    assert profiler.call_handler(lambda context: ('reply', 200), None, 0) == ('reply', 200)
+    monkeypatch.undo()
+
+    profile = instance.start()
+    assert profile is not None
+    instance.stop(profile, 'after')
@@ -0,0 +1,70 @@
+from kik.messages import TextMessage
+
+from feelsbot.message_queue import MessageQueue
+from feelsbot.rate_limiter import RATE_LIMIT_DEFAULTS, RateLimiter
+
+
+class RecordingKik:
+    def __init__(self):
+        self.sent = []
+
+    def send_messages(self, messages):
+        self.sent += [(message.to, message.body) for message in messages]
+        return {}
+
+
+def messages(to, count):
+    return [TextMessage(to=to, body='message {}'.format(i)) for i in range(count)]
+
+
+def test_over_the_limit_is_deferred(config):
+    limiter = RateLimiter(dict(RATE_LIMIT_DEFAULTS, rate_limit_user_rate=1.0, rate_limit_user_burst=2))
+    granted, delay = limiter.acquire([('one', 3), ('two', 1)])
+    assert granted == {'one': 2, 'two': 1}
+    assert delay > 0
+
+    # The bucket is shared, so a later call is limited too until it refills.
+    granted, delay = limiter.acquire([('one', 1)])
+    assert granted == {'one': 0}
+    assert delay > 0
+
+
+def test_queue_sends_what_is_granted_and_schedules_the_rest(config, monkeypatch):
+    config.update(rate_limit=True, rate_limit_user_burst=3)
+    kik = RecordingKik()
+    queue = MessageQueue(config, kik)
+    scheduled = []
+    monkeypatch.setattr(MessageQueue, '_schedule', staticmethod(lambda delay, work: scheduled.append((delay, work))))
+
+    assert queue.send_queue({'one': messages('one', 5), 'two': messages('two', 1)}) == 200
+    assert kik.sent == [('one', 'message 0'), ('one', 'message 1'), ('one', 'message 2'), ('two', 'message 0')]
+    assert len(scheduled) == 1 and scheduled[0][0] > 0
+
+
+class GrantAfterFirst:
+    """
+    Stand in for RateLimiter, refusing everything for 'held' the first time and granting everything afterwards.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, counts):
+        self.calls.append(counts)
+        if len(self.calls) == 1:
+            return {to: 0 if to == 'held' else count for to, count in counts}, 1.5
+        return dict(counts), 0
+
+
+def test_held_recipient_stays_held_for_later_batches(config):
+    queue = MessageQueue(config, RecordingKik())
+    queue.rate_limiter = GrantAfterFirst()
+    # Two batches: the held recipient's first two messages with another's, then the rest of theirs.
+    planned = [(messages('held', 2) + messages('other', 1), {}), (messages('held', 4)[2:], {})]
+
+    admitted, deferred, delay = queue._admit(planned, lambda message: message)
+    assert [[message.to for message in batch] for batch, _ in admitted] == [['other']]
+    assert [message.to for message in deferred] == ['held'] * 4
+    assert delay == 1.5
+    # Tokens are not even asked for the held recipient's later messages, which must wait behind the first ones.
+    assert queue.rate_limiter.calls[1:] == []
@@ -0,0 +1,68 @@
+import random
+from collections import Counter
+
+import pytest
+
+from feelsbot.database import FeelsTable, request_session
+from feelsbot.database.selector import SelectionIndex
+
+
+def indexed():
+    """
+    :return: Dictionary of feel id to selector, of the feels in the selection index.
+    """
+    return dict(FeelsTable.index()._selectors)
+
+
+def add_feels(count, approve=()):
+    with FeelsTable() as table:
+        table.insert_feels([('today', 'name', 'feel {}'.format(i)) for i in range(count)])
+        for feel_id in approve:
+            table.approve(feel_id)
+
+
+def test_pick_is_weighted_across_the_two_lowest_selectors():
+    random.seed(1)
+    index = SelectionIndex()
+    index.load([(1, 3), (2, 3), (3, 4), (4, 5), (5, 9)])
+    picks = Counter(index.pick()[0] for _ in range(3000))
+    # Only feels within 1 of the lowest selector are eligible, each as likely as any other.
+    assert set(picks) == {1, 2, 3}
+    assert all(800 < count < 1200 for count in picks.values())
+
+
+def test_index_follows_approve_block_and_unblock(config):
+    add_feels(3, approve=[1, 2])
+    with FeelsTable() as table:
+        table.select_random_feel()
+    assert indexed().keys() == {1, 2}
+
+    with FeelsTable() as table:
+        table.block(2)
+    assert indexed().keys() == {1}
+
+    with FeelsTable() as table:
+        table.unblock(2)
+        table.approve(3)
+        rows = {feel_id: table._select_row(feel_id)['selector'] for feel_id in (1, 2, 3)}
+    # The index holds the same selectors as the table, so approved feels join at the current lowest selector.
+    assert indexed() == rows
+
+
+def test_index_reloaded_after_rollback(config):
+    add_feels(2, approve=[1])
+    with FeelsTable() as table:
+        table.select_random_feel()
+
+    with pytest.raises(RuntimeError):
+        with request_session():
+            with FeelsTable() as table:
+                table.approve(2)
+            assert 2 in indexed()
+            raise RuntimeError("rolled back")
+
+    # The approval was rolled back, so the index is out of date and reloaded before the next pick.
+    assert not FeelsTable.index().loaded
+    with FeelsTable() as table:
+        assert table.select_random_feel()['feel_id'] == 1
+    assert indexed().keys() == {1}